@@ -37,6 +37,7 @@ for box_predictor in model.roi_heads.box_predictors:
     box_predictor.test_topk_per_image = 1000
     box_predictor.test_score_thresh = 0.5
 model.roi_heads.num_components = 1
+model.roi_heads.share_pooling = True
 
 # DC2 overrides
 model.backbone.bottom_up.in_chans = 6
@@ -0,0 +1,65 @@
+"""Benchmark the latency/AP tradeoff of running fewer cascade stages, with and without masks.
+
+Example:
+    $ python benchmark_cascade_depth.py --cfgfile configs/solo/solo_swin_DC2.py --test-metadata test.json
+    $ python benchmark_cascade_depth.py --cfgfile ... --test-metadata ... --stages 1 3 --no-mask-runs --output depth.json
+"""
+
+import argparse
+import json
+
+import torch
+from detectron2.config import LazyConfig
+
+from deepdisc.astrodet.astrodet import AstroPredictor
+from deepdisc.benchmarks import cascade_depth, data_pipeline
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cfgfile", type=str, required=True, help="the model config")
+    parser.add_argument("--test-metadata", type=str, required=True, help="held-out dataset dicts (json)")
+    parser.add_argument("--checkpoint", type=str, default=None, help="default: the config's train.init_checkpoint")
+    parser.add_argument("--device", type=str, default=None, help="default: the config's train.device")
+    parser.add_argument("--stages", nargs="+", type=int, default=None, help="default: 1 .. the trained depth")
+    parser.add_argument("--no-mask-runs", action="store_true", help="only run with the mask head on")
+    parser.add_argument("--n-images", type=int, default=20, help="number of images")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--output", type=str, default=None, help="json report file")
+    return parser
+
+
+def main(args):
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    cfg = LazyConfig.load(args.cfgfile)
+    for key in cfg.get("MISC", dict()).keys():
+        cfg[key] = cfg.MISC[key]
+    if args.device is not None:
+        cfg.train.device = args.device
+    if args.checkpoint is not None:
+        cfg.train.init_checkpoint = args.checkpoint
+    predictor = AstroPredictor(cfg)
+
+    with open(args.test_metadata) as f:
+        dataset_dicts = json.load(f)[: args.n_images]
+    imreader = cfg.dataloader.imagereader
+    images = [imreader(cfg.dataloader.key_mapper(d)) for d in dataset_dicts]
+
+    results = cascade_depth.benchmark_cascade_depth(
+        predictor,
+        images,
+        dataset_dicts=dataset_dicts,
+        stages=args.stages,
+        masks=(True,) if args.no_mask_runs else (True, False),
+    )
+    print(cascade_depth.format_table(results))
+    if args.output is not None:
+        report = {"environment": data_pipeline.environment_info(), "config": vars(args), "results": results}
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(make_parser().parse_args())
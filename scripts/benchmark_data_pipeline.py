@@ -0,0 +1,79 @@
+"""Benchmark the image readers, data mappers and train loaders on synthetic tiles.
+
+Example:
+    $ python benchmark_data_pipeline.py --surveys dc2 hsc --workers 0 4 --output report.json
+    $ python benchmark_data_pipeline.py --surveys dc2 --compare-to baseline.json --output report.json
+"""
+
+import argparse
+import sys
+import tempfile
+
+from deepdisc.benchmarks import data_pipeline
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--surveys", nargs="+", default=["dc2", "hsc", "roman"], choices=list(data_pipeline.SURVEYS))
+    parser.add_argument("--norms", nargs="+", default=["raw", "zscore", "lupton"], help="contrast scalings")
+    parser.add_argument(
+        "--mappers", nargs="+", default=["DictMapper", "RedshiftDictMapper"], help="mapper classes in deepdisc.model.loaders"
+    )
+    parser.add_argument("--workers", nargs="+", type=int, default=[0, 2, 4], help="data loader worker counts")
+    parser.add_argument(
+        "--augs", type=str, default=None, help="augmentation function in deepdisc.data_format.augment_image, e.g. dc2_train_augs"
+    )
+    parser.add_argument("--n-images", type=int, default=8, help="synthetic tiles per survey")
+    parser.add_argument("--n-objects", type=int, default=20, help="sources per tile")
+    parser.add_argument("--shape", type=int, nargs=3, default=None, help="override the tile (bands, height, width)")
+    parser.add_argument("--repeats", type=int, default=3, help="passes over the tiles for reader/mapper benchmarks")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--n-batches", type=int, default=20, help="batches timed per loader benchmark")
+    parser.add_argument("--data-dir", type=str, default=None, help="where to write the tiles (default: a temporary directory)")
+    parser.add_argument("--output", type=str, default="data_pipeline_benchmark.json", help="json report file")
+    parser.add_argument("--compare-to", type=str, default=None, help="a previous json report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative slowdown flagged as a regression")
+    return parser
+
+
+def main(args):
+    augs = None
+    if args.augs is not None:
+        from deepdisc.data_format import augment_image
+
+        augs = getattr(augment_image, args.augs)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        report = data_pipeline.run_benchmarks(
+            args.data_dir or tmpdir,
+            surveys=args.surveys,
+            norms=args.norms,
+            mappers=args.mappers,
+            workers=args.workers,
+            n_images=args.n_images,
+            n_objects=args.n_objects,
+            repeats=args.repeats,
+            batch_size=args.batch_size,
+            n_batches=args.n_batches,
+            augs=augs,
+            shape=args.shape,
+        )
+    data_pipeline.save_report(report, args.output)
+
+    for r in report["results"]:
+        case = " ".join(str(v) for k, v in data_pipeline.result_key(r))
+        print(f"{case:<55} {r['samples_per_s']:10.1f} samples/s")
+
+    if args.compare_to is not None:
+        comparison = data_pipeline.compare_reports(
+            data_pipeline.load_report(args.compare_to), report, tolerance=args.tolerance
+        )
+        regressions = [c for c in comparison if c["regression"]]
+        for c in regressions:
+            print("REGRESSION", c["case"], f"{c['ratio']:.2f}x")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(make_parser().parse_args()))
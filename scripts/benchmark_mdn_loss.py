@@ -0,0 +1,41 @@
+"""Benchmark the fused mixture density NLL of the redshift PDF heads against torch.distributions.
+
+Example:
+    $ python benchmark_mdn_loss.py --n-instances 64 512 4096 --num-components 1 5
+    $ python benchmark_mdn_loss.py --scale-activation softplus --output mdn_loss.json
+"""
+
+import argparse
+import json
+
+from deepdisc.benchmarks import data_pipeline, mdn_loss
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-instances", nargs="+", type=int, default=[64, 512, 4096], help="instances per step")
+    parser.add_argument("--num-components", nargs="+", type=int, default=[1, 5], help="mixture components")
+    parser.add_argument("--scale-activation", choices=["exp", "softplus"], default="exp")
+    parser.add_argument("--n-grid", type=int, default=300, help="redshifts in the inference grid")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--output", type=str, default=None, help="json report file")
+    return parser
+
+
+def main(args):
+    results = mdn_loss.benchmark_mdn_loss(
+        n_instances=args.n_instances,
+        num_components=args.num_components,
+        scale_activation=args.scale_activation,
+        n_grid=args.n_grid,
+        repeats=args.repeats,
+    )
+    print(mdn_loss.format_table(results))
+    if args.output is not None:
+        report = {"environment": data_pipeline.environment_info(), "config": vars(args), "results": results}
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(make_parser().parse_args())
@@ -0,0 +1,45 @@
+"""Benchmark the CPU inference latency and memory of the redshift ROI heads.
+
+Example:
+    $ python benchmark_roi_heads.py --detections 10 100 500 --threads 4 --output roi_heads.json
+    $ python benchmark_roi_heads.py --heads RedshiftPDFCasROIHeads RedshiftPointCasROIHeads
+"""
+
+import argparse
+import json
+
+from deepdisc.benchmarks import data_pipeline, roi_heads
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--heads", nargs="+", default=None, choices=list(roi_heads.HEADS), help="default: all heads")
+    parser.add_argument("--detections", nargs="+", type=int, default=[10, 100, 500], help="detections per image")
+    parser.add_argument("--image-size", type=int, default=512, help="input image size of the synthetic features")
+    parser.add_argument("--n-proposals", type=int, default=1000, help="proposals per image")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--no-isolate", action="store_true", help="run all heads in this process")
+    parser.add_argument("--output", type=str, default=None, help="json report file")
+    return parser
+
+
+def main(args):
+    results = roi_heads.run_benchmarks(
+        heads=args.heads,
+        isolate=not args.no_isolate,
+        detections=args.detections,
+        image_size=args.image_size,
+        n_proposals=args.n_proposals,
+        repeats=args.repeats,
+        threads=args.threads,
+    )
+    print(roi_heads.format_table(results))
+    if args.output is not None:
+        report = {"environment": data_pipeline.environment_info(), "config": vars(args), "results": results}
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(make_parser().parse_args())
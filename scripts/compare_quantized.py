@@ -0,0 +1,65 @@
+"""Compare the predictions of a dynamically int8-quantised model with the float model on CPU.
+
+Both predictors are built from the same config and checkpoint, and run on held-out images.
+The report gives the latencies, the fraction of float detections matched by the quantised
+model, the class agreement, and the score and redshift (PDF) differences.
+
+Example:
+    $ python compare_quantized.py --cfgfile configs/solo/solo_swin_DC2.py --test-metadata test.json
+    $ python compare_quantized.py --cfgfile ... --test-metadata ... --mode all --n-images 50 --output q.json
+"""
+
+import argparse
+import json
+
+import torch
+from detectron2.config import LazyConfig
+
+from deepdisc.astrodet.astrodet import AstroPredictor
+from deepdisc.benchmarks import data_pipeline
+from deepdisc.inference import quantization
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cfgfile", type=str, required=True, help="the model config")
+    parser.add_argument("--test-metadata", type=str, required=True, help="held-out dataset dicts (json)")
+    parser.add_argument("--checkpoint", type=str, default=None, help="default: the config's train.init_checkpoint")
+    parser.add_argument("--mode", choices=quantization.QUANTIZE_MODES, default="heads", help="what to quantise")
+    parser.add_argument("--n-images", type=int, default=20, help="number of images to compare")
+    parser.add_argument("--iou-thresh", type=float, default=0.5, help="IoU to match detections")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--output", type=str, default=None, help="json report file")
+    return parser
+
+
+def main(args):
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    cfg = LazyConfig.load(args.cfgfile)
+    for key in cfg.get("MISC", dict()).keys():
+        cfg[key] = cfg.MISC[key]
+    cfg.train.device = "cpu"
+    if args.checkpoint is not None:
+        cfg.train.init_checkpoint = args.checkpoint
+
+    reference = AstroPredictor(cfg)
+    candidate = AstroPredictor(cfg, quantize=args.mode)
+
+    with open(args.test_metadata) as f:
+        dataset_dicts = json.load(f)[: args.n_images]
+    imreader = cfg.dataloader.imagereader
+    images = (imreader(cfg.dataloader.key_mapper(d)) for d in dataset_dicts)
+
+    zs = quantization.redshift_grid(reference.model)
+    summary = quantization.compare_predictors(reference, candidate, images, iou_thresh=args.iou_thresh, zs=zs)
+    print(quantization.format_report(summary))
+    if args.output is not None:
+        report = {"environment": data_pipeline.environment_info(), "config": vars(args), "summary": summary}
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(make_parser().parse_args())
@@ -0,0 +1,56 @@
+"""Convert a training checkpoint into a weights-only inference checkpoint for fast loading.
+
+The inference checkpoint is memory-mapped by AstroPredictor(cfg, inference_checkpoint=...),
+so inference workers on one machine share its weights instead of each unpickling the
+training checkpoint.  The script reports the file sizes and the predictor startup times.
+
+Example:
+    $ python export_inference_checkpoint.py --cfgfile configs/solo/solo_swin_DC2.py --output swin_dc2_inference.pt
+    $ python export_inference_checkpoint.py --cfgfile ... --checkpoint model_final.pth --half --output swin_dc2_fp16.pt
+"""
+
+import argparse
+import os
+import time
+
+from detectron2.config import LazyConfig
+
+from deepdisc.astrodet.astrodet import AstroPredictor
+from deepdisc.inference.checkpoint import save_inference_checkpoint
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cfgfile", type=str, required=True, help="the model config")
+    parser.add_argument("--checkpoint", type=str, default=None, help="default: the config's train.init_checkpoint")
+    parser.add_argument("--output", type=str, required=True, help="the inference checkpoint to write")
+    parser.add_argument("--half", action="store_true", help="store the weights in float16")
+    return parser
+
+
+def main(args):
+    cfg = LazyConfig.load(args.cfgfile)
+    for key in cfg.get("MISC", dict()).keys():
+        cfg[key] = cfg.MISC[key]
+    cfg.train.device = "cpu"
+    if args.checkpoint is not None:
+        cfg.train.init_checkpoint = args.checkpoint
+
+    start = time.perf_counter()
+    predictor = AstroPredictor(cfg)
+    startup = time.perf_counter() - start
+
+    save_inference_checkpoint(predictor.model, args.output, half=args.half)
+
+    start = time.perf_counter()
+    AstroPredictor(cfg, inference_checkpoint=args.output)
+    inference_startup = time.perf_counter() - start
+
+    size_mb = os.path.getsize(cfg.train.init_checkpoint) / 2**20
+    inference_size_mb = os.path.getsize(args.output) / 2**20
+    print(f"size       training {size_mb:8.1f} MB   inference {inference_size_mb:8.1f} MB")
+    print(f"startup    training {startup:8.2f} s    inference {inference_startup:8.2f} s")
+
+
+if __name__ == "__main__":
+    main(make_parser().parse_args())
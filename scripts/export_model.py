@@ -0,0 +1,77 @@
+"""Export a trained model to a TorchScript file that ExportedAstroPredictor loads directly.
+
+The first image of the metadata is used to trace the model, and the next --n-check images
+to check the traced model against the eager one and compare their latencies.
+
+Example:
+    $ python export_model.py --cfgfile configs/solo/solo_swin_DC2.py --metadata test.json --output swin_dc2.ts
+    $ python export_model.py --cfgfile ... --metadata ... --device cpu --quantize heads --output swin_dc2_int8.ts
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+from detectron2.config import LazyConfig
+
+from deepdisc.astrodet.astrodet import AstroPredictor
+from deepdisc.inference.export import ExportedAstroPredictor, export_predictor
+from deepdisc.inference.quantization import QUANTIZE_MODES
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cfgfile", type=str, required=True, help="the model config")
+    parser.add_argument("--metadata", type=str, required=True, help="dataset dicts (json) of sample tiles")
+    parser.add_argument("--checkpoint", type=str, default=None, help="default: the config's train.init_checkpoint")
+    parser.add_argument("--output", type=str, required=True, help="the TorchScript file to write")
+    parser.add_argument("--device", type=str, default=None, help="default: the config's train.device")
+    parser.add_argument("--quantize", choices=QUANTIZE_MODES, default=None, help="dynamic int8 quantization (CPU)")
+    parser.add_argument("--n-check", type=int, default=3, help="images to check the traced model on")
+    return parser
+
+
+def median_latency_ms(predictor, images):
+    times = []
+    for image in images:
+        start = time.perf_counter()
+        predictor(image)
+        times.append(time.perf_counter() - start)
+    return 1000 * float(np.median(times))
+
+
+def main(args):
+    cfg = LazyConfig.load(args.cfgfile)
+    for key in cfg.get("MISC", dict()).keys():
+        cfg[key] = cfg.MISC[key]
+    if args.device is not None:
+        cfg.train.device = args.device
+    if args.checkpoint is not None:
+        cfg.train.init_checkpoint = args.checkpoint
+
+    start = time.perf_counter()
+    predictor = AstroPredictor(cfg, quantize=args.quantize)
+    eager_startup = time.perf_counter() - start
+
+    with open(args.metadata) as f:
+        dataset_dicts = json.load(f)[: args.n_check + 1]
+    imreader = cfg.dataloader.imagereader
+    images = [imreader(cfg.dataloader.key_mapper(d)) for d in dataset_dicts]
+
+    export_predictor(predictor, images[0], args.output, check_images=images[1:])
+
+    start = time.perf_counter()
+    exported = ExportedAstroPredictor(args.output)
+    exported_startup = time.perf_counter() - start
+
+    check_images = images[1:] or images[:1]
+    print(f"startup    eager {eager_startup:8.2f} s   exported {exported_startup:8.2f} s")
+    print(
+        f"latency    eager {median_latency_ms(predictor, check_images):8.1f} ms  "
+        f"exported {median_latency_ms(exported, check_images):8.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    main(make_parser().parse_args())
@@ -31,8 +31,9 @@ from detectron2.data import MetadataCatalog, DatasetCatalog
 from deepdisc.data_format.augment_image import hsc_test_augs, train_augs
 from deepdisc.data_format.image_readers import DC2ImageReader, HSCImageReader
 from deepdisc.data_format.register_data import register_data_set
+from deepdisc.model.feature_cache import FeatureStore
 from deepdisc.model.loaders import DictMapper, RedshiftDictMapper, return_test_loader, return_train_loader
-from deepdisc.model.models import RedshiftPDFCasROIHeads, return_lazy_model
+from deepdisc.model.models import RedshiftPDFCasROIHeads, return_lazy_model, unfreeze_lazy_model
 from deepdisc.training.trainers import (
     return_evallosshook,
     return_lazy_trainer,
@@ -43,7 +44,7 @@ from deepdisc.training.trainers import (
 from deepdisc.utils.parse_arguments import dtype_from_args, make_training_arg_parser
 
 
-def main(args, freeze):
+def main(args):
     # Hack if you get SSL certificate error
     import ssl
     ssl._create_default_https_context = ssl._create_unverified_context
@@ -64,13 +65,6 @@ def main(args, freeze):
     for key in cfg.get("MISC", dict()).keys():
         cfg[key] = cfg.MISC[key]
 
-    
-    if args.num_gpus==1 and not freeze:
-        DatasetCatalog.remove(cfg.DATASETS.TRAIN)
-        MetadataCatalog.remove(cfg.DATASETS.TRAIN)
-        DatasetCatalog.remove(cfg.DATASETS.TEST)
-        MetadataCatalog.remove(cfg.DATASETS.TEST)
-        
     # Register the data sets
     astrotrain_metadata = register_data_set(
         cfg.DATASETS.TRAIN, trainfile, thing_classes=cfg.metadata.classes
@@ -94,66 +88,80 @@ def main(args, freeze):
     val_per = epoch
     #val_per=5
     
-    model = return_lazy_model(cfg,freeze)
+    # The model, data loaders and their workers are built once and shared by both phases
+    feature_store = FeatureStore(args.feature_cache) if args.feature_cache else None
+    model = return_lazy_model(cfg, freeze=True, feature_store=feature_store)
 
     mapper = cfg.dataloader.train.mapper(
+            cfg.dataloader.imagereader, cfg.dataloader.key_mapper, cfg.dataloader.augs, profile=args.profile
+        ).map_data
+    # the validation loss is not profiled, so its inputs carry no timings
+    eval_mapper = cfg.dataloader.train.mapper(
             cfg.dataloader.imagereader, cfg.dataloader.key_mapper, cfg.dataloader.augs
         ).map_data
 
 
-    loader = return_train_loader(cfg, mapper)
-    eval_loader = return_test_loader(cfg, mapper)    
+    loader = return_train_loader(cfg, mapper, profile=args.profile)
+    eval_loader = return_test_loader(cfg, eval_mapper)    
     
+    ######
+    # Phase 1: train the head layers with the backbone frozen
+    ######
+    if comm.is_main_process():
+        print("Training head layers")
+
     cfg.optimizer.params.model = model
+    cfg.optimizer.lr = 0.001
+    optimizer = return_optimizer(cfg)
 
-        
-    if freeze:
+    saveHook = return_savehook(
+        run_name, val_per, async_save=args.async_checkpoint, max_to_keep=args.max_checkpoints
+    )
+    lossHook = return_evallosshook(val_per, model, eval_loader)
+    schedulerHook = return_schedulerhook(optimizer)
+    hookList = [lossHook, schedulerHook, saveHook]
 
-        cfg.optimizer.lr = 0.001
-        optimizer = return_optimizer(cfg)
+    trainer = return_lazy_trainer(model, loader, optimizer, cfg, hookList)
+    trainer.set_period(epoch//2)
+    if args.profile:
+        trainer.enable_profiling(trace_file=os.path.join(output_dir, run_name + "_trace.json"))
+    trainer.train(0, e1)
+    #trainer.train(0, 10)
 
+    ######
+    # Phase 2: after finetuning the head layers, train the whole model.
+    # Only the parameters' requires_grad flags and the optimizer change; the
+    # weights stay in memory and the data loader workers keep running.
+    ######
+    if comm.is_main_process():
+        print("Training all layers")
 
-        saveHook = return_savehook(run_name)
-        lossHook = return_evallosshook(val_per, model, eval_loader)
-        schedulerHook = return_schedulerhook(optimizer)
-        hookList = [lossHook, schedulerHook, saveHook]
+    model = unfreeze_lazy_model(model, cfg)
 
-        trainer = return_lazy_trainer(model, loader, optimizer, cfg, hookList)
-        trainer.set_period(epoch//2)
-        trainer.train(0, e1)
-        #trainer.train(0, 10)
-        if comm.is_main_process():
-            np.save(output_dir + run_name + "_losses", trainer.lossList)
-            np.save(output_dir + run_name + "_val_losses", trainer.vallossList)
-            
-        return
-            
-    else:
-        
-        cfg.train.init_checkpoint = os.path.join(output_dir, run_name + ".pth")
-        cfg.SOLVER.BASE_LR = 0.0001
-        cfg.SOLVER.MAX_ITER = efinal  # for DefaultTrainer
-        cfg.SOLVER.STEPS=[e2,e3]
-        
-        cfg.optimizer.lr = 0.0001
-        
-        optimizer = return_optimizer(cfg)
-        schedulerHook = return_schedulerhook(optimizer)
-        
-        saveHook = return_savehook(run_name)
-        lossHook = return_evallosshook(val_per, model, eval_loader)
-        schedulerHook = return_schedulerhook(optimizer)
-        hookList = [lossHook, schedulerHook, saveHook]
-
-        trainer = return_lazy_trainer(model, loader, optimizer, cfg, hookList)
-        trainer.set_period(epoch//2)
-        trainer.train(e1, efinal)
-        #trainer.train(10, 20)
-        if comm.is_main_process():
-            losses = np.load(output_dir + run_name + "_losses.npy")
-            losses = np.concatenate((losses, trainer.lossList))
-            np.save(output_dir + run_name + "_losses", losses)
-        return
+    cfg.SOLVER.BASE_LR = 0.0001
+    cfg.SOLVER.MAX_ITER = efinal  # for DefaultTrainer
+    cfg.SOLVER.STEPS=[e2,e3]
+
+    cfg.optimizer.params.model = model
+    cfg.optimizer.lr = 0.0001
+    optimizer = return_optimizer(cfg)
+
+    saveHook = return_savehook(
+        run_name, val_per, async_save=args.async_checkpoint, max_to_keep=args.max_checkpoints
+    )
+    lossHook = return_evallosshook(val_per, model, eval_loader)
+    schedulerHook = return_schedulerhook(optimizer)
+    hookList = [lossHook, schedulerHook, saveHook]
+
+    trainer.start_phase(model, optimizer, cfg, hookList)
+    trainer.train(e1, efinal)
+    #trainer.train(10, 20)
+
+    if comm.is_main_process():
+        np.save(os.path.join(output_dir, run_name + "_losses"), trainer.lossList)
+        np.save(os.path.join(output_dir, run_name + "_val_losses"), trainer.vallossList)
+
+    return
             
     
 
@@ -161,8 +169,6 @@ if __name__ == "__main__":
     args = make_training_arg_parser().parse_args()
     print("Command Line Args:", args)
 
-    print("Training head layers")
-    freeze = True
     t0 = time.time()
     launch(
         main,
@@ -170,39 +176,10 @@ if __name__ == "__main__":
         num_machines=args.num_machines,
         machine_rank=args.machine_rank,
         dist_url=args.dist_url,
-        args=(
-            args,
-            freeze
-        ),
-    )
-
-    torch.cuda.empty_cache()
-    gc.collect()
-    
-    
-    ######
-    # After finetuning the head layers, train the whole model
-    ######
-    
-    print("Training all layers")
-    freeze = False
-    t0 = time.time()
-    launch(
-        main,
-        args.num_gpus,
-        num_machines=args.num_machines,
-        machine_rank=args.machine_rank,
-        dist_url=args.dist_url,
-        args=(
-            args,
-            freeze
-        ),
+        args=(args,),
     )
 
     torch.cuda.empty_cache()
     gc.collect()
 
-
-    
     print(f"Took {time.time()-t0} seconds")
-    
\ No newline at end of file
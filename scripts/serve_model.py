@@ -0,0 +1,78 @@
+"""Serve a trained model to local clients, batching concurrent requests on the fly.
+
+The model is loaded once, either from the config and checkpoint (AstroPredictor) or from
+an artifact written by export_model.py (ExportedAstroPredictor).  Clients POST single
+tiles in .npy format to /predict, see deepdisc.inference.server.predict_remote.
+
+Example:
+    $ python serve_model.py --cfgfile configs/solo/solo_swin_DC2.py --port 8470
+    $ python serve_model.py --exported swin_dc2.ts --unix-socket /tmp/deepdisc.sock --max-batch-size 16
+"""
+
+import argparse
+
+from deepdisc.inference.quantization import QUANTIZE_MODES
+from deepdisc.inference.server import InferenceServer
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    model = parser.add_mutually_exclusive_group(required=True)
+    model.add_argument("--cfgfile", type=str, help="the model config")
+    model.add_argument("--exported", type=str, help="a TorchScript file from export_model.py")
+    parser.add_argument("--checkpoint", type=str, default=None, help="default: the config's train.init_checkpoint")
+    parser.add_argument(
+        "--inference-checkpoint", type=str, default=None, help="a file from export_inference_checkpoint.py"
+    )
+    parser.add_argument("--device", type=str, default=None, help="default: the config's (or export's) device")
+    parser.add_argument("--quantize", choices=QUANTIZE_MODES, default=None, help="dynamic int8 quantization (CPU)")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="the address to listen on")
+    parser.add_argument("--port", type=int, default=8470, help="the TCP port")
+    parser.add_argument("--unix-socket", type=str, default=None, help="listen on a Unix socket instead of TCP")
+    parser.add_argument("--max-batch-size", type=int, default=8, help="the largest batch of tiles")
+    parser.add_argument("--max-latency-ms", type=float, default=20.0, help="how long a request waits for a batch")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    return parser
+
+
+def load_predictor(args):
+    if args.exported is not None:
+        from deepdisc.inference.export import ExportedAstroPredictor
+
+        return ExportedAstroPredictor(args.exported, device=args.device)
+
+    from detectron2.config import LazyConfig
+
+    from deepdisc.astrodet.astrodet import AstroPredictor
+
+    cfg = LazyConfig.load(args.cfgfile)
+    for key in cfg.get("MISC", dict()).keys():
+        cfg[key] = cfg.MISC[key]
+    if args.device is not None:
+        cfg.train.device = args.device
+    if args.checkpoint is not None:
+        cfg.train.init_checkpoint = args.checkpoint
+    return AstroPredictor(cfg, quantize=args.quantize, inference_checkpoint=args.inference_checkpoint)
+
+
+def main(args):
+    server = InferenceServer(
+        load_predictor(args),
+        host=args.host,
+        port=args.port,
+        unix_socket=args.unix_socket,
+        max_batch_size=args.max_batch_size,
+        max_latency_ms=args.max_latency_ms,
+        verbose=args.verbose,
+    )
+    print(f"Serving on {server.address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main(make_parser().parse_args())
@@ -32,12 +32,13 @@ import io
 import itertools
 import json
 import logging
+import multiprocessing
 import os
 import pickle
 import random
 import shutil
 import weakref
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 from typing import Optional
 
 import cv2
@@ -47,7 +48,6 @@ import detectron2.utils.comm as comm
 #import imgaug.augmenters.flip as flip
 
 # from google.colab.patches import cv2_imshow
-import matplotlib.pyplot as plt
 
 # import some common libraries
 import numpy as np
@@ -71,7 +71,7 @@ from detectron2.engine.hooks import LRScheduler
 from detectron2.evaluation import DatasetEvaluator, inference_on_dataset, print_csv_format, verify_results
 
 # yufeng 6/11 import cocoevaluator
-from detectron2.evaluation.coco_evaluation import COCOEvaluator
+from detectron2.evaluation.coco_evaluation import COCOEvaluator, instances_to_coco_json
 from detectron2.evaluation.fast_eval_api import COCOeval_opt
 from detectron2.modeling import build_model
 from detectron2.solver import build_lr_scheduler, build_optimizer
@@ -88,7 +88,6 @@ from detectron2.utils.events import (
 )
 from detectron2.utils.file_io import PathManager
 from detectron2.utils.logger import create_small_table, log_every_n_seconds, setup_logger
-from detectron2.utils.visualizer import Visualizer
 from fvcore.common.param_scheduler import ParamScheduler
 from fvcore.nn.precise_bn import get_bn_modules
 from iopath.common.file_io import file_lock
@@ -100,9 +99,15 @@ from tabulate import tabulate
 from torch.nn.parallel import DistributedDataParallel
 
 from DeepDiscVR.src.deepdisc.astrodet import detectron as detectron_addons
+from deepdisc.data_format import coco_cache
+from deepdisc.inference.checkpoint import build_inference_model, load_inference_weights
+from deepdisc.inference.early_exit import set_cascade_depth
+from deepdisc.inference.masks import MASK_FORMATS, mask_rles, model_inference
+from deepdisc.inference.quantization import quantize_model
 
 def set_mpl_style():
     """Function to set MPL style"""
+    import matplotlib.pyplot as plt
 
     fsize = 15
     tsize = 18
@@ -111,6 +116,7 @@ def set_mpl_style():
     minor = 3.0
     lwidth = 1.8
     lhandle = 2.0
+
     plt.style.use("default")
     plt.rcParams["text.usetex"] = False
     plt.rcParams["font.size"] = fsize
@@ -256,10 +262,42 @@ class AstroPredictor:
         inputs = cv2.imread("input.jpg")
         outputs = pred(inputs)
     """
-    def __init__(self, cfg, lazy=False, cfglazy=None, checkpoint=None):
+    def __init__(
+        self,
+        cfg,
+        lazy=False,
+        cfglazy=None,
+        checkpoint=None,
+        quantize=None,
+        cascade_stages=None,
+        masks=True,
+        mask_format="full",
+        inference_checkpoint=None,
+    ):
+        """
+        Args:
+            quantize (str): None, or "heads"/"all" to apply dynamic int8 quantization to the
+                Linear layers of the heads (and backbone) for CPU inference, see
+                deepdisc.inference.quantization
+            cascade_stages (int): run only the first cascade_stages stages of a cascade head,
+                None for all of them, see deepdisc.inference.early_exit
+            masks (bool): predict masks, if the model has a mask head
+            mask_format (str): "full" for (N, H, W) masks, or "roi"/"rle" to keep them compact,
+                see deepdisc.inference.masks
+            inference_checkpoint (str): a weights-only checkpoint from save_inference_checkpoint
+                to memory-map instead of loading cfg.train.init_checkpoint, see
+                deepdisc.inference.checkpoint
+        """
         self.cfg = copy.deepcopy(cfg) # cfg can be modified by model
         
-        if "model" in self.cfg: # This is when were using a LazyConfig-style model in the solo config
+        if "model" in self.cfg and inference_checkpoint is not None:
+            # built on the meta device and assigned the memory-mapped weights
+            self.model = build_inference_model(
+                lambda: instantiate(self.cfg.model), inference_checkpoint, device=self.cfg.train.device
+            )
+            self.model = create_ddp_model(self.model)
+
+        elif "model" in self.cfg: # This is when were using a LazyConfig-style model in the solo config
             self.model = instantiate(self.cfg.model)
             self.model.to(self.cfg.train.device)
             self.model = create_ddp_model(self.model)
@@ -275,10 +313,19 @@ class AstroPredictor:
 
         # If we provide AstroPredictor with a checkpoint already loaded in memory
         # just simply load the weights into the model.
-        if checkpoint:
+        if inference_checkpoint is not None:
+            if "model" not in self.cfg:
+                load_inference_weights(self.model, inference_checkpoint)
+        elif checkpoint:
             checkpointer._load_model(checkpoint)
         else:
             checkpointer.load(cfg.train.init_checkpoint)
+
+        if cascade_stages is not None or not masks:
+            set_cascade_depth(self.model, cascade_stages, mask=masks)
+
+        if quantize is not None:
+            self.model = quantize_model(self.model, quantize)
         
         self.aug = T.ResizeShortestEdge(
             [cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST
@@ -286,6 +333,8 @@ class AstroPredictor:
 
         self.input_format = cfg.INPUT.FORMAT
         assert self.input_format in ["RGB", "BGR"], self.input_format
+        assert mask_format in MASK_FORMATS, mask_format
+        self.mask_format = mask_format
       
     def __call__(self, original_image):
         """
@@ -306,20 +355,47 @@ class AstroPredictor:
             image = torch.as_tensor(original_image.astype("float32").transpose(2, 0, 1))
 
             inputs = {"image": image, "height": height, "width": width}
-            predictions = self.model([inputs])[0]
+            predictions = model_inference(self.model, [inputs], self.mask_format)[0]
             return predictions
 
+    def predict_batch(self, original_images):
+        """
+        Args:
+            original_images (list[np.ndarray]): images of shape (H, W, C) (in BGR order),
+                which may have different sizes.
+        Returns:
+            predictions (list[dict]):
+                the output of the model for each image, from a single batched forward pass.
+        """
+        with torch.no_grad():
+            batched_inputs = []
+            for original_image in original_images:
+                if self.input_format == "RGB":
+                    original_image = original_image[:, :, ::-1]
+                height, width = original_image.shape[:2]
+                image = torch.as_tensor(original_image.astype("float32").transpose(2, 0, 1))
+                batched_inputs.append({"image": image, "height": height, "width": width})
+            return model_inference(self.model, batched_inputs, self.mask_format)
+
+
+# The COCOeval_opt_custom instance evaluated by the forked worker processes of evaluate_custom
+_PARALLEL_COCO_EVAL = None
+
+
+def _evaluate_img_shard(img_ids):
+    return _PARALLEL_COCO_EVAL._evaluate_imgs(img_ids, store_ious=False)
+
 
 class COCOeval_opt_custom(COCOeval_opt):
-    """ """
+    """COCOeval with custom area ranges, which can evaluate images in parallel or incrementally
 
-    def evaluate_custom(self):
-        """
-        Run per image evaluation on given images and store results (a list of dict) in self.evalImgs
-        :return: None
-        """
-        tic = time.time()
-        print("Running per image evaluation...")
+    evaluate_custom(num_workers) evaluates all images at once, optionally split over
+    forked worker processes.  Alternatively, start_incremental(), add_image_results()
+    for each image as its predictions become available, and finish_incremental()
+    produce the same evalImgs without holding every prediction in memory.
+    """
+
+    def _setup_params(self):
         p = self.params
         # add backward compatibility if useSegm is specified in params
         if not p.useSegm is None:
@@ -330,29 +406,238 @@ class COCOeval_opt_custom(COCOeval_opt):
         if p.useCats:
             p.catIds = list(np.unique(p.catIds))
         p.maxDets = sorted(p.maxDets)
+        self._setup_mag_bins(p)
         self.params = p
-        print(p.areaRng)
-        self._prepare()
-        # loop through images, area range, max detection number
+        return p
+
+    def _setup_mag_bins(self, p):
+        """Fold the magnitude bins in p.magRng into the area range dimension
+
+        p.areaRng becomes [area ranges for all magnitudes] + [area ranges for magnitude bin 0] + ...,
+        so accumulate_custom works unchanged, the first block (and the standard summary)
+        covers all objects, and the IoUs of an image are computed once for every bin.
+        """
+        self._magRng = [None] * len(p.areaRng)
+        if getattr(p, "magRng", None) is None:
+            return
+        if not hasattr(p, "areaRngBase"):
+            p.areaRngBase = [list(a) for a in p.areaRng]
+            p.areaRngLblBase = list(p.areaRngLbl)
+        mags = [None] + [list(m) for m in p.magRng]
+        p.areaRng = [a for _ in mags for a in p.areaRngBase]
+        p.areaRngLbl = [
+            lbl if m == 0 else f"{lbl}-mag{m - 1}" for m in range(len(mags)) for lbl in p.areaRngLblBase
+        ]
+        self._magRng = [m for m in mags for _ in p.areaRngBase]
+
+    def evaluateImg(self, imgId, catId, aRng, maxDet, mRng=None):
+        """COCOeval.evaluateImg, where ground truths with an "imag" outside mRng = (lo, hi] are also ignored
+
+        As for objects outside the area range, unmatched detections are still counted.
+        """
+        if mRng is None:
+            return super().evaluateImg(imgId, catId, aRng, maxDet)
+        p = self.params
+        if p.useCats:
+            gts = self._gts[imgId, catId]
+        else:
+            gts = [g for cId in p.catIds for g in self._gts[imgId, cId]]
+        ignore = [g["ignore"] for g in gts]
+        for g in gts:
+            imag = g.get("imag")
+            g["ignore"] = g["ignore"] or imag is None or not (mRng[0] < imag <= mRng[1])
+        try:
+            return super().evaluateImg(imgId, catId, aRng, maxDet)
+        finally:
+            for g, ig in zip(gts, ignore):
+                g["ignore"] = ig
+
+    def _evaluate_imgs(self, img_ids, store_ious=True):
+        """Compute the IoUs and evalImgs entries of the given images
+
+        The entries are ordered by category, then area range, then image, as in
+        the evalImgs list of COCOeval.evaluate.
+        """
+        p = self.params
         catIds = p.catIds if p.useCats else [-1]
 
         if p.iouType == "segm" or p.iouType == "bbox":
             computeIoU = self.computeIoU
         elif p.iouType == "keypoints":
             computeIoU = self.computeOks
-        self.ious = {(imgId, catId): computeIoU(imgId, catId) for imgId in p.imgIds for catId in catIds}
+        ious = {(imgId, catId): computeIoU(imgId, catId) for imgId in img_ids for catId in catIds}
+        if store_ious:
+            self.ious.update(ious)
+        else:
+            self.ious = ious
         evaluateImg = self.evaluateImg
         maxDet = p.maxDets[-1]
-        self.evalImgs = [
-            evaluateImg(imgId, catId, areaRng, maxDet)
+        return [
+            evaluateImg(imgId, catId, areaRng, maxDet, magRng)
             for catId in catIds
-            for areaRng in p.areaRng
-            for imgId in p.imgIds
+            for areaRng, magRng in zip(p.areaRng, self._magRng)
+            for imgId in img_ids
         ]
+
+    def _evaluate_parallel(self, num_workers):
+        """Evaluate contiguous shards of the images in forked processes and merge the evalImgs"""
+        global _PARALLEL_COCO_EVAL
+
+        p = self.params
+        shards = [list(ids) for ids in np.array_split(np.array(p.imgIds), num_workers) if len(ids) > 0]
+        _PARALLEL_COCO_EVAL = self
+        try:
+            with multiprocessing.get_context("fork").Pool(len(shards)) as pool:
+                shard_evalImgs = pool.map(_evaluate_img_shard, shards)
+        finally:
+            _PARALLEL_COCO_EVAL = None
+
+        # Each shard is ordered (category, area range, image); interleave them so the
+        # images of every (category, area range) block are in p.imgIds order again
+        num_blocks = len(p.catIds if p.useCats else [-1]) * len(p.areaRng)
+        evalImgs = []
+        for b in range(num_blocks):
+            for shard, evals in zip(shards, shard_evalImgs):
+                evalImgs.extend(evals[b * len(shard) : (b + 1) * len(shard)])
+        # The IoU matrices stay in the workers
+        self.ious = {}
+        return evalImgs
+
+    def evaluate_custom(self, num_workers=0):
+        """
+        Run per image evaluation on given images and store results (a list of dict) in self.evalImgs
+
+        Parameters
+        ----------
+        num_workers : int
+            If larger than 1, split the images over this many forked processes.
+            self.ious is left empty in that case.
+
+        :return: None
+        """
+        tic = time.time()
+        print("Running per image evaluation...")
+        p = self._setup_params()
+        print(p.areaRng)
+        self._prepare()
+        # loop through images, area range, max detection number
+        if num_workers > 1 and len(p.imgIds) > 1 and "fork" in multiprocessing.get_all_start_methods():
+            self.evalImgs = self._evaluate_parallel(num_workers)
+        else:
+            self.ious = {}
+            self.evalImgs = self._evaluate_imgs(p.imgIds)
         self._paramsEval = copy.deepcopy(self.params)
         toc = time.time()
         print("DONE (t={:0.2f}s).".format(toc - tic))
 
+    def start_incremental(self):
+        """Start evaluating images one at a time with add_image_results()
+
+        self.params (imgIds, catIds, areaRng, maxDets, iouType) must be set beforehand.
+        The COCOeval can be created without detections, i.e. COCOeval_opt_custom(coco_gt, None, iou_type).
+        """
+        self._setup_params()
+        self._incremental_evalImgs = {}
+        self._next_dt_id = 0
+        self.ious = {}
+
+    def _load_image_results(self, results):
+        """Give one image's results the fields COCO.loadRes would add"""
+        p = self.params
+        dts = []
+        for result in results:
+            dt = dict(result)
+            if p.iouType == "segm":
+                # use the mask area, not the box area, for the area ranges (as in _evaluate_predictions_on_coco)
+                dt.pop("bbox", None)
+            self._next_dt_id += 1
+            dt["id"] = self._next_dt_id
+            if "bbox" in dt and not dt["bbox"] == []:
+                bb = dt["bbox"]
+                x1, x2, y1, y2 = [bb[0], bb[0] + bb[2], bb[1], bb[1] + bb[3]]
+                if not "segmentation" in dt:
+                    dt["segmentation"] = [[x1, y1, x1, y2, x2, y2, x2, y1]]
+                dt["area"] = bb[2] * bb[3]
+                dt["iscrowd"] = 0
+            elif "segmentation" in dt:
+                dt["area"] = mask_util.area(dt["segmentation"])
+                if not "bbox" in dt:
+                    dt["bbox"] = mask_util.toBbox(dt["segmentation"])
+                dt["iscrowd"] = 0
+            elif "keypoints" in dt:
+                s = dt["keypoints"]
+                x = s[0::3]
+                y = s[1::3]
+                x0, x1, y0, y1 = np.min(x), np.max(x), np.min(y), np.max(y)
+                dt["area"] = (x1 - x0) * (y1 - y0)
+                dt["bbox"] = [x0, y0, x1 - x0, y1 - y0]
+            dts.append(dt)
+        return dts
+
+    def _prepare_image(self, img_id, results):
+        """Same as COCOeval._prepare, for a single image and its results"""
+        p = self.params
+        if p.useCats:
+            gts = self.cocoGt.loadAnns(self.cocoGt.getAnnIds(imgIds=[img_id], catIds=p.catIds))
+        else:
+            gts = self.cocoGt.loadAnns(self.cocoGt.getAnnIds(imgIds=[img_id]))
+        # copy, so converting the segmentations below does not change cocoGt
+        gts = [dict(gt) for gt in gts]
+        dts = self._load_image_results(results)
+        if p.useCats:
+            dts = [dt for dt in dts if dt["category_id"] in p.catIds]
+
+        if p.iouType == "segm":
+            for ann in gts + dts:
+                ann["segmentation"] = self.cocoGt.annToRLE(ann)
+        for gt in gts:
+            gt["ignore"] = gt["ignore"] if "ignore" in gt else 0
+            gt["ignore"] = "iscrowd" in gt and gt["iscrowd"]
+            if p.iouType == "keypoints":
+                gt["ignore"] = (gt["num_keypoints"] == 0) or gt["ignore"]
+
+        self._gts = defaultdict(list)
+        self._dts = defaultdict(list)
+        for gt in gts:
+            self._gts[gt["image_id"], gt["category_id"]].append(gt)
+        for dt in dts:
+            self._dts[dt["image_id"], dt["category_id"]].append(dt)
+
+    def add_image_results(self, img_id, results):
+        """Evaluate one image, given all of its results in COCO result format
+
+        Only the evalImgs entries are kept, so memory does not grow with the
+        number of detections already evaluated.
+        """
+        self._prepare_image(img_id, results)
+        self._incremental_evalImgs[img_id] = self._evaluate_imgs([img_id], store_ious=False)
+        self.ious = {}
+
+    def evaluated_images(self):
+        """The per-image evalImgs entries computed so far by add_image_results, {img_id: entries}"""
+        return self._incremental_evalImgs
+
+    def add_evaluated_images(self, evaluated_images):
+        """Add per-image entries from evaluated_images() of another COCOeval with the same params
+
+        Used to merge the images evaluated on several ranks before finish_incremental().
+        """
+        self._incremental_evalImgs.update(evaluated_images)
+
+    def finish_incremental(self):
+        """Assemble self.evalImgs from the evaluated images, ready for accumulate_custom
+
+        Images in params.imgIds that received no results are evaluated without detections.
+        """
+        p = self.params
+        for img_id in p.imgIds:
+            if img_id not in self._incremental_evalImgs:
+                self.add_image_results(img_id, [])
+        num_blocks = len(p.catIds if p.useCats else [-1]) * len(p.areaRng)
+        self.evalImgs = [self._incremental_evalImgs[img_id][b] for b in range(num_blocks) for img_id in p.imgIds]
+        self._incremental_evalImgs = {}
+        self._paramsEval = copy.deepcopy(self.params)
+
     def accumulate_custom(self, p=None):
         """
         YL: Override in order to put in some output commands
@@ -423,8 +708,8 @@ class COCOeval_opt_custom(COCOeval_opt):
                     tps = np.logical_and(dtm, np.logical_not(dtIg))
                     fps = np.logical_and(np.logical_not(dtm), np.logical_not(dtIg))
                     # print('tps cumsum', np.cumsum(tps))
-                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float)
-                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float)
+                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=float)
+                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=float)
                     # print('TP and FP sums', tp_sum.shape, fp_sum.shape)
                     for t, (tp, fp) in enumerate(zip(tp_sum, fp_sum)):
                         tp = np.array(tp)
@@ -548,6 +833,43 @@ class COCOeval_opt_custom(COCOeval_opt):
             summarize = _summarizeKps
         self.stats = summarize()
 
+    def summarize_mag_bins(self):
+        """Compute the metrics of every magnitude bin and area range from the accumulated results
+
+        Returns
+        -------
+        rows : list[dict]
+            One row per (magnitude bin, area range), the first rows being for all magnitudes,
+            with AP, AP50, AP75 and AR in percent (nan if not computable)
+        """
+        p = self.params
+        precision = self.eval["precision"]
+        recall = self.eval["recall"]
+        areaRng = getattr(p, "areaRngBase", p.areaRng)
+        areaLbl = getattr(p, "areaRngLblBase", p.areaRngLbl)
+        mags = [None] + list(getattr(p, "magRng", None) or [])
+
+        def _mean(s):
+            s = s[s > -1]
+            return float(np.mean(s) * 100) if s.size else float("nan")
+
+        rows = []
+        for m, mRng in enumerate(mags):
+            for a, lbl in enumerate(areaLbl[: len(areaRng)]):
+                idx = m * len(areaRng) + a
+                rows.append(
+                    {
+                        "mag": "all" if mRng is None else f"({mRng[0]}, {mRng[1]}]",
+                        "area": lbl,
+                        "AP": _mean(precision[:, :, :, idx, -1]),
+                        "AP50": _mean(precision[np.isclose(p.iouThrs, 0.5)][:, :, :, idx, -1]),
+                        "AP75": _mean(precision[np.isclose(p.iouThrs, 0.75)][:, :, :, idx, -1]),
+                        "AR": _mean(recall[:, :, idx, -1]),
+                    }
+                )
+        print(tabulate(rows, headers="keys", tablefmt="pipe", floatfmt=".3f"))
+        return rows
+
 
 def _evaluate_predictions_on_coco(
     coco_gt,
@@ -558,6 +880,8 @@ def _evaluate_predictions_on_coco(
     img_ids=None,
     max_dets_per_image=None,
     areaRng=None,
+    num_workers=0,
+    magRng=None,
 ):
     # Evaluate the coco results using COCOEval API.
     assert len(coco_results) > 0
@@ -601,15 +925,20 @@ def _evaluate_predictions_on_coco(
         max_dets_per_image  # by default it is [1,10,100], our datasets have more than 100 instances
     )
     coco_eval.params.areaRng = areaRng
-    coco_eval.evaluate_custom()
+    if magRng is not None:
+        # magnitude bins are evaluated from the same matching, see COCOeval_opt_custom._setup_mag_bins
+        coco_eval.params.magRng = magRng
+    coco_eval.evaluate_custom(num_workers=num_workers)
     coco_eval.accumulate_custom()
     coco_eval.summarize_custom()
+    if magRng is not None:
+        coco_eval.mag_bin_results = coco_eval.summarize_mag_bins()
     # coco_eval.summarize()
 
     return coco_eval
 
 
-def convert_to_coco_dict(dataset_name, mbins, mind, logger):
+def convert_to_coco_dict(dataset_name, mbins, mind, logger, rle_masks=False, dataset_dicts=None):
     """
     Convert an instance detection/segmentation or keypoint detection dataset
     in detectron2's standard format into COCO json format.
@@ -625,10 +954,17 @@ def convert_to_coco_dict(dataset_name, mbins, mind, logger):
             name of the source dataset
             Must be registered in DatastCatalog and in detectron2's standard format.
             Must have corresponding metadata "thing_classes"
+        rle_masks (bool):
+            store the segmentations as compressed RLE instead of polygons, so
+            evaluations reading the json do not rasterise the polygons again.
+            Areas are still computed from the polygons.
+        dataset_dicts (list[dict]):
+            the dataset dicts of dataset_name, if they are already loaded
     Returns:
         coco_dict: serializable dict in COCO json format
     """
-    dataset_dicts = DatasetCatalog.get(dataset_name)
+    if dataset_dicts is None:
+        dataset_dicts = DatasetCatalog.get(dataset_name)
     metadata = MetadataCatalog.get(dataset_name)
 
     # unmap the category mapping ids for COCO
@@ -728,6 +1064,9 @@ def convert_to_coco_dict(dataset_name, mbins, mind, logger):
                 coco_annotation["ignore"] = int(annotation.get("ignore", 0))
 
             coco_annotation["category_id"] = int(reverse_id_mapper(annotation["category_id"]))
+            if annotation.get("imag") is not None:
+                # used to split the evaluation by magnitude, see COCOEvaluatorRecall(magRng=...)
+                coco_annotation["imag"] = float(annotation["imag"])
 
             # Add optional fields
             if "keypoints" in annotation:
@@ -736,6 +1075,10 @@ def convert_to_coco_dict(dataset_name, mbins, mind, logger):
 
             if "segmentation" in annotation:
                 seg = coco_annotation["segmentation"] = annotation["segmentation"]
+                if rle_masks:
+                    seg = coco_annotation["segmentation"] = coco_cache.segmentation_to_rle(
+                        seg, coco_image["height"], coco_image["width"]
+                    )
                 if isinstance(seg, dict):  # RLE
                     counts = seg["counts"]
                     if not isinstance(counts, str):
@@ -761,7 +1104,7 @@ def convert_to_coco_dict(dataset_name, mbins, mind, logger):
     return coco_dict
 
 
-def convert_to_coco_json(dataset_name, output_file, mbins=[0, 1], mind=-1, allow_cached=True):
+def convert_to_coco_json(dataset_name, output_file, mbins=[0, 1], mind=-1, allow_cached=True, rle_masks=False):
     """
     Converts dataset into COCO format and saves it to a json file.
     dataset_name must be registered in DatasetCatalog and in detectron2's standard format.
@@ -772,6 +1115,7 @@ def convert_to_coco_json(dataset_name, output_file, mbins=[0, 1], mind=-1, allow
             must be registered in DatasetCatalog and in detectron2's standard format
         output_file: path of json file that will be saved to
         allow_cached: if json file is already present then skip conversion
+        rle_masks: store the ground truth masks as compressed RLE
     """
 
     logger = logging.getLogger(__name__)
@@ -784,7 +1128,7 @@ def convert_to_coco_json(dataset_name, output_file, mbins=[0, 1], mind=-1, allow
             )
         else:
             logger.info(f"Converting annotations of dataset '{dataset_name}' to COCO format ...)")
-            coco_dict = convert_to_coco_dict(dataset_name, mbins, mind, logger)
+            coco_dict = convert_to_coco_dict(dataset_name, mbins, mind, logger, rle_masks=rle_masks)
 
             logger.info(f"Caching COCO format annotations at '{output_file}' ...")
             tmp_file = output_file + ".tmp"
@@ -793,6 +1137,52 @@ def convert_to_coco_json(dataset_name, output_file, mbins=[0, 1], mind=-1, allow
             shutil.move(tmp_file, output_file)
 
 
+def load_coco_gt_cache(dataset_name, cache_dir, allow_cached=True):
+    """
+    Loads the ground truth of a dataset as a pycocotools COCO object from a binary cache.
+    The cache is built with convert_to_coco_dict (masks as compressed RLE) the first time.
+    It is keyed by the path, size and modification time of the file the dataset was
+    registered from (metadata "dataset_file", set by register_data_set) and the category
+    metadata, so it is rebuilt when the dataset changes without loading the dataset to
+    check.  Datasets registered without a file are keyed by a hash of their dataset dicts.
+
+    Args:
+        dataset_name: must be registered in DatasetCatalog and in detectron2's standard format
+        cache_dir: directory for the cache file
+        allow_cached: if False, rebuild the cache even if it exists
+
+    Returns:
+        COCO: the indexed ground truth
+    """
+    logger = logging.getLogger(__name__)
+    metadata = MetadataCatalog.get(dataset_name)
+    category_metadata = (
+        metadata.get("thing_classes", None),
+        metadata.get("thing_dataset_id_to_contiguous_id", None),
+    )
+    dataset_file = metadata.get("dataset_file", None)
+    if dataset_file is not None and os.path.exists(dataset_file):
+        key = coco_cache.file_key(dataset_file, *category_metadata)
+    else:
+        key = coco_cache.content_hash(DatasetCatalog.get(dataset_name), *category_metadata)
+    cache_file = coco_cache.cache_filename(cache_dir, dataset_name, key)
+
+    def build():
+        dataset_dicts = DatasetCatalog.get(dataset_name)
+        if any("keypoints" in ann for d in dataset_dicts for ann in d.get("annotations", [])):
+            raise ValueError("Keypoint annotations are not supported by the ground truth cache.")
+        logger.info(f"Converting annotations of dataset '{dataset_name}' to COCO format ...)")
+        return convert_to_coco_dict(
+            dataset_name, [0, 1], -1, logger, rle_masks=True, dataset_dicts=dataset_dicts
+        )
+
+    PathManager.mkdirs(cache_dir)
+    with file_lock(cache_file):
+        cache = coco_cache.load_or_build(cache_dir, dataset_name, key, build, allow_cached=allow_cached)
+    logger.info(f"Loaded COCO format ground truth from '{cache_file}'")
+    return cache.to_coco()
+
+
 class COCOEvaluatorRecall(COCOEvaluator):
 
     """
@@ -821,6 +1211,10 @@ class COCOEvaluatorRecall(COCOEvaluator):
         use_fast_impl=True,
         kpt_oks_sigmas=(),
         allow_cached_coco=True,
+        num_eval_workers=0,
+        magRng=None,
+        rle_gt_masks=True,
+        gt_cache=True,
     ):
         """
         Args:
@@ -856,9 +1250,24 @@ class COCOEvaluatorRecall(COCOEvaluator):
             allow_cached_coco (bool): Whether to use cached coco json from previous validation
                 runs. You should set this to False if you need to use different validation data.
                 Defaults to True.
+            num_eval_workers (int): number of processes to split the per-image evaluation over.
+                0 or 1 evaluates in the main process.
+            magRng (list[list[float]]): optional i-band magnitude bins [lo, hi] (lo < imag <= hi).
+                All bins are evaluated in one pass from the same matching, using the "imag"
+                of each ground truth annotation. The standard metrics still cover all objects,
+                and the per-bin metrics are returned under "results_per_mag_bin".
+            rle_gt_masks (bool): when converting the dataset to COCO format, store the ground
+                truth masks as compressed RLE, so that repeated segm evaluations using the cached
+                json skip polygon rasterisation. Predicted masks are already RLE-encoded in process().
+            gt_cache (bool): for datasets not in COCO format, keep the ground truth in a binary,
+                pre-indexed cache (see deepdisc.data_format.coco_cache) instead of a json file.
+                The cache is invalidated by a hash of the dataset content, and always stores
+                RLE masks. Datasets with keypoints fall back to the json file.
         """
 
         self._logger = logging.getLogger(__name__)
+        self._num_eval_workers = num_eval_workers
+        self._magRng = magRng
         self._distributed = distributed
         self._output_dir = output_dir
 
@@ -900,20 +1309,32 @@ class COCOEvaluatorRecall(COCOEvaluator):
         self._cpu_device = torch.device("cpu")
 
         self._metadata = MetadataCatalog.get(dataset_name)
+        self._coco_api = None
         if not hasattr(self._metadata, "json_file"):
             if output_dir is None:
                 raise ValueError(
                     "output_dir must be provided to COCOEvaluator " "for datasets not in COCO format."
                 )
-            self._logger.info(f"Trying to convert '{dataset_name}' to COCO format ...")
-
-            cache_path = os.path.join(output_dir, f"{dataset_name}_coco_format.json")
-            self._metadata.json_file = cache_path
-            convert_to_coco_json(dataset_name, cache_path, allow_cached=allow_cached_coco)
-        json_file = PathManager.get_local_path(self._metadata.json_file)
-        print("Loading ", json_file)
-        with contextlib.redirect_stdout(io.StringIO()):
-            self._coco_api = COCO(json_file)
+            if gt_cache:
+                try:
+                    self._coco_api = load_coco_gt_cache(dataset_name, output_dir, allow_cached=allow_cached_coco)
+                except ValueError as e:
+                    self._logger.warning(f"Not using the binary ground truth cache: {e}")
+
+            if self._coco_api is None:
+                self._logger.info(f"Trying to convert '{dataset_name}' to COCO format ...")
+
+                suffix = "_rle" if rle_gt_masks else ""
+                cache_path = os.path.join(output_dir, f"{dataset_name}_coco_format{suffix}.json")
+                self._metadata.json_file = cache_path
+                convert_to_coco_json(
+                    dataset_name, cache_path, allow_cached=allow_cached_coco, rle_masks=rle_gt_masks
+                )
+        if self._coco_api is None:
+            json_file = PathManager.get_local_path(self._metadata.json_file)
+            print("Loading ", json_file)
+            with contextlib.redirect_stdout(io.StringIO()):
+                self._coco_api = COCO(json_file)
 
         # Test set json files do not contain annotations (evaluation must be
         # performed using the COCO evaluation server).
@@ -921,15 +1342,30 @@ class COCOEvaluatorRecall(COCOEvaluator):
         if self._do_evaluation:
             self._kpt_oks_sigmas = kpt_oks_sigmas
 
-    def _eval_predictions(self, predictions, img_ids=None):
-        # Evaluate predictions. Fill self._results with the metrics of the tasks.
-
-        self._logger.info("Preparing results for COCO format ...")
-        # for splitting by magnitude, take the instances that are matched to objects with that mag thresh
-        coco_results = list(itertools.chain(*[x["instances"] for x in predictions]))
-        tasks = self._tasks or self._tasks_from_predictions(coco_results)
-
-        # unmap the category ids for COCO
+    def process(self, inputs, outputs):
+        """
+        As COCOEvaluator.process, but masks in a compact format (deepdisc.inference.masks)
+        are encoded a chunk at a time, without pasting all of them at full resolution.
+        """
+        for input, output in zip(inputs, outputs):
+            prediction = {"image_id": input["image_id"]}
+            if "instances" in output:
+                instances = output["instances"].to(self._cpu_device)
+                rles = None
+                if instances.has("pred_masks") and not torch.is_tensor(instances.pred_masks):
+                    rles = mask_rles(instances)
+                    instances.remove("pred_masks")
+                prediction["instances"] = instances_to_coco_json(instances, input["image_id"])
+                if rles is not None:
+                    for result, rle in zip(prediction["instances"], rles):
+                        result["segmentation"] = rle
+            if "proposals" in output:
+                prediction["proposals"] = output["proposals"].to(self._cpu_device)
+            if len(prediction) > 1:
+                self._predictions.append(prediction)
+
+    def _unmap_category_ids(self, coco_results):
+        # unmap the category ids for COCO, in place
         if hasattr(self._metadata, "thing_dataset_id_to_contiguous_id"):
             dataset_id_to_contiguous_id = self._metadata.thing_dataset_id_to_contiguous_id
             all_contiguous_ids = list(dataset_id_to_contiguous_id.values())
@@ -946,6 +1382,15 @@ class COCOEvaluatorRecall(COCOEvaluator):
                 )
                 result["category_id"] = reverse_id_mapping[category_id]
 
+    def _eval_predictions(self, predictions, img_ids=None):
+        # Evaluate predictions. Fill self._results with the metrics of the tasks.
+
+        self._logger.info("Preparing results for COCO format ...")
+        # for splitting by magnitude, take the instances that are matched to objects with that mag thresh
+        coco_results = list(itertools.chain(*[x["instances"] for x in predictions]))
+        tasks = self._tasks or self._tasks_from_predictions(coco_results)
+        self._unmap_category_ids(coco_results)
+
         if self._output_dir:
             file_path = os.path.join(self._output_dir, "coco_instances_results.json")
             self._logger.info("Saving results to {}".format(file_path))
@@ -978,6 +1423,8 @@ class COCOEvaluatorRecall(COCOEvaluator):
                     img_ids=img_ids,
                     max_dets_per_image=self._max_dets_per_image,
                     areaRng=self._areaRng,
+                    num_workers=self._num_eval_workers,
+                    magRng=self._magRng,
                 )
                 if len(coco_results) > 0
                 else None  # cocoapi does not handle empty results very well
@@ -1056,9 +1503,177 @@ class COCOEvaluatorRecall(COCOEvaluator):
         results["results_per_category"] = precision_per_category
 
         results.update({"AP-" + name: ap for name, ap in results_per_category})
+
+        mag_bin_results = getattr(coco_eval, "mag_bin_results", None)
+        if mag_bin_results is not None:
+            self._logger.info(
+                "Per-magnitude {} results: \n".format(iou_type)
+                + tabulate(mag_bin_results, headers="keys", tablefmt="pipe", floatfmt=".3f")
+            )
+            results["results_per_mag_bin"] = mag_bin_results
+            results.update(
+                {f"AP-mag{row['mag']}": row["AP"] for row in mag_bin_results if row["area"] == "all" and row["mag"] != "all"}
+            )
         return results
 
 
+class StreamingCOCOEvaluatorRecall(COCOEvaluatorRecall):
+    """
+    A COCOEvaluatorRecall that evaluates every image as soon as its predictions arrive,
+    instead of holding the predictions of the whole test set in memory until evaluate().
+
+    The predictions of each batch are converted to COCO result records and matched to the
+    ground truth with COCOeval_opt_custom.add_image_results, which only keeps the per-image
+    matching. The records themselves are appended to a per-rank spill file, which is streamed
+    into "coco_instances_results.json" at the end. In distributed runs only the per-image
+    matchings are gathered to the main process, and the spill directory must be shared.
+    """
+
+    def __init__(self, dataset_name, tasks=None, distributed=True, output_dir=None, *, spill_dir=None, **kwargs):
+        """
+        Args:
+            dataset_name, tasks, distributed, output_dir, **kwargs: see COCOEvaluatorRecall
+            spill_dir (str): directory for the per-rank files of result records.
+                Defaults to output_dir. If both are None, the records are not kept.
+        """
+        super().__init__(dataset_name, tasks, distributed, output_dir, **kwargs)
+        self._spill_dir = spill_dir if spill_dir is not None else output_dir
+        self.reset()
+
+    def reset(self):
+        super().reset()
+        self._coco_evals = None
+        self._num_results = 0
+        if self._spill_dir is not None:
+            PathManager.mkdirs(self._spill_dir)
+            spill_file = self._spill_file(comm.get_rank())
+            if os.path.exists(spill_file):
+                os.remove(spill_file)
+
+    def _spill_file(self, rank):
+        return os.path.join(self._spill_dir, f"coco_results_rank{rank}.pkl")
+
+    def _new_coco_eval(self, task):
+        # same settings as _evaluate_predictions_on_coco
+        assert task in {"bbox", "segm", "keypoints"}, f"Got unknown task: {task}!"
+        coco_eval = COCOeval_opt_custom(self._coco_api, None, task)
+        coco_eval.params.maxDets = self._max_dets_per_image
+        coco_eval.params.areaRng = self._areaRng
+        if self._magRng is not None:
+            coco_eval.params.magRng = self._magRng
+        coco_eval.start_incremental()
+        return coco_eval
+
+    def process(self, inputs, outputs):
+        """
+        Args:
+            inputs: the inputs to a COCO model (e.g., GeneralizedRCNN).
+                It is a list of dict. Each dict corresponds to an image and
+                contains keys like "height", "width", "file_name", "image_id".
+            outputs: the outputs of a COCO model. It is a list of dicts with key
+                "instances" that contains :class:`Instances`.
+        """
+        super().process(inputs, outputs)
+        predictions, self._predictions = self._predictions, []
+        records = []
+        for prediction in predictions:
+            coco_results = prediction.pop("instances", None)
+            if "proposals" in prediction:
+                # proposals are evaluated at the end, as in COCOEvaluator
+                self._predictions.append(prediction)
+            if not coco_results:
+                continue
+            self._unmap_category_ids(coco_results)
+            if self._do_evaluation:
+                if self._coco_evals is None:
+                    tasks = self._tasks or self._tasks_from_predictions(coco_results)
+                    self._coco_evals = {task: self._new_coco_eval(task) for task in sorted(tasks)}
+                for coco_eval in self._coco_evals.values():
+                    coco_eval.add_image_results(prediction["image_id"], coco_results)
+            self._num_results += len(coco_results)
+            records.extend(coco_results)
+
+        if self._spill_dir is not None and len(records) > 0:
+            with open(self._spill_file(comm.get_rank()), "ab") as f:
+                pickle.dump(records, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _read_spill_file(self, rank):
+        spill_file = self._spill_file(rank)
+        if not os.path.exists(spill_file):
+            return
+        with open(spill_file, "rb") as f:
+            while True:
+                try:
+                    yield from pickle.load(f)
+                except EOFError:
+                    return
+
+    def _write_results(self, num_ranks):
+        file_path = os.path.join(self._output_dir, "coco_instances_results.json")
+        self._logger.info("Saving results to {}".format(file_path))
+        with PathManager.open(file_path, "w") as f:
+            f.write("[")
+            sep = ""
+            for rank in range(num_ranks):
+                for record in self._read_spill_file(rank):
+                    f.write(sep + json.dumps(record))
+                    sep = ", "
+            f.write("]")
+            f.flush()
+
+    def evaluate(self, img_ids=None):
+        """
+        Args:
+            img_ids: a list of image IDs to evaluate on. Default to None for the whole dataset
+        """
+        evaluated = {task: coco_eval.evaluated_images() for task, coco_eval in (self._coco_evals or {}).items()}
+        proposals = self._predictions
+        num_results = self._num_results
+        num_ranks = 1
+        if self._distributed:
+            comm.synchronize()
+            num_ranks = comm.get_world_size()
+            evaluated = comm.gather(evaluated, dst=0)
+            proposals = list(itertools.chain(*comm.gather(proposals, dst=0)))
+            num_results = sum(comm.gather(num_results, dst=0))
+            if not comm.is_main_process():
+                return {}
+        else:
+            evaluated = [evaluated]
+
+        self._results = OrderedDict()
+        if self._output_dir and self._spill_dir is not None:
+            self._write_results(num_ranks)
+        if len(proposals) > 0:
+            self._eval_box_proposals(proposals)
+
+        if not self._do_evaluation:
+            self._logger.info("Annotations are not available for evaluation.")
+            return copy.deepcopy(self._results)
+
+        tasks = set(itertools.chain(*evaluated)) or set(self._tasks or {"bbox"})
+        self.coco_eval_list = []
+        for task in sorted(tasks):
+            coco_eval = None  # cocoapi does not handle empty results very well
+            if num_results > 0:
+                coco_eval = self._new_coco_eval(task)
+                for rank_evaluated in evaluated:
+                    coco_eval.add_evaluated_images(rank_evaluated.get(task, {}))
+                if img_ids is not None:
+                    coco_eval.params.imgIds = sorted(set(img_ids))
+                # images without predictions on any rank are evaluated as empty here
+                coco_eval.finish_incremental()
+                coco_eval.accumulate_custom()
+                coco_eval.summarize_custom()
+                if self._magRng is not None:
+                    coco_eval.mag_bin_results = coco_eval.summarize_mag_bins()
+            self.coco_eval_list.append(coco_eval)
+            self._results[task] = self._derive_coco_results(
+                coco_eval, task, class_names=self._metadata.get("thing_classes")
+            )
+        return copy.deepcopy(self._results)
+
+
 def read_image_hsc(
     filenames,
     normalize="lupton",
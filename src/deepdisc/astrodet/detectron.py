@@ -1,14 +1,16 @@
+import copy
 import datetime
 import json
 import logging
 import os
+import queue
+import shutil
 import sys
+import threading
 import time
 
-import cv2
 import detectron2
 import numpy as np
-from astropy.io import fits
 from detectron2.utils.logger import setup_logger
 
 setup_logger()
@@ -17,7 +19,6 @@ from typing import Dict, List, Optional, Tuple
 import detectron2.data as data
 import detectron2.data.transforms as T
 
-import matplotlib.pyplot as plt
 import torch
 from detectron2.data import build_detection_train_loader
 from detectron2.data.transforms import Augmentation, Transform
@@ -41,7 +42,6 @@ from detectron2.utils.events import (
 )
 from detectron2.utils.file_io import PathManager
 from detectron2.utils.logger import log_every_n_seconds, setup_logger
-from detectron2.utils.visualizer import Visualizer
 from fvcore.common.param_scheduler import ParamScheduler
 from fvcore.transforms.transform import Transform, TransformList
 from torch import nn
@@ -52,6 +52,8 @@ from torch.distributions.mixture_same_family import MixtureSameFamily
 from torch.distributions.normal import Normal
 from torch.nn import functional as F
 
+from deepdisc.data_format import dihedral
+
 
 def plot_stretch_Q(
     dataset_dicts,
@@ -86,6 +88,10 @@ def plot_stretch_Q(
 
     """
 
+    # plotting dependencies are only needed here, so they are not imported with the module
+    import matplotlib.pyplot as plt
+    from detectron2.utils.visualizer import Visualizer
+
     d = dataset_dicts[num]
 
     fig, ax = plt.subplots(len(stretches), len(Qs), figsize=(9, 9))
@@ -130,18 +136,181 @@ class SaveHook(HookBase):
 
         
         
+class AsyncCheckpointWriter:
+
+    """
+    Writes checkpoints on a background thread so the training loop only pays for
+    copying the state dicts to CPU memory.
+
+    Every checkpoint is serialised to a temporary file and atomically renamed into
+    place, so a crash mid-write never leaves a truncated .pth behind.
+
+    Parameters
+    ----------
+    save_dir: str
+        The directory the checkpoints are written to
+    max_to_keep: int
+        How many rotating checkpoints to retain on disk.  Older ones are deleted
+        once a newer one has been written.  None keeps everything.
+    max_pending: int
+        How many snapshots may wait in memory for the writer.  Further saves block
+        the training thread, which bounds the host memory used by snapshots.
+    """
+
+    def __init__(self, save_dir, max_to_keep=None, max_pending=2):
+        self.save_dir = save_dir
+        self.max_to_keep = max_to_keep
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._kept = []
+        self._latencies = []
+        self._lock = threading.Lock()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="AsyncCheckpointWriter", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def snapshot(state_dict):
+        """Copy a (possibly nested) state dict to CPU memory, detached from the live model."""
+        if isinstance(state_dict, torch.Tensor):
+            return state_dict.detach().to("cpu", copy=True)
+        if isinstance(state_dict, dict):
+            return type(state_dict)((k, AsyncCheckpointWriter.snapshot(v)) for k, v in state_dict.items())
+        if isinstance(state_dict, (list, tuple)):
+            return type(state_dict)(AsyncCheckpointWriter.snapshot(v) for v in state_dict)
+        return copy.deepcopy(state_dict)
+
+    def save(self, name, data, aliases=(), rotate=True):
+        """Queue a snapshot for writing to ``{save_dir}/{name}.pth``
+
+        Parameters
+        ----------
+        name: str
+            The basename of the checkpoint
+        data: dict
+            An already snapshotted checkpoint (see `snapshot`)
+        aliases: list[str]
+            Extra basenames that should point at the same file once it is written
+        rotate: bool
+            Whether this checkpoint counts towards `max_to_keep`
+        """
+        self._raise_if_failed()
+        self._queue.put((name, data, tuple(aliases), rotate))
+
+    def pop_latencies(self):
+        """Return (and clear) the write times, in seconds, of checkpoints finished so far"""
+        with self._lock:
+            latencies, self._latencies = self._latencies, []
+        return latencies
+
+    def wait(self):
+        """Block until every queued checkpoint has been written"""
+        self._queue.join()
+        self._raise_if_failed()
+
+    def close(self):
+        """Write the queued checkpoints and stop the writer thread, even if a write failed"""
+        try:
+            self.wait()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Background checkpoint write failed") from error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                start = time.perf_counter()
+                self._write(*item)
+                with self._lock:
+                    self._latencies.append(time.perf_counter() - start)
+            except Exception as e:  # surfaced on the training thread by the next save/wait
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    @staticmethod
+    def _replace(tmp_path, path, write):
+        """Write tmp_path with write(tmp_path) and rename it to path; a failed write removes tmp_path"""
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _write(self, name, data, aliases, rotate):
+        os.makedirs(self.save_dir, exist_ok=True)
+        path = os.path.join(self.save_dir, f"{name}.pth")
+
+        def save(tmp_path):
+            with open(tmp_path, "wb") as f:
+                torch.save(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+
+        self._replace(path + ".tmp", path, save)
+
+        def link(tmp_path):
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+            try:
+                os.link(path, tmp_path)
+            except OSError:
+                shutil.copyfile(path, tmp_path)
+
+        for alias in aliases:
+            alias_path = os.path.join(self.save_dir, f"{alias}.pth")
+            self._replace(alias_path + ".tmp", alias_path, link)
+
+        def tag(tmp_path):
+            with open(tmp_path, "w") as f:
+                f.write(os.path.basename(path))
+
+        # Same tag file DetectionCheckpointer writes, so resume_or_load keeps working
+        last = os.path.join(self.save_dir, "last_checkpoint")
+        self._replace(last + ".tmp", last, tag)
+
+        if rotate and self.max_to_keep is not None:
+            self._kept.append(path)
+            while len(self._kept) > self.max_to_keep:
+                old = self._kept.pop(0)
+                if os.path.exists(old):
+                    os.remove(old)
+
+
 class NewSaveHook(HookBase):
 
     """
     This Hook saves the model during training
 
+    Parameters
+    ----------
+    save_period: int
+        How many iterations between checkpoints
+    async_save: bool
+        If True, only snapshot the weights to CPU memory in the training thread and
+        serialise them in the background with an AsyncCheckpointWriter
+    max_to_keep: int
+        How many periodic checkpoints to keep on disk (async_save only).
+        None keeps all of them.  The final checkpoint is never deleted.
     """
     
     output_name = "model_temp"
 
     
-    def __init__(self, save_period):
+    def __init__(self, save_period, async_save=False, max_to_keep=None):
         self._period = save_period
+        self._async_save = async_save
+        self._max_to_keep = max_to_keep
+        self._writer = None
 
     def set_output_name(self, name):
         self.output_name = name
@@ -149,15 +318,52 @@ class NewSaveHook(HookBase):
     #def after_train(self):
     #    self.trainer.checkpointer.save(self.output_name)  # Note: Set the name of the output model here
 
+    def before_train(self):
+        checkpointer = self.trainer.checkpointer
+        if self._async_save and checkpointer.save_to_disk and self._writer is None:
+            self._writer = AsyncCheckpointWriter(checkpointer.save_dir, max_to_keep=self._max_to_keep)
+
     def after_step(self):
         next_iter = self.trainer.iter + 1
         is_final = next_iter == self.trainer.max_iter
         if is_final or (self._period > 0 and next_iter % self._period == 0):  # or (next_iter == 1):
             print("saving", self.output_name)
-            self.trainer.checkpointer.save(f'{self.output_name}_{next_iter//self._period}')
-            if is_final:
-                self.trainer.checkpointer.save(self.output_name)
+            start = time.perf_counter()
+            periodic_name = f'{self.output_name}_{next_iter//self._period}'
+            if self._writer is not None:
+                checkpointer = self.trainer.checkpointer
+                data = {"model": AsyncCheckpointWriter.snapshot(checkpointer.model.state_dict())}
+                for key, obj in checkpointer.checkpointables.items():
+                    data[key] = AsyncCheckpointWriter.snapshot(obj.state_dict())
+                # The final weights are serialised once and linked to the final name
+                aliases = [self.output_name] if is_final else []
+                self._writer.save(periodic_name, data, aliases=aliases)
+            else:
+                self.trainer.checkpointer.save(periodic_name)
+                if is_final:
+                    self.trainer.checkpointer.save(self.output_name)
+            self.trainer.storage.put_scalar(
+                "checkpoint_blocking_time", time.perf_counter() - start, smoothing_hint=False
+            )
+
+        if self._writer is not None:
+            for latency in self._writer.pop_latencies():
+                self.trainer.storage.put_scalar("checkpoint_write_time", latency, smoothing_hint=False)
 
+    def after_train(self):
+        if self._writer is not None:
+            # detectron2 calls after_train from a finally block, so an exception from training
+            # may be propagating; a failed checkpoint write must not replace it
+            training_error = sys.exc_info()[1]
+            try:
+                self._writer.close()
+            except RuntimeError:
+                if training_error is None:
+                    raise
+                logging.getLogger(__name__).exception("Background checkpoint write failed while training failed")
+            for latency in self._writer.pop_latencies():
+                self.trainer.storage.put_scalar("checkpoint_write_time", latency, smoothing_hint=False)
+            self._writer = None
         
 #
 class LossEvalHook(HookBase):
@@ -398,6 +604,61 @@ class CustomAug(Augmentation):
             )  # it returns a Transform which just returns the original Image array only
 
 
+class DihedralTransform(Transform):
+    """
+    Rotate an image by a multiple of 90 degrees and optionally flip it, without interpolation.
+    Boxes and polygons are remapped exactly, see deepdisc.data_format.dihedral
+    """
+
+    def __init__(self, variant, height, width):
+        """
+        Args:
+            variant (int): dihedral variant in [0, 8): variant % 4 counter-clockwise quarter turns,
+                followed by a horizontal flip if variant >= 4
+            height, width (int): the shape of the input image
+        """
+        dihedral.variant_params(variant)
+        super().__init__()
+        self._set_attributes(locals())
+
+    def apply_image(self, img):
+        return np.ascontiguousarray(dihedral.dihedral_image(img, self.variant))
+
+    def apply_coords(self, coords):
+        return dihedral.dihedral_points(coords, self.variant, self.height, self.width)
+
+    def apply_segmentation(self, segmentation):
+        return self.apply_image(segmentation)
+
+    def inverse(self):
+        k, flip = dihedral.variant_params(self.variant)
+        # reflections are their own inverse
+        variant = self.variant if flip else (4 - k) % 4
+        height, width = dihedral.transformed_shape(self.height, self.width, self.variant)
+        return DihedralTransform(variant, height, width)
+
+
+class RandomDihedral(Augmentation):
+    """
+    Apply one of the 8 rotations by multiples of 90 degrees with or without a flip, chosen uniformly.
+    A replacement for T.RandomRotation([-90, 90, 180]) combined with T.RandomFlip,
+    without the interpolation of RandomRotation.
+    """
+
+    def __init__(self, variants=tuple(range(dihedral.NUM_VARIANTS))):
+        """
+        Args:
+            variants (list[int]): the dihedral variants to choose from, all 8 by default
+        """
+        super().__init__()
+        self._init(locals())
+
+    def get_transform(self, image):
+        height, width = image.shape[:2]
+        variant = self.variants[np.random.randint(len(self.variants))]
+        return DihedralTransform(variant, height, width)
+
+
 class KRandomAugmentationList(Augmentation):
     """
     Select and Apply "K" augmentations in "RANDOM" order with "Every"  __call__ method invoke
@@ -17,6 +17,8 @@ from detectron2.utils.file_io import PathManager
 from matplotlib.backends.backend_agg import FigureCanvasAgg
 from PIL import Image
 
+from deepdisc.inference.masks import paste_masks
+
 from .colormap import random_color
 
 logger = logging.getLogger(__name__)
@@ -398,7 +400,9 @@ class Visualizer:
         keypoints = predictions.pred_keypoints if predictions.has("pred_keypoints") else None
 
         if predictions.has("pred_masks"):
-            masks = np.asarray(predictions.pred_masks)
+            # masks kept box-local or run-length encoded (deepdisc.inference.masks) are pasted here
+            pasted_masks = paste_masks(predictions)
+            masks = np.asarray(pasted_masks)
             masks = [GenericMask(x, self.output.height, self.output.width) for x in masks]
         else:
             masks = None
@@ -415,7 +419,7 @@ class Visualizer:
         if self._instance_mode == ColorMode.IMAGE_BW:
             self.output.reset_image(
                 self._create_grayscale_image(
-                    (predictions.pred_masks.any(dim=0) > 0).numpy() if predictions.has("pred_masks") else None
+                    (pasted_masks.any(dim=0) > 0).numpy() if predictions.has("pred_masks") else None
                 )
             )
             # alpha = 0.3
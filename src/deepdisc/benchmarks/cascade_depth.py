@@ -0,0 +1,155 @@
+"""Latency and accuracy of a trained model for each cascade depth, with and without masks.
+
+The predictor is run on the same images with the first k cascade stages (k = 1 .. the
+trained depth) and with the mask head on and off, see deepdisc.inference.early_exit.
+For each setting the benchmark reports the mean latency per image, the box AP against
+the ground truth of the images (when dataset dicts with annotations are given), and how
+closely the detections and redshifts follow those of the full model.
+"""
+
+import time
+
+import numpy as np
+
+from deepdisc.inference.early_exit import cascade_depth, set_cascade_depth
+from deepdisc.inference.quantization import compare_outputs, redshift_grid
+
+
+def box_ap(dataset_dicts, outputs):
+    """COCO box AP of predictions on images with ground truth annotations
+
+    Parameters
+    ----------
+    dataset_dicts : list[dict]
+        The dataset dicts of the images, with "annotations" ("bbox", "bbox_mode",
+        "category_id") and "height"/"width"
+    outputs : list[dict]
+        The predictor outputs of the images, in the same order
+
+    Returns
+    -------
+    dict
+        "AP" (IoU 0.5:0.95) and "AP50", in percent
+    """
+    from detectron2.structures import BoxMode
+    from pycocotools.coco import COCO
+    from pycocotools.cocoeval import COCOeval
+
+    images, annotations, results = [], [], []
+    categories = set()
+    for image_id, (d, output) in enumerate(zip(dataset_dicts, outputs)):
+        images.append({"id": image_id, "height": d["height"], "width": d["width"]})
+        for a in d.get("annotations", []):
+            bbox = BoxMode.convert(list(a["bbox"]), a.get("bbox_mode", BoxMode.XYWH_ABS), BoxMode.XYWH_ABS)
+            annotations.append(
+                {
+                    "id": len(annotations) + 1,
+                    "image_id": image_id,
+                    "category_id": a["category_id"],
+                    "bbox": [float(x) for x in bbox],
+                    "area": float(bbox[2] * bbox[3]),
+                    "iscrowd": 0,
+                }
+            )
+            categories.add(a["category_id"])
+        instances = output["instances"].to("cpu")
+        boxes = BoxMode.convert(instances.pred_boxes.tensor.numpy(), BoxMode.XYXY_ABS, BoxMode.XYWH_ABS)
+        for box, score, cls in zip(boxes, instances.scores.numpy(), instances.pred_classes.numpy()):
+            results.append(
+                {"image_id": image_id, "category_id": int(cls), "bbox": box.tolist(), "score": float(score)}
+            )
+    if not annotations or not results:
+        return {"AP": 0.0 if annotations else None, "AP50": 0.0 if annotations else None}
+
+    gt = COCO()
+    gt.dataset = {"images": images, "annotations": annotations, "categories": [{"id": c} for c in sorted(categories)]}
+    gt.createIndex()
+    coco_eval = COCOeval(gt, gt.loadRes(results), "bbox")
+    # the deepdisc configs keep up to test_topk_per_image detections per tile
+    coco_eval.params.maxDets = [1, 10, max(100, max(len(o["instances"]) for o in outputs))]
+    coco_eval.evaluate()
+    coco_eval.accumulate()
+    coco_eval.summarize()
+    return {"AP": 100 * float(coco_eval.stats[0]), "AP50": 100 * float(coco_eval.stats[1])}
+
+
+def benchmark_cascade_depth(predictor, images, dataset_dicts=None, stages=None, masks=(True, False), iou_thresh=0.5):
+    """Time and score a predictor at each cascade depth
+
+    Parameters
+    ----------
+    predictor : AstroPredictor
+        The predictor, with a cascade head.  Its depth is restored afterwards
+    images : list[np.ndarray]
+        The (H, W, C) images
+    dataset_dicts : list[dict]
+        The dataset dicts of the images, for the box AP.  None to skip it
+    stages : list[int]
+        The depths to run.  Default: 1 .. the trained depth
+    masks : tuple[bool]
+        Run each depth with these mask settings
+    iou_thresh : float
+        The IoU to match detections to those of the full model
+
+    Returns
+    -------
+    list[dict]
+        One entry per (depth, mask) setting
+    """
+    original = cascade_depth(predictor.model)
+    try:
+        n_trained, _ = cascade_depth(set_cascade_depth(predictor.model))
+        stages = list(range(1, n_trained + 1)) if stages is None else list(stages)
+        reference = [predictor(image) for image in images]
+        zs = redshift_grid(predictor.model)
+
+        results = []
+        for num_stages in stages:
+            for mask in masks:
+                set_cascade_depth(predictor.model, num_stages, mask=mask)
+                outputs, times = [], []
+                for image in images:
+                    start = time.perf_counter()
+                    outputs.append(predictor(image))
+                    times.append(time.perf_counter() - start)
+
+                matched = n_reference = 0
+                z_diffs = []
+                for ref, out in zip(reference, outputs):
+                    comparison = compare_outputs(ref, out, iou_thresh=iou_thresh, zs=zs)
+                    matched += len(comparison["ious"])
+                    n_reference += comparison["n_reference"]
+                    z_diffs.extend(comparison.get("z_mean_diffs", comparison.get("z_point_diffs", [])))
+
+                result = {
+                    "stages": num_stages,
+                    "masks": mask,
+                    "latency_ms": 1000 * float(np.mean(times)),
+                    "n_detections": int(sum(len(o["instances"]) for o in outputs)),
+                    "matched_fraction": matched / n_reference if n_reference else None,
+                    "rms_z_diff": float(np.sqrt(np.mean(np.square(z_diffs)))) if z_diffs else None,
+                }
+                if dataset_dicts is not None:
+                    result.update(box_ap(dataset_dicts, outputs))
+                results.append(result)
+    finally:
+        set_cascade_depth(predictor.model, original[0], mask=original[1])
+    return results
+
+
+def format_table(results):
+    """Format the results of benchmark_cascade_depth as a text table"""
+
+    def fmt(value, spec):
+        return "-" if value is None else format(value, spec)
+
+    lines = [
+        f"{'stages':>6} {'masks':>5} {'ms/image':>9} {'n_det':>7} {'matched':>8} {'rms_dz':>8} {'AP':>6} {'AP50':>6}"
+    ]
+    for r in results:
+        lines.append(
+            f"{r['stages']:>6d} {'yes' if r['masks'] else 'no':>5} {r['latency_ms']:>9.1f} {r['n_detections']:>7d} "
+            f"{fmt(r['matched_fraction'], '8.3f'):>8} {fmt(r['rms_z_diff'], '8.4f'):>8} "
+            f"{fmt(r.get('AP'), '6.1f'):>6} {fmt(r.get('AP50'), '6.1f'):>6}"
+        )
+    return "\n".join(lines)
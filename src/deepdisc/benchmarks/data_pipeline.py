@@ -0,0 +1,444 @@
+"""Throughput benchmarks for the data pipeline (image readers, data mappers and train loaders).
+
+The benchmarks run on synthetic tiles with the shapes and file layouts of the
+surveys the image readers support, so they do not need any real data or a model.
+Results are collected in a json report that can be compared between commits.
+"""
+
+import json
+import os
+import platform
+import resource
+import time
+import tracemalloc
+
+import numpy as np
+
+# Default (bands, height, width) of a tile for each survey, and its image reader
+SURVEYS = {
+    "dc2": {"shape": (6, 525, 525), "reader": "DC2ImageReader"},
+    "hsc": {"shape": (3, 1050, 1050), "reader": "HSCImageReader"},
+    "roman": {"shape": (4, 512, 512), "reader": "RomanImageReader"},
+}
+
+HSC_BANDS = ["G", "R", "I"]
+
+
+def make_synthetic_dataset(output_dir, survey="dc2", n_images=8, n_objects=20, shape=None, seed=0):
+    """Write synthetic tiles to disk and return the matching metadata
+
+    Each tile is gaussian sky noise with a few elliptical sources added, and each
+    source gets a box, a polygon segmentation, a redshift and an i-band magnitude,
+    matching the annotation keys the DeepDISC mappers use.
+
+    Parameters
+    ----------
+    output_dir : str
+        The directory to write the tiles to
+    survey : str
+        One of "dc2" (one npy file per tile), "hsc" (one FITS file per band)
+        or "roman" (one npy file per tile)
+    n_images : int
+        The number of tiles
+    n_objects : int
+        The number of annotated sources per tile
+    shape : tuple
+        The (bands, height, width) of the tiles.  Defaults to SURVEYS[survey]["shape"]
+    seed : int
+        Seed for the random number generator
+
+    Returns
+    -------
+    dataset_dicts : list[dict]
+        The metadata for each tile
+    """
+    if survey not in SURVEYS:
+        raise ValueError(f"Unknown survey {survey}. Choose from {list(SURVEYS.keys())}")
+    nb, height, width = shape if shape is not None else SURVEYS[survey]["shape"]
+    if survey == "hsc" and nb != 3:
+        raise ValueError("HSC tiles must have 3 bands.")
+
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width]
+
+    dataset_dicts = []
+    for image_id in range(n_images):
+        image = rng.normal(0.0, 0.05, size=(nb, height, width)).astype(np.float32)
+        annotations = []
+        for _ in range(n_objects):
+            a = rng.uniform(2, 12)
+            b = a * rng.uniform(0.4, 1.0)
+            x0 = rng.uniform(a, width - a)
+            y0 = rng.uniform(a, height - a)
+            x1, y1 = max(int(x0 - a), 0), max(int(y0 - a), 0)
+            x2, y2 = min(int(x0 + a) + 1, width), min(int(y0 + a) + 1, height)
+            profile = np.exp(-0.5 * (((xx[y1:y2, x1:x2] - x0) / a) ** 2 + ((yy[y1:y2, x1:x2] - y0) / b) ** 2))
+            image[:, y1:y2, x1:x2] += rng.uniform(0.1, 5.0, size=(nb, 1, 1)) * profile
+
+            t = np.linspace(0, 2 * np.pi, 16, endpoint=False)
+            poly = np.stack([x0 + a * np.cos(t), y0 + b * np.sin(t)], axis=1)
+            poly[:, 0] = np.clip(poly[:, 0], 0, width - 1)
+            poly[:, 1] = np.clip(poly[:, 1], 0, height - 1)
+            annotations.append(
+                {
+                    "bbox": [float(x0 - a), float(y0 - b), float(2 * a), float(2 * b)],
+                    # detectron2 BoxMode.XYWH_ABS
+                    "bbox_mode": 1,
+                    "segmentation": [poly.ravel().tolist()],
+                    "category_id": int(rng.integers(0, 2)),
+                    "redshift": float(rng.uniform(0.01, 3.0)),
+                    "mag_i": float(rng.uniform(18, 28)),
+                }
+            )
+
+        record = {"image_id": image_id, "height": height, "width": width, "annotations": annotations}
+        if survey == "hsc":
+            from astropy.io import fits
+
+            for b, band in zip(HSC_BANDS, image):
+                fn = os.path.join(output_dir, f"tile_{image_id}_{b}.fits")
+                fits.writeto(fn, band, overwrite=True)
+                record[f"filename_{b}"] = fn
+            record["file_name"] = record["filename_G"]
+        else:
+            fn = os.path.join(output_dir, f"tile_{image_id}.npy")
+            np.save(fn, image)
+            record["file_name"] = fn
+            record["filename"] = fn
+        dataset_dicts.append(record)
+
+    return dataset_dicts
+
+
+def key_mapper_for(survey):
+    """Return the key_mapper that gives the image reader key for a synthetic tile"""
+    if survey == "hsc":
+        return lambda dataset_dict: [dataset_dict[f"filename_{b}"] for b in HSC_BANDS]
+    return lambda dataset_dict: dataset_dict["filename"]
+
+
+def image_reader_for(survey, norm="raw", **kwargs):
+    """Return the image reader for a survey with the given contrast scaling"""
+    from deepdisc.data_format import image_readers
+
+    return getattr(image_readers, SURVEYS[survey]["reader"])(norm=norm, **kwargs)
+
+
+def _time_calls(func, items, repeats, warmup):
+    """Call func on every item, `repeats` times, and return the per-call latencies"""
+    for item in items[:warmup]:
+        func(item)
+    latencies = []
+    for _ in range(repeats):
+        for item in items:
+            start = time.perf_counter()
+            func(item)
+            latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+
+def _peak_traced_mb(func, item):
+    """Peak python-allocated memory (including numpy buffers) of one call, in MB"""
+    tracemalloc.start()
+    try:
+        func(item)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 2**20
+
+
+def _summarize(latencies, n_samples, total_time):
+    return {
+        "samples_per_s": n_samples / total_time if total_time > 0 else float("inf"),
+        "latency_ms": {
+            f"p{q}": float(v) * 1e3 for q, v in zip((50, 90, 99), np.percentile(latencies, (50, 90, 99)))
+        },
+        "n_samples": int(n_samples),
+    }
+
+
+def benchmark_reader(reader, keys, repeats=3, warmup=1):
+    """Measure the throughput and memory of an image reader
+
+    Parameters
+    ----------
+    reader : ImageReader
+        The image reader, including its contrast scaling
+    keys : list
+        The keys (filenames) to read
+    repeats : int
+        How many times to read every key
+    warmup : int
+        The number of keys read before timing, so the page cache is warm
+
+    Returns
+    -------
+    dict
+        samples/s, latency percentiles, and the peak memory of one read
+    """
+    latencies = _time_calls(reader, keys, repeats, warmup)
+    result = _summarize(latencies, len(latencies), latencies.sum())
+    result["peak_traced_mb"] = _peak_traced_mb(reader, keys[0])
+    return result
+
+
+def benchmark_mapper(map_data, dataset_dicts, repeats=3, warmup=1):
+    """Measure the throughput and memory of a data mapper's map_data
+
+    Parameters
+    ----------
+    map_data : function
+        The mapping function, e.g. DictMapper(reader, key_mapper, augs).map_data
+    dataset_dicts : list[dict]
+        The metadata to map
+    repeats : int
+        How many times to map every record
+    warmup : int
+        The number of records mapped before timing
+
+    Returns
+    -------
+    dict
+        samples/s, latency percentiles, and the peak memory of one call
+    """
+    latencies = _time_calls(map_data, dataset_dicts, repeats, warmup)
+    result = _summarize(latencies, len(latencies), latencies.sum())
+    result["peak_traced_mb"] = _peak_traced_mb(map_data, dataset_dicts[0])
+    return result
+
+
+def benchmark_train_loader(map_data, dataset_dicts, num_workers=0, batch_size=4, n_batches=20, warmup=2):
+    """Measure the throughput of return_train_loader with a given number of workers
+
+    The synthetic metadata is registered as a temporary detectron2 dataset and
+    the loader is built from a minimal config, exactly as during training.
+
+    Parameters
+    ----------
+    map_data : function
+        The mapping function
+    dataset_dicts : list[dict]
+        The metadata of the data set
+    num_workers : int
+        The number of data loader worker processes
+    batch_size : int
+        The total batch size
+    n_batches : int
+        The number of batches timed
+    warmup : int
+        The number of batches drawn before timing, which includes starting the workers
+
+    Returns
+    -------
+    dict
+        samples/s, per-batch latency percentiles and the peak resident memory
+        of the main and worker processes
+    """
+    from detectron2.config import get_cfg
+    from detectron2.data import DatasetCatalog
+
+    from deepdisc.model.loaders import return_train_loader
+
+    name = f"deepdisc_benchmark_{os.getpid()}_{id(dataset_dicts)}"
+    DatasetCatalog.register(name, lambda: dataset_dicts)
+    try:
+        cfg = get_cfg()
+        cfg.DATASETS.TRAIN = (name,)
+        cfg.DATALOADER.NUM_WORKERS = num_workers
+        cfg.SOLVER.IMS_PER_BATCH = batch_size
+        loader = return_train_loader(cfg, map_data)
+
+        data_iter = iter(loader)
+        for _ in range(warmup):
+            next(data_iter)
+        latencies = []
+        for _ in range(n_batches):
+            start = time.perf_counter()
+            next(data_iter)
+            latencies.append(time.perf_counter() - start)
+        latencies = np.array(latencies)
+        del data_iter, loader
+    finally:
+        DatasetCatalog.remove(name)
+
+    result = _summarize(latencies, n_batches * batch_size, latencies.sum())
+    result["latency_ms"] = {"batch_" + k: v for k, v in result["latency_ms"].items()}
+    result["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    result["max_worker_rss_mb"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return result
+
+
+def environment_info():
+    """Information identifying where a report was produced"""
+    info = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    try:
+        from deepdisc._version import __version__
+
+        info["deepdisc"] = __version__
+    except ImportError:
+        pass
+    return info
+
+
+def run_benchmarks(
+    output_dir,
+    surveys=("dc2", "hsc", "roman"),
+    norms=("raw", "zscore", "lupton"),
+    mappers=("DictMapper", "RedshiftDictMapper"),
+    workers=(0, 2, 4),
+    n_images=8,
+    n_objects=20,
+    repeats=3,
+    batch_size=4,
+    n_batches=20,
+    augs=None,
+    shape=None,
+    seed=0,
+):
+    """Run the reader, mapper and loader benchmarks and return a report
+
+    The mapper and loader benchmarks need detectron2; if it cannot be imported
+    only the reader benchmarks are run.
+
+    Parameters
+    ----------
+    output_dir : str
+        Where to write the synthetic tiles
+    surveys, norms, mappers, workers : iterables
+        The grid of surveys, contrast scalings, mapper class names (from
+        deepdisc.model.loaders) and loader worker counts to benchmark
+    n_images, n_objects : int
+        The size of the synthetic data set per survey
+    repeats : int
+        Passes over the data set for the reader and mapper benchmarks
+    batch_size, n_batches : int
+        Settings for the loader benchmarks
+    augs : function
+        Augmentation function for the mappers, e.g. augment_image.dc2_train_augs
+    shape : tuple
+        Override the (bands, height, width) of the tiles
+    seed : int
+        Seed for the synthetic data
+
+    Returns
+    -------
+    report : dict
+        {"environment": ..., "config": ..., "results": [...]}
+    """
+    try:
+        from deepdisc.model import loaders
+    except ImportError:
+        loaders = None
+
+    results = []
+    for survey in surveys:
+        dataset_dicts = make_synthetic_dataset(
+            os.path.join(output_dir, survey), survey, n_images, n_objects, shape=shape, seed=seed
+        )
+        key_mapper = key_mapper_for(survey)
+        keys = [key_mapper(d) for d in dataset_dicts]
+
+        for norm in norms:
+            reader = image_reader_for(survey, norm)
+            result = benchmark_reader(reader, keys, repeats=repeats)
+            results.append({"benchmark": "reader", "survey": survey, "norm": norm, **result})
+
+        if loaders is None:
+            continue
+        for mapper_name in mappers:
+            mapper = getattr(loaders, mapper_name)(image_reader_for(survey, norms[0]), key_mapper, augs)
+            result = benchmark_mapper(mapper.map_data, dataset_dicts, repeats=repeats)
+            results.append(
+                {"benchmark": "mapper", "survey": survey, "norm": norms[0], "mapper": mapper_name, **result}
+            )
+            for num_workers in workers:
+                result = benchmark_train_loader(
+                    mapper.map_data, dataset_dicts, num_workers, batch_size=batch_size, n_batches=n_batches
+                )
+                results.append(
+                    {
+                        "benchmark": "train_loader",
+                        "survey": survey,
+                        "norm": norms[0],
+                        "mapper": mapper_name,
+                        "num_workers": num_workers,
+                        **result,
+                    }
+                )
+
+    config = {
+        "surveys": list(surveys),
+        "norms": list(norms),
+        "mappers": list(mappers),
+        "workers": list(workers),
+        "n_images": n_images,
+        "n_objects": n_objects,
+        "repeats": repeats,
+        "batch_size": batch_size,
+        "n_batches": n_batches,
+        "augs": getattr(augs, "__name__", None),
+        "shape": list(shape) if shape is not None else None,
+    }
+    return {"environment": environment_info(), "config": config, "results": results}
+
+
+def result_key(result):
+    """The fields that identify a benchmark case, used to match results between reports"""
+    return tuple(
+        (k, result[k]) for k in ("benchmark", "survey", "norm", "mapper", "num_workers") if k in result
+    )
+
+
+def compare_reports(baseline, current, tolerance=0.1):
+    """Compare the throughput of two reports
+
+    Parameters
+    ----------
+    baseline, current : dict
+        Reports from run_benchmarks (or loaded from their json files)
+    tolerance : float
+        Relative slowdown above which a case is flagged as a regression
+
+    Returns
+    -------
+    comparison : list[dict]
+        For every case in both reports: its key, both throughputs, their ratio
+        and whether it regressed
+    """
+    base = {result_key(r): r for r in baseline["results"]}
+    comparison = []
+    for r in current["results"]:
+        key = result_key(r)
+        if key not in base:
+            continue
+        ratio = r["samples_per_s"] / base[key]["samples_per_s"]
+        comparison.append(
+            {
+                "case": dict(key),
+                "baseline_samples_per_s": base[key]["samples_per_s"],
+                "samples_per_s": r["samples_per_s"],
+                "ratio": ratio,
+                "regression": ratio < 1 - tolerance,
+            }
+        )
+    return comparison
+
+
+def save_report(report, filename):
+    """Write a report to a json file"""
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def load_report(filename):
+    """Read a report written by save_report"""
+    with open(filename) as f:
+        return json.load(f)
@@ -0,0 +1,139 @@
+"""Benchmark of the fused mixture density NLL against the torch.distributions implementation.
+
+The redshift PDF heads used to build Independent(MixtureSameFamily(Categorical, Normal))
+objects at every step and call log_prob on them.  This compares a forward and backward pass
+of that with deepdisc.model.losses.mdn_nll on random head outputs, and also checks that the
+losses and gradients agree.
+"""
+
+import time
+
+import torch
+from torch.distributions.categorical import Categorical
+from torch.distributions.independent import Independent
+from torch.distributions.mixture_same_family import MixtureSameFamily
+from torch.distributions.normal import Normal
+from torch.nn import functional as F
+
+from deepdisc.model.losses import mdn_log_prob_grid, mdn_nll
+
+
+def distribution_nll(inputs, z, num_components, scale_activation="exp"):
+    """The NLL as computed by the redshift heads with torch.distributions"""
+    raw_scales = inputs[..., 2 * num_components :]
+    scales = torch.exp(raw_scales) if scale_activation == "exp" else F.softplus(raw_scales)
+    pdf = Independent(
+        MixtureSameFamily(
+            mixture_distribution=Categorical(logits=inputs[..., :num_components]),
+            component_distribution=Normal(inputs[..., num_components : 2 * num_components], scales),
+        ),
+        0,
+    )
+    return -pdf.log_prob(z)
+
+
+def distribution_log_prob_grid(inputs, zs, num_components, scale_activation="exp"):
+    """The (N, M) log densities as computed by the redshift heads at inference, one grid point at a time"""
+    probs = torch.zeros((len(inputs), len(zs)), dtype=inputs.dtype)
+    for j, z in enumerate(zs):
+        probs[:, j] = -distribution_nll(inputs, z.expand(len(inputs)), num_components, scale_activation)
+    return probs
+
+
+def make_inputs(n_instances, num_components, seed=0):
+    """Random head outputs and redshifts"""
+    generator = torch.Generator().manual_seed(seed)
+    inputs = torch.randn(n_instances, 3 * num_components, generator=generator)
+    z = 3 * torch.rand(n_instances, generator=generator)
+    return inputs, z
+
+
+def _time_step(loss_fn, inputs, z, num_components, scale_activation, repeats, warmup):
+    """Median time of a forward and backward pass, and the last loss and gradient"""
+    times = []
+    for i in range(warmup + repeats):
+        x = inputs.clone().requires_grad_(True)
+        start = time.perf_counter()
+        loss = loss_fn(x, z, num_components, scale_activation).mean()
+        loss.backward()
+        if i >= warmup:
+            times.append(time.perf_counter() - start)
+    times.sort()
+    return 1000 * times[len(times) // 2], loss.detach(), x.grad
+
+
+def benchmark_mdn_loss(
+    n_instances=(64, 512, 4096), num_components=(1, 5), scale_activation="exp", n_grid=300, repeats=20, warmup=3
+):
+    """Time both NLL implementations and the inference grid for several sizes
+
+    Parameters
+    ----------
+    n_instances : list[int]
+        The numbers of foreground instances per step
+    num_components : list[int]
+        The numbers of mixture components
+    scale_activation : str
+        "exp" or "softplus"
+    n_grid : int
+        The number of redshifts of the inference grid
+    repeats : int
+        Timed repeats of each measurement
+    warmup : int
+        Untimed repeats before those
+
+    Returns
+    -------
+    results : list[dict]
+        Latencies (ms) of each implementation, the speedups, and the largest absolute
+        differences of the losses, gradients and grid log densities
+    """
+    results = []
+    for k in num_components:
+        for n in n_instances:
+            inputs, z = make_inputs(n, k)
+            dist_ms, dist_loss, dist_grad = _time_step(
+                distribution_nll, inputs, z, k, scale_activation, repeats, warmup
+            )
+            fused_ms, fused_loss, fused_grad = _time_step(mdn_nll, inputs, z, k, scale_activation, repeats, warmup)
+
+            zs = torch.linspace(0, 3, n_grid)
+            start = time.perf_counter()
+            dist_grid = distribution_log_prob_grid(inputs, zs, k, scale_activation)
+            dist_grid_ms = 1000 * (time.perf_counter() - start)
+            start = time.perf_counter()
+            fused_grid = mdn_log_prob_grid(inputs, zs, k, scale_activation)
+            fused_grid_ms = 1000 * (time.perf_counter() - start)
+
+            results.append(
+                {
+                    "n_instances": n,
+                    "num_components": k,
+                    "step_ms": {"distributions": dist_ms, "fused": fused_ms},
+                    "step_speedup": dist_ms / fused_ms,
+                    "grid_ms": {"distributions": dist_grid_ms, "fused": fused_grid_ms},
+                    "grid_speedup": dist_grid_ms / fused_grid_ms,
+                    "max_abs_diff": {
+                        "loss": float((dist_loss - fused_loss).abs()),
+                        "grad": float((dist_grad - fused_grad).abs().max()),
+                        "grid": float((dist_grid - fused_grid).abs().max()),
+                    },
+                }
+            )
+    return results
+
+
+def format_table(results):
+    """Format benchmark results as a text table"""
+    lines = [
+        f"{'K':>3} {'N':>6} {'dist ms':>9} {'fused ms':>9} {'speedup':>8} "
+        f"{'grid dist':>10} {'grid fused':>10} {'speedup':>8} {'grad diff':>10}"
+    ]
+    for r in results:
+        step, grid = r["step_ms"], r["grid_ms"]
+        lines.append(
+            f"{r['num_components']:>3} {r['n_instances']:>6} {step['distributions']:>9.2f} {step['fused']:>9.2f} "
+            f"{r['step_speedup']:>7.1f}x {grid['distributions']:>10.1f} {grid['fused']:>10.1f} "
+            f"{r['grid_speedup']:>7.1f}x {r['max_abs_diff']['grad']:>10.1e}"
+        )
+    return "\n".join(lines)
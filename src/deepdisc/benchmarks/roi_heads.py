@@ -0,0 +1,338 @@
+"""CPU inference benchmarks for the redshift ROI-head variants in deepdisc.model.models.
+
+Each head is built with the box, mask and pooler settings of the cascade/standard
+FPN configs, and fed synthetic p2-p5 feature maps and proposals, so no backbone,
+checkpoint or data is needed.  The box, mask and redshift stages are timed
+separately for several numbers of detections per image.  Each head runs in its
+own forked process so its peak memory can be measured independently.
+"""
+
+import multiprocessing as mp
+import queue
+import resource
+import time
+
+import numpy as np
+
+# Head name -> (is a cascade head, extra constructor arguments)
+HEADS = {
+    "RedshiftPDFCasROIHeads": (True, {"num_components": 5, "zloss_factor": 1.0}),
+    "RedshiftPDFCasROIHeadsGold": (True, {"num_components": 5, "zloss_factor": 1.0}),
+    "WeightedRedshiftPDFCasROIHeads": (
+        True,
+        {
+            "num_components": 5,
+            "zloss_factor": 1.0,
+            "weights": [1.0] * 11,
+            "zbins": list(np.linspace(0, 3, 10)),
+        },
+    ),
+    "CNNRedshiftPDFCasROIHeads": (True, {"num_components": 5, "zloss_factor": 1.0}),
+    "OldRedshiftPDFCasROIHeads": (True, {"num_components": 5, "zloss_factor": 1.0}),
+    "OldEBVRedshiftPDFCasROIHeads": (True, {"num_components": 5, "zloss_factor": 1.0}),
+    "RedshiftPointCasROIHeads": (True, {"zloss_factor": 1.0}),
+    "RedshiftPointROIHeads": (False, {"zloss_factor": 1.0}),
+    "RedshiftPDFROIHeads": (False, {"num_components": 5, "zloss_factor": 1.0}),
+}
+
+IN_FEATURES = ["p2", "p3", "p4", "p5"]
+SCALES = (1.0 / 4, 1.0 / 8, 1.0 / 16, 1.0 / 32)
+
+
+def build_head(name, num_classes=1, max_detections=100, **kwargs):
+    """Build a ROI head from deepdisc.model.models with the FPN config defaults
+
+    Parameters
+    ----------
+    name : str
+        The class name of the head, a key of HEADS
+    num_classes : int
+        The number of object classes
+    max_detections : int
+        The number of detections kept per image.  The score threshold is 0 and
+        the NMS threshold is 1, so with random weights exactly this many
+        detections go to the mask and redshift stages.
+    **kwargs
+        Override the head's extra constructor arguments in HEADS
+
+    Returns
+    -------
+    head : torch module
+        The head, in eval mode
+    """
+    from detectron2.layers import ShapeSpec
+    from detectron2.modeling.box_regression import Box2BoxTransform
+    from detectron2.modeling.matcher import Matcher
+    from detectron2.modeling.poolers import ROIPooler
+    from detectron2.modeling.roi_heads import FastRCNNConvFCHead, FastRCNNOutputLayers, MaskRCNNConvUpsampleHead
+
+    from deepdisc.model import models
+
+    cascade, head_kwargs = HEADS[name]
+    head_kwargs = {**head_kwargs, **kwargs}
+
+    def box_head():
+        return FastRCNNConvFCHead(
+            ShapeSpec(channels=256, height=7, width=7), conv_dims=[256, 256, 256, 256], fc_dims=[1024], conv_norm="LN"
+        )
+
+    def box_predictor(weights):
+        return FastRCNNOutputLayers(
+            ShapeSpec(channels=1024),
+            box2box_transform=Box2BoxTransform(weights=weights),
+            num_classes=num_classes,
+            cls_agnostic_bbox_reg=cascade,
+            test_score_thresh=0.0,
+            test_nms_thresh=1.0,
+            test_topk_per_image=max_detections,
+        )
+
+    common = dict(
+        num_classes=num_classes,
+        batch_size_per_image=512,
+        positive_fraction=0.25,
+        box_in_features=IN_FEATURES,
+        box_pooler=ROIPooler(output_size=7, scales=SCALES, sampling_ratio=0, pooler_type="ROIAlignV2"),
+        mask_in_features=IN_FEATURES,
+        mask_pooler=ROIPooler(output_size=14, scales=SCALES, sampling_ratio=0, pooler_type="ROIAlignV2"),
+        mask_head=MaskRCNNConvUpsampleHead(
+            ShapeSpec(channels=256, width=14, height=14),
+            num_classes=num_classes,
+            conv_dims=[256, 256, 256, 256, 256],
+            conv_norm="LN",
+        ),
+    )
+    if cascade:
+        common.update(
+            box_heads=[box_head() for _ in range(3)],
+            box_predictors=[box_predictor((w1, w1, w2, w2)) for (w1, w2) in [(10, 5), (20, 10), (30, 15)]],
+            proposal_matchers=[
+                Matcher(thresholds=[th], labels=[0, 1], allow_low_quality_matches=False) for th in [0.5, 0.6, 0.7]
+            ],
+        )
+    else:
+        common.update(
+            box_head=box_head(),
+            box_predictor=box_predictor((10, 10, 5, 5)),
+            proposal_matcher=Matcher(thresholds=[0.5], labels=[0, 1], allow_low_quality_matches=False),
+        )
+    head = getattr(models, name)(**head_kwargs, **common)
+    return head.eval()
+
+
+def make_inputs(image_size=512, n_proposals=1000, batch_size=1, seed=0):
+    """Synthetic FPN features and RPN proposals
+
+    Parameters
+    ----------
+    image_size : int
+        The (square) input image size the features correspond to
+    n_proposals : int
+        The number of proposals per image
+    batch_size : int
+        The number of images
+    seed : int
+        Seed for the random features and boxes
+
+    Returns
+    -------
+    features : dict
+        {"p2": ..., "p5": ...} tensors of shape (batch_size, 256, image_size * scale, image_size * scale)
+    proposals : list[Instances]
+        proposal_boxes and objectness_logits for each image
+    """
+    import torch
+    from detectron2.structures import Boxes, Instances
+
+    gen = torch.Generator().manual_seed(seed)
+    features = {
+        f: torch.randn(batch_size, 256, int(image_size * s), int(image_size * s), generator=gen)
+        for f, s in zip(IN_FEATURES, SCALES)
+    }
+    proposals = []
+    for _ in range(batch_size):
+        xy = torch.rand(n_proposals, 2, generator=gen) * (image_size - 32)
+        wh = 4 + torch.rand(n_proposals, 2, generator=gen) * 28
+        instances = Instances((image_size, image_size))
+        instances.proposal_boxes = Boxes(torch.cat([xy, xy + wh], dim=1))
+        instances.objectness_logits = torch.randn(n_proposals, generator=gen)
+        proposals.append(instances)
+    return features, proposals
+
+
+def _reset_peak_rss():
+    """Reset the peak resident memory of this process (Linux only); return the current RSS in MB"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return _read_status("VmRSS")
+    except OSError:
+        return None
+
+
+def _read_status(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+    return None
+
+
+def _peak_rss_mb():
+    try:
+        return _read_status("VmHWM")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_stages(head, features, proposals):
+    """Run the inference path of a ROI head as in its forward(), timing each stage
+
+    Returns
+    -------
+    instances : list[Instances]
+        The predictions
+    times : dict
+        Seconds spent in the "box", "mask" and "redshift" stages
+    memory : dict
+        Peak resident memory above the start of each stage in MB (None if not measurable)
+    """
+    times, memory = {}, {}
+
+    def stage(name, func, *args):
+        base = _reset_peak_rss()
+        start = time.perf_counter()
+        out = func(*args)
+        times[name] = time.perf_counter() - start
+        memory[name] = _peak_rss_mb() - base if base is not None else None
+        return out
+
+    instances = stage("box", head._forward_box, features, proposals)
+    instances = stage("mask", head.forward_with_given_boxes, features, instances)
+    instances = stage("redshift", head._forward_redshift, features, instances)
+    return instances, times, memory
+
+
+def benchmark_head(name, detections=(10, 100, 500), image_size=512, n_proposals=1000, repeats=5, warmup=1, threads=None):
+    """Benchmark one head at several numbers of detections per image
+
+    Parameters
+    ----------
+    name : str
+        The head class name, a key of HEADS
+    detections : iterable of int
+        The numbers of detections per image to benchmark
+    image_size : int
+        The input image size the synthetic features correspond to
+    n_proposals : int
+        The number of proposals per image (at least the largest number of detections)
+    repeats : int
+        Timed runs per detection count
+    warmup : int
+        Untimed runs per detection count
+    threads : int
+        torch.set_num_threads value, or None to keep the default
+
+    Returns
+    -------
+    results : list[dict]
+        One entry per detection count with the median latency per stage and in
+        total (ms) and the peak memory per stage (MB), or with an "error"
+        entry if the head failed.
+    """
+    import torch
+
+    if threads is not None:
+        torch.set_num_threads(threads)
+
+    results = []
+    for n_det in detections:
+        result = {"head": name, "detections": n_det, "image_size": image_size}
+        try:
+            head = build_head(name, max_detections=n_det)
+            features, proposals = make_inputs(image_size, max(n_proposals, n_det))
+            stage_times = {"box": [], "mask": [], "redshift": []}
+            stage_memory = {}
+            with torch.no_grad():
+                for i in range(warmup + repeats):
+                    instances, times, memory = run_stages(head, features, proposals)
+                    if i < warmup:
+                        continue
+                    for k, v in times.items():
+                        stage_times[k].append(v)
+                    for k, v in memory.items():
+                        if v is not None:
+                            stage_memory[k] = max(stage_memory.get(k, 0.0), v)
+            result["n_pred"] = len(instances[0])
+            result["latency_ms"] = {k: float(np.median(v)) * 1e3 for k, v in stage_times.items()}
+            result["latency_ms"]["total"] = float(np.median(np.sum([v for v in stage_times.values()], axis=0))) * 1e3
+            result["peak_memory_mb"] = stage_memory
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+        results.append(result)
+    return results
+
+
+def _benchmark_head_worker(name, kwargs, queue):
+    results = benchmark_head(name, **kwargs)
+    for r in results:
+        r["process_peak_rss_mb"] = _peak_rss_mb()
+    queue.put(results)
+
+
+def run_benchmarks(heads=None, isolate=True, **kwargs):
+    """Benchmark several heads
+
+    Parameters
+    ----------
+    heads : list[str]
+        The heads to benchmark, defaults to all of HEADS
+    isolate : bool
+        Run each head in its own forked process, so memory measurements of one
+        head are not affected by the others
+    **kwargs
+        Passed to benchmark_head
+
+    Returns
+    -------
+    results : list[dict]
+        The results of benchmark_head for every head
+    """
+    heads = list(HEADS) if heads is None else heads
+    results = []
+    for name in heads:
+        if not isolate:
+            results.extend(benchmark_head(name, **kwargs))
+            continue
+        ctx = mp.get_context("fork")
+        result_queue = ctx.Queue()
+        proc = ctx.Process(target=_benchmark_head_worker, args=(name, kwargs, result_queue))
+        proc.start()
+        head_results = None
+        while head_results is None:
+            try:
+                head_results = result_queue.get(timeout=1)
+            except queue.Empty:
+                if not proc.is_alive():
+                    head_results = [{"head": name, "detections": None, "error": f"exited with code {proc.exitcode}"}]
+        proc.join()
+        results.extend(head_results)
+    return results
+
+
+def format_table(results):
+    """Format benchmark results as a text table"""
+    lines = [
+        f"{'head':<32} {'dets':>5} {'box ms':>9} {'mask ms':>9} {'z ms':>9} {'total ms':>9} {'peak MB':>8}"
+    ]
+    for r in results:
+        if "error" in r:
+            lines.append(f"{r['head']:<32} {r['detections']:>5} failed: {r['error']}")
+            continue
+        t = r["latency_ms"]
+        peak = max(r["peak_memory_mb"].values()) if r["peak_memory_mb"] else float("nan")
+        lines.append(
+            f"{r['head']:<32} {r['detections']:>5} {t['box']:>9.1f} {t['mask']:>9.1f} "
+            f"{t['redshift']:>9.1f} {t['total']:>9.1f} {peak:>8.1f}"
+        )
+    return "\n".join(lines)
@@ -1,21 +1,94 @@
 """Utilities for augmenting image data."""
 
 import detectron2.data.transforms as T
-#import imgaug.augmenters as iaa
 import numpy as np
+from scipy import ndimage
 
-import DeepDiscVR.src.deepdisc.astrodet.detectron as detectron_addons
-import random
-
+import deepdisc.astrodet.detectron as detectron_addons
 
 
 LAMBDA_EFFS = [3671,4827,6223,7546,8691,9712]
 A_EBV = np.array([4.81,3.64,2.70,2.06,1.58,1.31])
 
 
+def _gaussian_kernels(sigmas, truncate=4.0):
+    """1D Gaussian kernels for each sigma, zero padded to a common radius
 
-def redden(image, rng_seed=None):
+    Returns
+    -------
+    kernels : ndarray
+        Normalised kernels of shape (len(sigmas), 2 * radius + 1); sigma <= 0 gives the identity
+    """
+    sigmas = np.asarray(sigmas, dtype=np.float64)
+    radius = int(np.ceil(truncate * sigmas.max())) if sigmas.max() > 0 else 0
+    x = np.arange(-radius, radius + 1, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        kernels = np.exp(-0.5 * (x[None, :] / sigmas[:, None]) ** 2)
+    kernels[sigmas <= 0] = (x == 0)
+    return kernels / kernels.sum(axis=1, keepdims=True)
+
+
+def _to_dtype(result, dtype):
+    """Round and clip integer results to the input dtype, keep floats as float32 or the input float type"""
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        return np.clip(np.rint(result), info.min, info.max).astype(dtype, order="C")
+    return result.astype(dtype if dtype == np.float64 else np.float32, order="C")
+
+
+def separable_blur(image, sigmas, truncate=4.0):
+    """Gaussian blur of all bands of an image in one pass, with a separate sigma per band
+
+    The blur is separable: each band is convolved with its 1D kernel along the rows and then
+    along the columns (scipy.ndimage.correlate1d). All kernels are cut at the radius of the
+    largest sigma. Borders are reflected (as cv2's default).
+
+    Parameters
+    ----------
+    image: ndarray
+        HWC image, or a single-band HW image
+    sigmas: float or list[float]
+        The standard deviation in pixels, for all bands or one per band
+    truncate: float
+        The kernels are cut at this many sigma
+
+    Returns
+    -------
+    the blurred image, with the dtype of the input (float32 for non-float64 floats)
     """
+    dtype = image.dtype
+    work_dtype = np.float64 if dtype == np.float64 else np.float32
+    im = np.asarray(image, dtype=work_dtype)
+    squeeze = im.ndim == 2
+    # work on CHW arrays, so each band is contiguous
+    im = np.ascontiguousarray(im[None] if squeeze else im.transpose(2, 0, 1))
+    sigmas = np.broadcast_to(np.asarray(sigmas, dtype=np.float64), (im.shape[0],))
+    kernels = _gaussian_kernels(sigmas, truncate)
+    out = np.empty_like(im)
+    for band, sigma in enumerate(sigmas):
+        if sigma <= 0:
+            out[band] = im[band]
+            continue
+        # np.pad's "reflect" is ndimage's "mirror"; each line is buffered, so the second pass can run in place
+        ndimage.correlate1d(im[band], kernels[band], axis=0, mode="mirror", output=out[band])
+        ndimage.correlate1d(out[band], kernels[band], axis=1, mode="mirror", output=out[band])
+    im = out[0] if squeeze else out.transpose(1, 2, 0)
+    return _to_dtype(im, dtype)
+
+
+def _add_uniform_noise(image, low, high, rng_seed=None):
+    """Add independent uniform noise in [low, high] to every element; integers for integer images"""
+    rng = np.random.default_rng(rng_seed)
+    if np.issubdtype(image.dtype, np.integer):
+        noise = rng.integers(int(np.floor(low)), int(np.ceil(high)), size=image.shape, endpoint=True)
+    else:
+        noise = rng.uniform(low, high, size=image.shape)
+    return _to_dtype(image + noise, image.dtype)
+
+
+def redden(image, rng_seed=None):
+    """Apply a random dust reddening with E(B-V) in [0, 0.5] to a 6 band (ugrizy) HWC image
+
     Parameters
     ----------
     image: ndarray
@@ -27,28 +100,27 @@ def redden(image, rng_seed=None):
     augmented image
 
     """
-    new_ebv = np.random.uniform(0, 0.5)
+    rng = np.random.default_rng(rng_seed)
+    new_ebv = rng.uniform(0, 0.5)
     image = np.float32(image*(10.**(-A_EBV*new_ebv/2.5)))
     return image
 
 
 def gaussblur(image, rng_seed=None):
-    """
+    """Gaussian blur with sigma=10 pixels
+
     Parameters
     ----------
     image: ndarray
     rng_seed : np.random.Generator
-        Random state that is seeded. if none, use machine entropy.
+        Unused, the blur is deterministic. Kept for a uniform augmentation interface.
 
     Returns
     -------
     augmented image
 
     """
-    if rng_seed is None:
-        rng_seed = np.random.default_rng()
-    aug = iaa.GaussianBlur(sigma=10, seed=rng_seed)
-    return aug.augment_image(image)
+    return separable_blur(image, 10)
 
 
 def scale_psf(sigi, lambda_eff):
@@ -58,10 +130,13 @@ def scale_psf(sigi, lambda_eff):
 
 
 def multiband_gaussblur(image, rng_seed=None):
-    """
+    """Blur each band with a PSF whose width scales with wavelength as lambda^-0.3,
+    for a random i-band sigma in [0, 1) pixels
+
     Parameters
     ----------
     image: ndarray
+        6 band (ugrizy) HWC image
     rng_seed : np.random.Generator
         Random state that is seeded. if none, use machine entropy.
 
@@ -70,19 +145,15 @@ def multiband_gaussblur(image, rng_seed=None):
     augmented image
 
     """
-    if rng_seed is None:
-        rng_seed = np.random.default_rng()
-    imgs = np.zeros(image.shape, dtype=np.float32)
-    sigmai = random.random()
-    for i in range(6):
-        sigma = scale_psf(sigmai,LAMBDA_EFFS[i])
-        aug = iaa.GaussianBlur(sigma=sigma, seed=rng_seed)
-        imaug = aug.augment_image(image[:,:,i])
-        imgs[:,:,i] = imaug
-    return imgs
+    rng = np.random.default_rng(rng_seed)
+    sigmai = rng.random()
+    sigmas = scale_psf(sigmai, np.array(LAMBDA_EFFS[: image.shape[2]], dtype=np.float64))
+    return separable_blur(image, sigmas).astype(np.float32, copy=False)
+
 
 def addelementwise16(image, rng_seed=None):
-    """
+    """Add uniform noise in [-3276, 3276] to every pixel (for 16 bit images)
+
     Parameters
     ----------
     image: ndarray
@@ -94,14 +165,12 @@ def addelementwise16(image, rng_seed=None):
     augmented image
 
     """
-    if rng_seed is None:
-        rng_seed = np.random.default_rng()
-    aug = iaa.AddElementwise((-3276, 3276), seed=rng_seed)
-    return aug.augment_image(image)
+    return _add_uniform_noise(image, -3276, 3276, rng_seed)
 
 
 def addelementwise8(image, rng_seed=None):
-    """
+    """Add uniform noise in [-25, 25] to every pixel (for 8 bit images)
+
     Parameters
     ----------
     image: ndarray
@@ -113,14 +182,12 @@ def addelementwise8(image, rng_seed=None):
     augmented image
 
     """
-    if rng_seed is None:
-        rng_seed = np.random.default_rng()
-    aug = iaa.AddElementwise((-25, 25), seed=rng_seed)
-    return aug.augment_image(image)
+    return _add_uniform_noise(image, -25, 25, rng_seed)
 
 
 def addelementwise(image, rng_seed=None):
-    """
+    """Add uniform noise within 10% of the image maximum to every pixel
+
     Parameters
     ----------
     image: ndarray
@@ -132,10 +199,7 @@ def addelementwise(image, rng_seed=None):
     augmented image
 
     """
-    if rng_seed is None:
-        rng_seed = np.random.default_rng()
-    aug = iaa.AddElementwise((-image.max() * 0.1, image.max() * 0.1), seed=rng_seed)
-    return aug.augment_image(image)
+    return _add_uniform_noise(image, -image.max() * 0.1, image.max() * 0.1, rng_seed)
 
 
 def centercrop(image):
@@ -156,6 +220,28 @@ def centercrop(image):
     return image
 
 
+def dihedral_augs():
+    """The rotation and flips of the training augmentation lists, as exact dihedral transforms
+
+    They replace T.RandomRotation([-90, 90, 180], sample_style="choice"), T.RandomFlip(prob=0.5)
+    and T.RandomFlip(prob=0.5, horizontal=False, vertical=True) one for one, with the same
+    probabilities, so KRandomAugmentationList samples them as before: a rotation by 90, 180
+    or 270 degrees, a horizontal flip with probability 0.5 and a vertical flip with probability
+    0.5.  Only the interpolation of RandomRotation is gone.
+
+    Returns
+    -------
+    list[detectron_addons.RandomDihedral]
+        The rotation, horizontal flip and vertical flip (see deepdisc.data_format.dihedral)
+    """
+    return [
+        detectron_addons.RandomDihedral(variants=(1, 2, 3)),
+        detectron_addons.RandomDihedral(variants=(0, 4)),
+        # a vertical flip is a horizontal flip after a 180 degree rotation
+        detectron_addons.RandomDihedral(variants=(0, 6)),
+    ]
+
+
 def train_augs(image):
     """Get the augmentation list
 
@@ -167,15 +253,13 @@ def train_augs(image):
     Returns
     -------
     augs: detectron_addons.KRandomAugmentationList
-        The list of augs for training.  Set to RandomRotation, RandomFlip, RandomCrop
+        The list of augs for training.  Set to dihedral_augs (exact 90 degree rotations and flips), RandomCrop
     """
 
     augs = detectron_addons.KRandomAugmentationList(
         [
             # my custom augs
-            T.RandomRotation([-90, 90, 180], sample_style="choice"),
-            T.RandomFlip(prob=0.5),
-            T.RandomFlip(prob=0.5, horizontal=False, vertical=True),
+            *dihedral_augs(),
         ],
         k=-1,
         cropaug=T.RandomCrop("relative", (0.5, 0.5)),
@@ -194,15 +278,13 @@ def dc2_train_augs(image):
     Returns
     -------
     augs: detectron_addons.KRandomAugmentationList
-        The list of augs for training.  Set to RandomRotation, RandomFlip, RandomCrop
+        The list of augs for training.  Set to dihedral_augs (exact 90 degree rotations and flips), RandomCrop
     """
 
     augs = detectron_addons.KRandomAugmentationList(
         [
             # my custom augs
-            T.RandomRotation([-90, 90, 180], sample_style="choice"),
-            T.RandomFlip(prob=0.5),
-            T.RandomFlip(prob=0.5, horizontal=False, vertical=True),
+            *dihedral_augs(),
             #detectron_addons.CustomAug(multiband_gaussblur,prob=1.0),
             #detectron_addons.CustomAug(redden,prob=1.0),
 
@@ -226,15 +308,14 @@ def dc2_train_augs_full(image):
     Returns
     -------
     augs: detectron_addons.KRandomAugmentationList
-        The list of augs for training.  Set to RandomRotation, RandomFlip, RandomCrop
+        The list of augs for training.  Set to dihedral_augs (exact 90 degree rotations and flips),
+        multiband_gaussblur, redden
     """
 
     augs = detectron_addons.KRandomAugmentationList(
         [
             # my custom augs
-            T.RandomRotation([-90, 90, 180], sample_style="choice"),
-            T.RandomFlip(prob=0.5),
-            T.RandomFlip(prob=0.5, horizontal=False, vertical=True),
+            *dihedral_augs(),
             detectron_addons.CustomAug(multiband_gaussblur,prob=1.0),
             detectron_addons.CustomAug(redden,prob=1.0),
 
@@ -0,0 +1,288 @@
+"""Batch-level augmentations applied to collated image tensors after the data loader.
+
+The per-sample augmentations in augment_image run in NumPy inside the data loader workers.
+The augmentations here run on a whole batch at once, on the GPU if there is one, so their
+cost is amortised over the batch and the workers only read and map the data.  Images of
+the same shape are stacked into an (N, C, H, W) tensor, every augmentation draws its random
+parameters per sample, and the ground truth boxes and masks of the Instances are transformed
+to match.
+
+Example
+-------
+    augs = [BatchDihedral(), BatchMultibandBlur(), BatchRedden(), BatchUniformNoise(0.01)]
+    loader = BatchAugmentedLoader(return_train_loader(cfg, mapper), augs)
+"""
+
+import math
+
+import torch
+from detectron2.structures import BitMasks, Boxes, Instances, PolygonMasks
+from torch.nn import functional as F
+
+from deepdisc.data_format import dihedral
+
+# as in augment_image
+LAMBDA_EFFS = [3671, 4827, 6223, 7546, 8691, 9712]
+A_EBV = [4.81, 3.64, 2.70, 2.06, 1.58, 1.31]
+
+
+def _generator_on(generator, device):
+    """A generator on device seeded from the CPU generator, so random tensors are drawn where they are used"""
+    if generator is None or torch.device(device).type == "cpu":
+        return generator
+    seed = int(torch.randint(2**62, (1,), generator=generator))
+    return torch.Generator(device=device).manual_seed(seed)
+
+
+def _uniform(n, low, high, generator, device):
+    return low + (high - low) * torch.rand(n, generator=_generator_on(generator, device), device=device)
+
+
+class BatchDihedral:
+    """Random rotation by a multiple of 90 degrees and flip of each image, with exact box/mask remapping
+
+    Parameters
+    ----------
+    variants : list[int]
+        The dihedral variants to choose from (see deepdisc.data_format.dihedral), all 8 by default.
+        For non-square images only the variants that keep the shape (0, 2, 4, 6) are used,
+        so the batch can stay stacked.
+    """
+
+    def __init__(self, variants=tuple(range(dihedral.NUM_VARIANTS))):
+        self.variants = list(variants)
+
+    def __call__(self, images, batch, generator):
+        n, _, height, width = images.shape
+        variants = self.variants
+        if height != width:
+            variants = [v for v in variants if v % 2 == 0]
+        choice = torch.randint(len(variants), (n,), generator=generator)
+        out = torch.empty_like(images)
+        # one rotation/flip per variant for all the images that drew it
+        for c in choice.unique().tolist():
+            variant = variants[c]
+            idx = (choice == c).nonzero().flatten()
+            out[idx.to(images.device)] = _dihedral_tensor(images[idx.to(images.device)], variant)
+            for i in idx.tolist():
+                if "instances" in batch[i]:
+                    batch[i]["instances"] = _dihedral_instances(batch[i]["instances"], variant, height, width)
+        return out
+
+
+def _dihedral_tensor(x, variant):
+    """Apply a dihedral variant to the last two (H, W) dimensions of a tensor"""
+    k, flip = dihedral.variant_params(variant)
+    x = torch.rot90(x, k, dims=(-2, -1))
+    return x.flip(-1) if flip else x
+
+
+def _dihedral_boxes_tensor(boxes, variant, height, width):
+    """Apply a dihedral variant to an (N, 4) XYXY box tensor, as dihedral.dihedral_boxes"""
+    k, flip = dihedral.variant_params(variant)
+    x0, y0, x1, y1 = boxes.unbind(-1)
+    for _ in range(k):
+        # (x, y) -> (y, W - x)
+        x0, y0, x1, y1 = y0, width - x1, y1, width - x0
+        height, width = width, height
+    if flip:
+        x0, x1 = width - x1, width - x0
+    return torch.stack([x0, y0, x1, y1], dim=-1)
+
+
+def _dihedral_instances(instances, variant, height, width):
+    """Apply a dihedral variant to the boxes and masks of Instances of an image of the given shape"""
+    out = Instances(dihedral.transformed_shape(height, width, variant))
+    for name, value in instances.get_fields().items():
+        if isinstance(value, Boxes):
+            value = Boxes(_dihedral_boxes_tensor(value.tensor, variant, height, width))
+        elif isinstance(value, PolygonMasks):
+            value = PolygonMasks(
+                [
+                    [dihedral.dihedral_points(poly, variant, height, width).ravel() for poly in polygons]
+                    for polygons in value.polygons
+                ]
+            )
+        elif isinstance(value, BitMasks):
+            value = BitMasks(_dihedral_tensor(value.tensor, variant))
+        out.set(name, value)
+    return out
+
+
+def separable_blur_tensor(images, sigmas, truncate=4.0):
+    """Gaussian blur of each band of each image with its own sigma, as two depthwise convolutions
+
+    Parameters
+    ----------
+    images : torch.Tensor
+        (N, C, H, W) float images
+    sigmas : torch.Tensor
+        (N, C) standard deviations in pixels; 0 leaves the band unchanged
+    truncate : float
+        The kernels are cut at this many sigma
+
+    Returns
+    -------
+    torch.Tensor
+        The blurred images, with borders reflected as in augment_image.separable_blur
+    """
+    n, c, height, width = images.shape
+    radius = min(int(math.ceil(truncate * float(sigmas.max()))), height - 1, width - 1)
+    if radius <= 0:
+        return images
+    x = torch.arange(-radius, radius + 1, dtype=images.dtype, device=images.device)
+    sigmas = sigmas.to(images)[..., None]
+    kernels = torch.where(
+        sigmas > 0, torch.exp(-0.5 * (x / sigmas.clamp_min(1e-12)) ** 2), (x == 0).to(images.dtype)
+    )
+    kernels = (kernels / kernels.sum(-1, keepdim=True)).reshape(n * c, 1, -1)
+
+    out = images.reshape(1, n * c, height, width)
+    out = F.conv2d(F.pad(out, (0, 0, radius, radius), mode="reflect"), kernels[..., None], groups=n * c)
+    out = F.conv2d(F.pad(out, (radius, radius, 0, 0), mode="reflect"), kernels[:, :, None, :], groups=n * c)
+    return out.reshape(n, c, height, width)
+
+
+class BatchMultibandBlur:
+    """PSF-like blur with a random i-band sigma per image, scaled as lambda^-0.3 per band
+
+    Parameters
+    ----------
+    max_sigma : float
+        The i-band sigma is drawn uniformly from [0, max_sigma) pixels
+    lambda_effs : list[float]
+        Effective wavelength of each band (the first C are used for C band images)
+    """
+
+    def __init__(self, max_sigma=1.0, lambda_effs=LAMBDA_EFFS):
+        self.max_sigma = max_sigma
+        self.lambda_effs = lambda_effs
+
+    def __call__(self, images, batch, generator):
+        n, c = images.shape[:2]
+        sigma_i = _uniform(n, 0, self.max_sigma, generator, images.device)
+        # as augment_image.scale_psf
+        scale = torch.tensor(self.lambda_effs[:c], dtype=images.dtype, device=images.device) ** -0.3 / 7546**-0.3
+        return separable_blur_tensor(images, sigma_i[:, None] * scale[None, :])
+
+
+class BatchRedden:
+    """Dust reddening with a random E(B-V) per image
+
+    Parameters
+    ----------
+    max_ebv : float
+        E(B-V) is drawn uniformly from [0, max_ebv)
+    a_ebv : list[float]
+        The extinction per unit E(B-V) of each band
+    """
+
+    def __init__(self, max_ebv=0.5, a_ebv=A_EBV):
+        self.max_ebv = max_ebv
+        self.a_ebv = a_ebv
+
+    def __call__(self, images, batch, generator):
+        n, c = images.shape[:2]
+        ebv = _uniform(n, 0, self.max_ebv, generator, images.device)
+        a_ebv = torch.tensor(self.a_ebv[:c], dtype=images.dtype, device=images.device)
+        return images * (10.0 ** (-a_ebv[None, :] * ebv[:, None] / 2.5))[:, :, None, None]
+
+
+class BatchUniformNoise:
+    """Add uniform noise within a fraction of each image's maximum to every pixel
+
+    Parameters
+    ----------
+    fraction : float
+        The noise is drawn from [-fraction, fraction] times the image maximum
+    """
+
+    def __init__(self, fraction=0.1):
+        self.fraction = fraction
+
+    def __call__(self, images, batch, generator):
+        amplitude = self.fraction * images.flatten(1).amax(1)[:, None, None, None]
+        generator = _generator_on(generator, images.device)
+        noise = torch.rand(images.shape, generator=generator, device=images.device, dtype=images.dtype) * 2 - 1
+        return images + noise * amplitude
+
+
+def apply_batch_augmentations(batch, augs, device=None, generator=None):
+    """Apply batch augmentations to a list of mapped samples, in place
+
+    Parameters
+    ----------
+    batch : list[dict]
+        The samples from the train loader, with CHW "image" tensors and "instances"
+    augs : list[callable]
+        Batch augmentations, called as aug(images, samples, generator) with an
+        (N, C, H, W) float tensor, the samples of those images, and a CPU torch.Generator
+        (which seeds the draws of large random tensors on the images' device); they return
+        the augmented images and may update the samples' instances
+    device : str or torch.device
+        Where to run the augmentations; the images are left on this device
+    generator : torch.Generator
+        Random state for the augmentation parameters
+
+    Returns
+    -------
+    list[dict]
+        The batch
+    """
+    # stack images of the same shape
+    groups = {}
+    for i, sample in enumerate(batch):
+        groups.setdefault(tuple(sample["image"].shape), []).append(i)
+    for idx in groups.values():
+        samples = [batch[i] for i in idx]
+        dtype = samples[0]["image"].dtype
+        images = torch.stack([s["image"] for s in samples]).to(device=device, dtype=torch.float32)
+        for aug in augs:
+            images = aug(images, samples, generator)
+        if not dtype.is_floating_point:
+            info = torch.iinfo(dtype)
+            images = images.round().clamp(info.min, info.max)
+        images = images.to(dtype)
+        for s, image in zip(samples, images):
+            s["image"] = image
+            s["height"], s["width"] = image.shape[1:]
+            # the un-augmented HWC copy and the mapper's dihedral variant no longer match the image;
+            # without the variant, deepdisc.model.feature_cache does not cache the sample
+            s.pop("image_shaped", None)
+            s.pop("dihedral", None)
+    return batch
+
+
+class BatchAugmentedLoader:
+    """Wrap a data loader to apply batch augmentations to every batch it yields
+
+    Parameters
+    ----------
+    loader : iterable
+        The train loader, yielding lists of mapped samples
+    augs : list[callable]
+        The batch augmentations, see apply_batch_augmentations
+    device : str or torch.device
+        Where to run the augmentations. Default: cuda if available, else cpu
+    seed : int
+        Seed of the augmentation random state. Default: random
+    """
+
+    def __init__(self, loader, augs, device=None, seed=None):
+        self.loader = loader
+        self.augs = augs
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        self.generator = torch.Generator()
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+
+    def __iter__(self):
+        for batch in self.loader:
+            yield apply_batch_augmentations(batch, self.augs, self.device, self.generator)
+
+    def __len__(self):
+        return len(self.loader)
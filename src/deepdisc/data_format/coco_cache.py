@@ -0,0 +1,289 @@
+"""A binary, pre-indexed cache of COCO format ground truth.
+
+The cache stores the images and annotations of a COCO dict as flat numpy arrays
+(boxes, areas, categories, crowd/ignore flags, magnitudes and compressed RLE masks,
+sorted by image) in a single .npz file.  Loading it avoids parsing a large json
+file and building the pycocotools indices annotation by annotation.  The file name
+contains a key of the dataset (the path, size and modification time of the file it is
+registered from, see file_key, or a hash of its content), so a cache built from
+different data is never picked up by mistake.
+"""
+
+import contextlib
+import gc
+import hashlib
+import json
+import os
+import pickle
+from collections import defaultdict
+
+import numpy as np
+
+# Increase when the cache layout changes, so old caches are rebuilt
+CACHE_VERSION = 1
+
+
+def content_hash(*objs):
+    """Return a sha256 hex digest of python objects (e.g. dataset dicts and options)
+
+    The objects are pickled; objects that cannot be pickled are hashed through their json/repr form.
+    """
+    h = hashlib.sha256()
+    h.update(str(CACHE_VERSION).encode())
+    for obj in objs:
+        try:
+            data = pickle.dumps(obj, protocol=4)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            data = json.dumps(obj, sort_keys=True, default=repr).encode()
+        h.update(data)
+    return h.hexdigest()
+
+
+def file_key(filename, *objs):
+    """Return a sha256 hex digest of a file's path, size and modification time, and of objs
+
+    Unlike content_hash of the loaded dataset, this does not read the file, so checking
+    for a cache is cheap.  Rewriting the file changes its modification time, and so the key.
+    """
+    stat = os.stat(filename)
+    return content_hash(os.path.abspath(filename), stat.st_size, stat.st_mtime_ns, *objs)
+
+
+@contextlib.contextmanager
+def _gc_paused():
+    """Pause the cyclic garbage collector, which otherwise runs repeatedly (and finds
+    nothing) while hundreds of thousands of annotation dicts are created"""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def segmentation_to_rle(segmentation, height, width):
+    """Convert a polygon list or uncompressed RLE to json-serializable compressed RLE
+
+    This is the same conversion pycocotools (COCO.annToRLE) applies to every ground
+    truth mask each time a segmentation evaluation is run.
+    """
+    import pycocotools.mask as mask_util
+
+    if isinstance(segmentation, list):
+        rle = mask_util.merge(mask_util.frPyObjects(segmentation, height, width))
+    elif isinstance(segmentation["counts"], list):
+        rle = mask_util.frPyObjects(segmentation, height, width)
+    else:
+        rle = dict(segmentation)
+    if not isinstance(rle["counts"], str):
+        rle["counts"] = rle["counts"].decode("ascii")
+    return rle
+
+
+class COCOGroundTruthCache:
+    """COCO ground truth stored as arrays, indexed by image
+
+    Parameters
+    ----------
+    arrays : dict
+        The arrays, as produced by from_coco_dict or loaded by load
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    @classmethod
+    def from_coco_dict(cls, coco_dict):
+        """Build the cache from a COCO format dict, e.g. from astrodet.convert_to_coco_dict
+
+        Polygon segmentations are converted to compressed RLE.
+        """
+        images = coco_dict["images"]
+        anns = coco_dict.get("annotations", [])
+        if any("keypoints" in ann for ann in anns):
+            raise ValueError("Keypoint annotations are not supported by the ground truth cache.")
+
+        img_index = {img["id"]: i for i, img in enumerate(images)}
+        order = sorted(range(len(anns)), key=lambda j: img_index[anns[j]["image_id"]])
+        anns = [anns[j] for j in order]
+        counts_per_image = np.bincount([img_index[a["image_id"]] for a in anns], minlength=len(images))
+
+        rles = []
+        for ann in anns:
+            if "segmentation" in ann:
+                img = images[img_index[ann["image_id"]]]
+                rle = segmentation_to_rle(ann["segmentation"], img["height"], img["width"])
+                rles.append(rle["counts"].encode("ascii"))
+            else:
+                rles.append(b"")
+        rle_lengths = np.array([len(r) for r in rles], dtype=np.int64)
+
+        arrays = {
+            "img_ids": np.array([img["id"] for img in images], dtype=np.int64),
+            "img_heights": np.array([img["height"] for img in images], dtype=np.int64),
+            "img_widths": np.array([img["width"] for img in images], dtype=np.int64),
+            "img_file_names": np.array([img.get("file_name", "") for img in images], dtype=str),
+            "ann_offsets": np.concatenate([[0], np.cumsum(counts_per_image)]).astype(np.int64),
+            "ann_ids": np.array([a["id"] for a in anns], dtype=np.int64),
+            "bboxes": np.array([a["bbox"] for a in anns], dtype=np.float64).reshape(-1, 4),
+            "areas": np.array([a["area"] for a in anns], dtype=np.float64),
+            "category_ids": np.array([a["category_id"] for a in anns], dtype=np.int64),
+            "iscrowd": np.array([a.get("iscrowd", 0) for a in anns], dtype=np.int8),
+            "ignore": np.array([a.get("ignore", 0) for a in anns], dtype=np.int8),
+            "imag": np.array([a.get("imag", np.nan) for a in anns], dtype=np.float64),
+            "has_segmentation": np.array(["segmentation" in a for a in anns], dtype=bool),
+            "rle_offsets": np.concatenate([[0], np.cumsum(rle_lengths)]).astype(np.int64),
+            "rle_counts": np.frombuffer(b"".join(rles), dtype=np.uint8),
+            "categories": np.array(json.dumps(coco_dict["categories"])),
+        }
+        return cls(arrays)
+
+    def save(self, filename):
+        """Write the cache to an .npz file, atomically"""
+        tmp_file = filename + ".tmp.npz"
+        np.savez(tmp_file, **self.arrays)
+        os.replace(tmp_file, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Read a cache written by save"""
+        with np.load(filename, allow_pickle=False) as f:
+            arrays = {k: f[k] for k in f.files}
+        return cls(arrays)
+
+    def _images(self):
+        a = self.arrays
+        return [
+            {"id": img_id, "height": h, "width": w, "file_name": fn}
+            for img_id, h, w, fn in zip(
+                a["img_ids"].tolist(),
+                a["img_heights"].tolist(),
+                a["img_widths"].tolist(),
+                a["img_file_names"].tolist(),
+            )
+        ]
+
+    def _annotations(self):
+        """All annotations as COCO dicts, grouped by image in the order of the images"""
+        a = self.arrays
+        counts = np.diff(a["ann_offsets"])
+        rle_counts = a["rle_counts"].tobytes()
+        with _gc_paused():
+            heights, widths = np.repeat(a["img_heights"], counts), np.repeat(a["img_widths"], counts)
+            sizes = np.stack([heights, widths], axis=1).tolist()
+            rle_offsets = a["rle_offsets"].tolist()
+            columns = zip(
+                a["ann_ids"].tolist(),
+                np.repeat(a["img_ids"], counts).tolist(),
+                a["category_ids"].tolist(),
+                a["bboxes"].tolist(),
+                a["areas"].tolist(),
+                a["iscrowd"].tolist(),
+                a["ignore"].tolist(),
+                a["imag"].tolist(),
+                a["has_segmentation"].tolist(),
+            )
+            anns = []
+            for j, column in enumerate(columns):
+                ann_id, image_id, category_id, bbox, area, iscrowd, ignore, imag, has_seg = column
+                ann = {
+                    "id": ann_id,
+                    "image_id": image_id,
+                    "category_id": category_id,
+                    "bbox": bbox,
+                    "area": area,
+                    "iscrowd": iscrowd,
+                    "ignore": ignore,
+                }
+                if imag == imag:  # not nan
+                    ann["imag"] = imag
+                if has_seg:
+                    counts = rle_counts[rle_offsets[j] : rle_offsets[j + 1]].decode("ascii")
+                    ann["segmentation"] = {"size": sizes[j], "counts": counts}
+                anns.append(ann)
+        return anns
+
+    def to_coco_dict(self):
+        """The cached ground truth as a COCO format dict"""
+        annotations = self._annotations()
+        coco_dict = {"images": self._images(), "categories": json.loads(str(self.arrays["categories"]))}
+        if len(annotations) > 0:
+            coco_dict["annotations"] = annotations
+        return coco_dict
+
+    def to_coco(self):
+        """The cached ground truth as an indexed pycocotools COCO object
+
+        The indices of COCO.createIndex are built from the arrays, which are already
+        grouped by image, instead of by looping over the annotations again.
+        """
+        from pycocotools.coco import COCO
+
+        a = self.arrays
+        offsets = a["ann_offsets"].tolist()
+        # the image id of each annotation
+        ann_img_ids = np.repeat(a["img_ids"], np.diff(a["ann_offsets"]))
+        with _gc_paused():
+            coco_dict = self.to_coco_dict()
+            annotations = coco_dict.get("annotations", [])
+            coco = COCO()
+            coco.dataset = coco_dict
+            coco.imgs = {img["id"]: img for img in coco_dict["images"]}
+            coco.cats = {cat["id"]: cat for cat in coco_dict["categories"]}
+            coco.anns = {ann["id"]: ann for ann in annotations}
+            coco.imgToAnns = defaultdict(
+                list,
+                {
+                    img_id: annotations[start:end]
+                    for img_id, start, end in zip(a["img_ids"].tolist(), offsets[:-1], offsets[1:])
+                    if end > start
+                },
+            )
+            # one entry per annotation, as in createIndex
+            coco.catToImgs = defaultdict(
+                list,
+                {
+                    int(cat_id): ann_img_ids[a["category_ids"] == cat_id].tolist()
+                    for cat_id in np.unique(a["category_ids"])
+                },
+            )
+        return coco
+
+
+def cache_filename(cache_dir, dataset_name, key):
+    """The cache file for a dataset with key `key`, see file_key and content_hash"""
+    return os.path.join(cache_dir, f"{dataset_name}_coco_gt_{key[:16]}.npz")
+
+
+def load_or_build(cache_dir, dataset_name, key, build_coco_dict, allow_cached=True):
+    """Return the ground truth cache of a dataset, building and saving it if needed
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory holding the cache files
+    dataset_name : str
+        Name of the dataset, used in the file name
+    key : str
+        Key of everything the ground truth depends on, see file_key and content_hash
+    build_coco_dict : function
+        Called without arguments to produce the COCO dict if there is no valid cache
+    allow_cached : bool
+        If False, always rebuild the cache
+
+    Returns
+    -------
+    COCOGroundTruthCache
+    """
+    filename = cache_filename(cache_dir, dataset_name, key)
+    if allow_cached and os.path.exists(filename):
+        try:
+            return COCOGroundTruthCache.load(filename)
+        except (OSError, ValueError, KeyError):
+            # a truncated or outdated file, rebuild it
+            pass
+    cache = COCOGroundTruthCache.from_coco_dict(build_coco_dict())
+    os.makedirs(cache_dir, exist_ok=True)
+    cache.save(filename)
+    return cache
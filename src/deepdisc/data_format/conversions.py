@@ -1,12 +1,12 @@
+import json
 import os
+import shutil
 
-import astropy.io.fits as fits
-import h5py
 import numpy as np
-import scarlet
-from detectron2.utils.file_io import PathManager
-from iopath.common.file_io import file_lock
-import os, json, shutil
+
+# astropy, h5py and detectron2 are imported in the functions that use them, so that
+# importing this module (e.g. in data loader workers) stays cheap
+
 
 def fitsim_to_numpy(img_files, outdir):
     """Converts a list of single-band FITS images to multi-band numpy arrays
@@ -21,6 +21,7 @@ def fitsim_to_numpy(img_files, outdir):
 
 
     """
+    import astropy.io.fits as fits
 
     for images in img_files:
         full_im = []
@@ -51,6 +52,9 @@ def fitsim_to_hdf5(img_files, outname, dset="train"):
     
 
     """
+    import astropy.io.fits as fits
+    import h5py
+
     all_images = []
     for images in img_files:
         full_im = []
@@ -79,7 +83,8 @@ def ddict_to_hdf5(dataset_dicts, outname):
     outname: str
         The name of the output file
     """
-    
+    import h5py
+
     with h5py.File(outname, 'w') as file:
         data = [json.dumps(this_dict) for this_dict in dataset_dicts]
         dt = h5py.special_dtype(vlen=str)
@@ -101,6 +106,8 @@ def numpyim_to_hdf5(img_files, outname):
     
 
     """
+    import h5py
+
     all_images = []
     for img_file in img_files:
         full_im = np.load(img_file)
@@ -125,6 +132,8 @@ def convert_to_json(dict_list, output_file, allow_cached=True):
         output_file: path of json file that will be saved to
         allow_cached: if json file is already present then skip conversion
     """
+    from detectron2.utils.file_io import PathManager
+    from iopath.common.file_io import file_lock
 
     PathManager.mkdirs(os.path.dirname(output_file))
     with file_lock(output_file):
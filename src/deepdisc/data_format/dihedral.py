@@ -0,0 +1,267 @@
+"""Exact rotations by multiples of 90 degrees and flips (the dihedral group D4) of images and annotations.
+
+Variant v of an image is np.rot90 applied k = v % 4 times (counter-clockwise as displayed
+with origin="upper"), followed by a horizontal flip if v >= 4.  The eight variants cover
+every combination of the 90/180/270 degree rotations and horizontal/vertical flips used by
+the training augmentations, without interpolation.
+
+In pixel coordinates (x along columns, y along rows, pixel edges at integers) one rotation
+of an image of width W maps (x, y) -> (y, W - x), and a flip of an image of width W' maps
+x -> W' - x, so boxes and polygons are remapped exactly.
+
+The variants of a dataset can also be precomputed with materialize_dihedral_variants and
+sampled with DihedralVariantSampler, so the data mapper only reads a file.
+"""
+
+import copy
+import itertools
+import json
+import os
+from collections import defaultdict
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+NUM_VARIANTS = 8
+
+# detectron2.structures.BoxMode values, so this module does not need detectron2
+_XYXY_ABS = 0
+_XYWH_ABS = 1
+
+
+def variant_params(variant):
+    """Return (number of counter-clockwise quarter turns, horizontal flip) of a variant index"""
+    if not 0 <= variant < NUM_VARIANTS:
+        raise ValueError(f"Dihedral variant must be in [0, {NUM_VARIANTS}), got {variant}")
+    return variant % 4, variant >= 4
+
+
+def transformed_shape(height, width, variant):
+    """The (height, width) of an image of the given shape after applying a variant"""
+    k, _ = variant_params(variant)
+    return (width, height) if k % 2 else (height, width)
+
+
+def dihedral_image(image, variant):
+    """Apply a variant to an HWC (or HW) image
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The image, with the spatial axes first
+    variant : int
+        The variant index in [0, 8)
+
+    Returns
+    -------
+    np.ndarray
+        A view of the transformed image (use np.ascontiguousarray to copy)
+    """
+    k, flip = variant_params(variant)
+    image = np.rot90(image, k, axes=(0, 1))
+    if flip:
+        image = image[:, ::-1]
+    return image
+
+
+def compose(first, second):
+    """The variant equal to applying variant `first` and then variant `second`"""
+    # a non-square probe with distinct values tells all 8 variants apart
+    probe = np.arange(6).reshape(2, 3)
+    result = dihedral_image(dihedral_image(probe, first), second)
+    for variant in range(NUM_VARIANTS):
+        candidate = dihedral_image(probe, variant)
+        if candidate.shape == result.shape and np.array_equal(candidate, result):
+            return variant
+
+
+def dihedral_points(points, variant, height, width):
+    """Apply a variant to (x, y) pixel coordinates
+
+    Parameters
+    ----------
+    points : array-like
+        Coordinates of shape (N, 2)
+    variant : int
+        The variant index in [0, 8)
+    height, width : int
+        The shape of the image before the transform
+
+    Returns
+    -------
+    np.ndarray
+        The transformed coordinates, shape (N, 2)
+    """
+    k, flip = variant_params(variant)
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    x, y = points[:, 0], points[:, 1]
+    for _ in range(k):
+        x, y = y, width - x
+        height, width = width, height
+    if flip:
+        x = width - x
+    return np.stack([x, y], axis=1)
+
+
+def dihedral_boxes(boxes, variant, height, width):
+    """Apply a variant to XYXY boxes of shape (N, 4); the result is again XYXY"""
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    corners = dihedral_points(boxes.reshape(-1, 2), variant, height, width).reshape(-1, 2, 2)
+    return np.concatenate([corners.min(axis=1), corners.max(axis=1)], axis=1)
+
+
+def dihedral_annotation(annotation, variant, height, width):
+    """Apply a variant to a detectron2 annotation dict (bbox and polygon segmentation)
+
+    Parameters
+    ----------
+    annotation : dict
+        An annotation with "bbox" in XYXY_ABS or XYWH_ABS "bbox_mode" and
+        optionally a "segmentation" as a list of polygons
+    variant : int
+        The variant index in [0, 8)
+    height, width : int
+        The shape of the image before the transform
+
+    Returns
+    -------
+    dict
+        A transformed copy of the annotation, with the same bbox_mode
+    """
+    annotation = copy.deepcopy(annotation)
+    bbox = np.asarray(annotation["bbox"], dtype=np.float64)
+    mode = int(annotation.get("bbox_mode", _XYWH_ABS))
+    if mode == _XYWH_ABS:
+        bbox = np.concatenate([bbox[:2], bbox[:2] + bbox[2:]])
+    elif mode != _XYXY_ABS:
+        raise ValueError(f"Unsupported bbox_mode {mode} for dihedral transforms")
+    bbox = dihedral_boxes(bbox, variant, height, width)[0]
+    if mode == _XYWH_ABS:
+        bbox = np.concatenate([bbox[:2], bbox[2:] - bbox[:2]])
+    annotation["bbox"] = bbox.tolist()
+
+    segmentation = annotation.get("segmentation")
+    if isinstance(segmentation, list):
+        annotation["segmentation"] = [
+            dihedral_points(poly, variant, height, width).ravel().tolist() for poly in segmentation
+        ]
+    elif segmentation is not None:
+        raise ValueError("Only polygon segmentations are supported by dihedral transforms")
+    return annotation
+
+
+def dihedral_dataset_dict(dataset_dict, variant):
+    """Apply a variant to the annotations and image shape of a dataset dict (the image is not read)"""
+    height, width = dataset_dict["height"], dataset_dict["width"]
+    dataset_dict = copy.copy(dataset_dict)
+    dataset_dict["annotations"] = [
+        dihedral_annotation(a, variant, height, width) for a in dataset_dict.get("annotations", [])
+    ]
+    dataset_dict["height"], dataset_dict["width"] = transformed_shape(height, width, variant)
+    return dataset_dict
+
+
+def materialize_dihedral_variants(
+    dataset_dicts, imreader, key_mapper, output_dir, variants=range(NUM_VARIANTS), json_file=None
+):
+    """Precompute the dihedral variants of the images and annotations of a dataset
+
+    Each variant image is the unscaled output of imreader.read, saved as a channels-first
+    .npy file like the DC2 and Roman images, so it can be read back with DC2ImageReader or
+    RomanImageReader and key_mapper = lambda d: d["filename"].  Contrast scaling is still
+    applied when the variant is loaded.
+
+    Parameters
+    ----------
+    dataset_dicts : list[dict]
+        The dataset dicts, with "image_id", "height", "width" and polygon "annotations"
+    imreader : ImageReader
+        Reads the original images
+    key_mapper : function
+        Gives the imreader key of a dataset dict
+    output_dir : str
+        Directory for the variant images
+    variants : iterable of int
+        The variants to materialise, all 8 by default
+    json_file : str
+        If given, also save the variant dataset dicts to this json file
+
+    Returns
+    -------
+    list[dict]
+        One dataset dict per image and variant, with "filename" pointing to the variant image,
+        "dihedral" the variant index and "dihedral_source" the index of the original dict
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    variant_dicts = []
+    for source, dataset_dict in enumerate(dataset_dicts):
+        image = imreader.read(key_mapper(dataset_dict))
+        for variant in variants:
+            filename = os.path.join(output_dir, f"{dataset_dict['image_id']}_d{variant}.npy")
+            np.save(filename, np.ascontiguousarray(dihedral_image(image, variant).transpose(2, 0, 1)))
+            variant_dict = dihedral_dataset_dict(dataset_dict, variant)
+            variant_dict.update(filename=filename, dihedral=variant, dihedral_source=source)
+            variant_dicts.append(variant_dict)
+
+    if json_file is not None:
+        with open(json_file, "w") as f:
+            json.dump(variant_dicts, f, default=_to_json)
+    return variant_dicts
+
+
+def _to_json(obj):
+    # numpy scalars and arrays in the dataset dicts
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class DihedralVariantSampler(Sampler):
+    """Infinite training sampler over materialised dihedral variants
+
+    Every pass visits each original image once, in random order, and yields the dataset
+    index of one of its variants chosen at random, which replaces the random rotations and
+    flips of the augmentations.  Like detectron2's TrainingSampler, each rank yields an
+    interleaved share of the indices.
+    """
+
+    def __init__(self, dataset_dicts, shuffle=True, seed=None):
+        """
+        Parameters
+        ----------
+        dataset_dicts : list[dict]
+            The output of materialize_dihedral_variants
+        shuffle : bool
+            Shuffle the order of the original images in every pass
+        seed : int
+            The random seed, which must be the same on all ranks.
+            Default: a seed shared by all ranks
+        """
+        groups = defaultdict(list)
+        for i, d in enumerate(dataset_dicts):
+            groups[d["dihedral_source"]].append(i)
+        self._groups = list(groups.values())
+        self._shuffle = shuffle
+        if seed is None:
+            from detectron2.utils import comm
+
+            seed = comm.shared_random_seed()
+        self._seed = int(seed)
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            self._rank, self._world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+        else:
+            self._rank, self._world_size = 0, 1
+
+    def __iter__(self):
+        yield from itertools.islice(self._infinite_indices(), self._rank, None, self._world_size)
+
+    def _infinite_indices(self):
+        rng = np.random.default_rng(self._seed)
+        while True:
+            order = rng.permutation(len(self._groups)) if self._shuffle else range(len(self._groups))
+            for g in order:
+                group = self._groups[g]
+                yield group[rng.integers(len(group))]
@@ -2,8 +2,6 @@ import abc
 import os
 
 import numpy as np
-from astropy.io import fits
-from astropy.visualization import make_lupton_rgb
 
 
 class ImageReader(abc.ABC):
@@ -43,8 +41,8 @@ class ImageReader(abc.ABC):
         """
         pass
 
-    def __call__(self, image):
-        """Read the image and apply scaling.
+    def read(self, image):
+        """Read the image without applying any scaling.
 
         Parameters
         ----------
@@ -54,7 +52,7 @@ class ImageReader(abc.ABC):
         Returns
         -------
         im : numpy array
-            The image.
+            The unscaled image with dimensions (h, w, band).
         """
         if isinstance(image, str) or all(isinstance(s, str) for s in image):
             im = self._read_image(image)
@@ -62,8 +60,37 @@ class ImageReader(abc.ABC):
             im = np.transpose(image, axes=(1, 2, 0)).astype(np.float32)
         else:
             raise ValueError("Input must be a string or a numpy array.")
-        im_scale = self.scaling(im, **self.scalekwargs)
-        return im_scale
+        return im
+
+    def scale(self, im):
+        """Apply the contrast scaling to an image returned by read().
+
+        Parameters
+        ----------
+        im : numpy array
+            The image with dimensions (h, w, band).
+
+        Returns
+        -------
+        im : numpy array
+            The scaled image.
+        """
+        return self.scaling(im, **self.scalekwargs)
+
+    def __call__(self, image):
+        """Read the image and apply scaling.
+
+        Parameters
+        ----------
+        image : str or numpy array
+            The path indicating the image to read or image data in a numpy array with dimensions (band, h, w).
+
+        Returns
+        -------
+        im : numpy array
+            The image.
+        """
+        return self.scale(self.read(image))
 
     def raw(im):
         """Apply raw image scaling (no scaling done).
@@ -106,6 +133,8 @@ class ImageReader(abc.ABC):
         b2 = im[:, :, bandlist[1]]
         b3 = im[:, :, bandlist[2]]
 
+        from astropy.visualization import make_lupton_rgb
+
         return make_lupton_rgb(b1, b2, b3, minimum=m, stretch=stretch, Q=Q)
 
     def zscore(im, A=1., m=0.0):
@@ -203,6 +232,7 @@ class HSCImageReader(ImageReader):
         """
         if len(filenames) != 3:
             raise ValueError("Incorrect number of filenames passed.")
+        from astropy.io import fits
 
         g = fits.getdata(os.path.join(filenames[0]), memmap=False)
         length, width = g.shape
@@ -34,7 +34,8 @@ def register_data_set(data_set_name, filename, load_func=get_data_from_json, **k
         raise FileNotFoundError(f"Unable to load data set file {filename}")
 
     DatasetCatalog.register(data_set_name, lambda: load_func(filename))
-    MetadataCatalog.get(data_set_name).set(**kwargs)
+    # the ground truth cache (astrodet.load_coco_gt_cache) is keyed by this file
+    MetadataCatalog.get(data_set_name).set(dataset_file=str(filename), **kwargs)
     meta = MetadataCatalog.get(data_set_name)
 
     return meta
@@ -0,0 +1,174 @@
+"""A weights-only inference checkpoint format that loads fast and is shared between workers.
+
+A training checkpoint is read with DetectionCheckpointer, which unpickles the whole file
+(with the optimizer and scheduler state for .pth files) into each process, after the model
+was built and randomly initialised.  Launching many inference workers repeats all of that
+in every one of them.
+
+save_inference_checkpoint writes only the weights of a loaded model, optionally in float16,
+in torch's zip format.  build_inference_model then
+
+    - builds the model on the meta device, so no memory is allocated or initialised,
+    - memory-maps the checkpoint (torch.load(mmap=True, weights_only=True)), and
+    - assigns the mapped tensors to the model (load_state_dict(assign=True)).
+
+On CPU the weights of a float32 checkpoint are then backed by the page cache of the file,
+so every worker that maps the same file shares one copy of them and only the pages that are
+read are loaded.  Float16 checkpoints are half the size to read, but their weights are cast
+back to float32 in each worker.
+
+Example
+-------
+    save_inference_checkpoint(AstroPredictor(cfg).model, "swin_dc2_inference.pt")
+    predictor = AstroPredictor(cfg, inference_checkpoint="swin_dc2_inference.pt")
+"""
+
+import torch
+from torch.nn.parallel import DistributedDataParallel
+
+from deepdisc.model.feature_cache import FeatureCacheRCNN
+
+FORMAT_VERSION = 1
+
+
+def _unwrap(model):
+    if isinstance(model, DistributedDataParallel):
+        model = model.module
+    if isinstance(model, FeatureCacheRCNN):
+        model = model.model
+    return model
+
+
+def _non_persistent_buffers(model):
+    """The buffers of a model that are not in its state_dict, e.g. the pixel mean and std"""
+    state_dict_keys = set(model.state_dict().keys())
+    return {name: buf for name, buf in model.named_buffers() if name not in state_dict_keys}
+
+
+def save_inference_checkpoint(model, path, half=False):
+    """Save the weights of a model for build_inference_model
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        The model with its trained weights loaded, e.g. AstroPredictor(cfg).model
+    path : str
+        The file to write
+    half : bool
+        Store the floating point parameters in float16.  The buffers stay in full precision
+    """
+    model = _unwrap(model)
+    parameters = {name for name, _ in model.named_parameters()}
+    state_dict = {}
+    for name, value in model.state_dict().items():
+        value = value.detach().to("cpu")
+        if half and name in parameters and value.is_floating_point():
+            value = value.half()
+        # a contiguous tensor with its own storage, so it is mapped on its own at load time
+        state_dict[name] = value.contiguous().clone()
+    buffers = {name: buf.detach().to("cpu").clone() for name, buf in _non_persistent_buffers(model).items()}
+    meta = {"version": FORMAT_VERSION, "half": half}
+    torch.save({"model": state_dict, "buffers": buffers, "meta": meta}, path)
+
+
+def load_inference_checkpoint(path, mmap=True):
+    """Read an inference checkpoint
+
+    Parameters
+    ----------
+    path : str
+        A file from save_inference_checkpoint
+    mmap : bool
+        Memory-map the file instead of reading it
+
+    Returns
+    -------
+    dict
+        "model" (the state_dict), "buffers" (the non-persistent buffers) and "meta"
+    """
+    checkpoint = torch.load(path, map_location="cpu", mmap=mmap, weights_only=True)
+    if not isinstance(checkpoint, dict) or checkpoint.get("meta", {}).get("version") != FORMAT_VERSION:
+        raise ValueError(f"{path} is not a deepdisc inference checkpoint (see save_inference_checkpoint)")
+    return checkpoint
+
+
+def _restore_dtypes(tensors, model_tensors):
+    """Cast the tensors of a float16 checkpoint back to the dtypes of the model"""
+    for name, value in tensors.items():
+        target = model_tensors.get(name)
+        if target is not None and value.dtype != target.dtype:
+            tensors[name] = value.to(target.dtype)
+    return tensors
+
+
+def _meta_tensors(model):
+    """Names of the tensors of a model (including plain tensor attributes) left on the meta device"""
+    names = [name for name, t in list(model.named_parameters()) + list(model.named_buffers()) if t.is_meta]
+    for module_name, module in model.named_modules():
+        for attr, value in vars(module).items():
+            if torch.is_tensor(value) and value.is_meta:
+                names.append(f"{module_name}.{attr}" if module_name else attr)
+    return names
+
+
+def load_inference_weights(model, path, mmap=True):
+    """Load an inference checkpoint into a built model
+
+    The tensors are assigned to the model, and so stay memory-mapped, when the model is on
+    the CPU and has the dtypes of the checkpoint; otherwise they are copied into it.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        The model, built from the config the checkpoint was saved from
+    path : str
+        A file from save_inference_checkpoint
+    mmap : bool
+        Memory-map the file instead of reading it
+
+    Returns
+    -------
+    torch.nn.Module
+        The model with the weights loaded
+    """
+    model = _unwrap(model)
+    checkpoint = load_inference_checkpoint(path, mmap=mmap)
+    state_dict = _restore_dtypes(checkpoint["model"], model.state_dict())
+    on_cpu = all(t.device.type in ("cpu", "meta") for t in model.state_dict().values())
+    model.load_state_dict(state_dict, assign=on_cpu)
+    for name, value in checkpoint["buffers"].items():
+        module_name, _, buffer_name = name.rpartition(".")
+        module = model.get_submodule(module_name)
+        target = module._buffers[buffer_name]
+        # a model built on the meta device is moved later; otherwise keep the buffer where the model is
+        device = "cpu" if target.is_meta else target.device
+        module._buffers[buffer_name] = value.to(device=device, dtype=target.dtype)
+    return model
+
+
+def build_inference_model(build, path, device="cpu", mmap=True):
+    """Build a model and load an inference checkpoint into it, without initialising its weights
+
+    Parameters
+    ----------
+    build : callable
+        Returns the model, e.g. lambda: instantiate(cfg.model)
+    path : str
+        A file from save_inference_checkpoint
+    device : str
+        Where to put the model.  The weights are only shared between processes on the CPU
+    mmap : bool
+        Memory-map the file instead of reading it
+
+    Returns
+    -------
+    torch.nn.Module
+        The model in eval mode
+    """
+    with torch.device("meta"):
+        model = build()
+    load_inference_weights(model, path, mmap=mmap)
+    if _meta_tensors(model):
+        # the model keeps tensors that are neither weights nor buffers; build it normally
+        model = load_inference_weights(build(), path, mmap=mmap)
+    return model.to(device).eval()
@@ -0,0 +1,65 @@
+"""Run fewer cascade stages, and optionally no mask head, at inference.
+
+The cascade heads (the redshift PDF and point cascade heads of deepdisc.model.models)
+refine the boxes through all of their box_predictors, three in the DC2/HSC configs, and
+average the class scores over the stages.  For quick-look runs the later stages and the
+mask head can be dropped: set_cascade_depth(model, k) makes the heads stop after the first
+k stages, averaging the scores of those k stages and passing the boxes of stage k to the
+mask and redshift heads.  The weights are untouched, so the full depth is restored with
+set_cascade_depth(model).
+
+This is an inference setting; train with the full depth.  See
+deepdisc.benchmarks.cascade_depth for the latency/AP tradeoff of each depth.
+"""
+
+from torch import nn
+from torch.nn.parallel import DistributedDataParallel
+
+from deepdisc.model.feature_cache import FeatureCacheRCNN
+
+
+def _roi_heads(model):
+    if isinstance(model, DistributedDataParallel):
+        model = model.module
+    if isinstance(model, FeatureCacheRCNN):
+        model = model.model
+    return getattr(model, "roi_heads", model)
+
+
+def set_cascade_depth(model, num_stages=None, mask=True):
+    """Set the number of cascade stages, and whether masks are predicted, at inference
+
+    Parameters
+    ----------
+    model : GeneralizedRCNN or ROIHeads
+        The model (e.g. predictor.model), or its ROI heads
+    num_stages : int
+        Run only the first num_stages cascade stages.  None for all of them
+    mask : bool
+        Predict masks, if the heads have a mask head
+
+    Returns
+    -------
+    model
+        The same model, modified in place
+    """
+    roi_heads = _roi_heads(model)
+    if num_stages is not None:
+        if not isinstance(roi_heads.box_predictor, nn.ModuleList):
+            raise ValueError(f"{type(roi_heads).__name__} is not a cascade head; it has a single stage")
+        n_trained = len(roi_heads.box_predictor)
+        if not 1 <= num_stages <= n_trained:
+            raise ValueError(f"num_stages must be between 1 and {n_trained}, got {num_stages}")
+        # CascadeROIHeads loops over, and averages the scores of, num_cascade_stages stages
+        roi_heads.num_cascade_stages = num_stages
+    elif isinstance(roi_heads.box_predictor, nn.ModuleList):
+        roi_heads.num_cascade_stages = len(roi_heads.box_predictor)
+    # StandardROIHeads._forward_mask returns the instances unchanged when mask_on is False
+    roi_heads.mask_on = mask and hasattr(roi_heads, "mask_head")
+    return model
+
+
+def cascade_depth(model):
+    """The (number of cascade stages, mask) setting of a model, see set_cascade_depth"""
+    roi_heads = _roi_heads(model)
+    return getattr(roi_heads, "num_cascade_stages", 1), roi_heads.mask_on
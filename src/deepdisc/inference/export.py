@@ -0,0 +1,159 @@
+"""Export a trained model as a traced TorchScript artifact, and a predictor that runs it.
+
+AstroPredictor builds the eager detectron2 model from the config and loads the checkpoint
+in every process, then runs it with the full Python overhead of the detectron2 modules.
+export_model traces the inference of the model (backbone, RPN, cascade and redshift heads)
+on a sample image with detectron2's TracingAdapter and saves a single TorchScript file,
+with the output schema and the input format stored inside it.  ExportedAstroPredictor
+loads that file without detectron2's model zoo, the config or the checkpoint, and is
+called like AstroPredictor.
+
+The graph is traced for single images.  detectron2's modules are written so that the
+image size and the number of detections stay dynamic in a trace, and the redshift heads
+do not split their outputs for a single image, but Python control flow that depends on the
+data is fixed at export time.  export_model therefore compares the traced model with the
+eager one on further check images and refuses to save an artifact that disagrees.
+"""
+
+import json
+import pickle
+
+import numpy as np
+import torch
+from detectron2.export import TracingAdapter
+from torch.nn.parallel import DistributedDataParallel
+
+from deepdisc.inference.masks import postprocess
+from deepdisc.model.feature_cache import FeatureCacheRCNN
+
+_SCHEMA_FILE = "outputs_schema.pkl"
+_META_FILE = "deepdisc_meta.json"
+
+
+def _unwrap(model):
+    if isinstance(model, DistributedDataParallel):
+        model = model.module
+    if isinstance(model, FeatureCacheRCNN):
+        model = model.model
+    return model
+
+
+def _inference(model, inputs):
+    # the raw detections in the coordinates of the model input; rescaling (and pasting the
+    # masks) is done by ExportedAstroPredictor after the traced graph
+    return model.inference(inputs, do_postprocess=False)
+
+
+def _to_input(image, input_format, device):
+    """The CHW float tensor of an HWC image, as in AstroPredictor"""
+    if input_format == "RGB":
+        image = image[:, :, ::-1]
+    return torch.as_tensor(np.ascontiguousarray(image.astype("float32").transpose(2, 0, 1)), device=device)
+
+
+def _same_detections(expected, actual, atol):
+    if len(expected) != len(actual):
+        return False
+    for name, value in expected.get_fields().items():
+        other = actual.get(name)
+        value = getattr(value, "tensor", value)
+        other = getattr(other, "tensor", other)
+        if torch.is_tensor(value) and not torch.allclose(value.float(), other.float(), atol=atol, rtol=atol):
+            return False
+    return True
+
+
+def export_model(model, sample_image, output_path, input_format="BGR", check_images=(), atol=1e-3):
+    """Trace the inference of a model on a sample image and save it as TorchScript
+
+    Parameters
+    ----------
+    model : GeneralizedRCNN
+        The model with its weights loaded, e.g. AstroPredictor(cfg).model
+    sample_image : np.ndarray
+        An (H, W, C) image like those given to the predictor, with detections.  Use a tile
+        of the size the artifact will be run on
+    output_path : str
+        The file to save, conventionally with a .ts extension
+    input_format : str
+        "RGB" or "BGR", the predictor's input_format
+    check_images : list[np.ndarray]
+        Further images to run both the traced and the eager model on before saving
+    atol : float
+        Tolerance of that comparison
+
+    Returns
+    -------
+    torch.jit.ScriptModule
+        The traced model
+    """
+    model = _unwrap(model).eval()
+    device = next(model.parameters()).device
+    inputs = [{"image": _to_input(sample_image, input_format, device)}]
+    adapter = TracingAdapter(model, inputs, _inference)
+    with torch.no_grad():
+        traced = torch.jit.trace(adapter, adapter.flattened_inputs)
+
+        for image in check_images:
+            image = _to_input(image, input_format, device)
+            expected = _inference(model, [{"image": image}])[0]
+            actual = adapter.outputs_schema(traced(image))[0]
+            if not _same_detections(expected, actual, atol):
+                raise RuntimeError(
+                    "The traced model does not reproduce the eager model on a check image; "
+                    "it depends on control flow that tracing cannot capture"
+                )
+
+    meta = {"input_format": input_format, "device": str(device)}
+    extra_files = {_SCHEMA_FILE: pickle.dumps(adapter.outputs_schema), _META_FILE: json.dumps(meta)}
+    torch.jit.save(traced, output_path, _extra_files=extra_files)
+    return traced
+
+
+def export_predictor(predictor, sample_image, output_path, check_images=(), atol=1e-3):
+    """Export the model of an AstroPredictor, see export_model"""
+    return export_model(
+        predictor.model,
+        sample_image,
+        output_path,
+        input_format=predictor.input_format,
+        check_images=check_images,
+        atol=atol,
+    )
+
+
+class ExportedAstroPredictor:
+    """Run a model exported with export_model on single images, like AstroPredictor
+
+    Parameters
+    ----------
+    path : str
+        The exported TorchScript file
+    device : str
+        Where to run the model.  Default: the device the model was exported on
+    mask_format : str
+        "full", "roi" or "rle", see deepdisc.inference.masks
+    """
+
+    def __init__(self, path, device=None, mask_format="full"):
+        extra_files = {_SCHEMA_FILE: b"", _META_FILE: b""}
+        self.model = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+        meta = json.loads(extra_files[_META_FILE])
+        self.outputs_schema = pickle.loads(extra_files[_SCHEMA_FILE])
+        self.input_format = meta["input_format"]
+        self.device = torch.device(device if device is not None else meta["device"])
+        self.model.to(self.device).eval()
+        self.mask_format = mask_format
+
+    def __call__(self, original_image):
+        """
+        Args:
+            original_image (np.ndarray): an image of shape (H, W, C) (in BGR order).
+        Returns:
+            predictions (dict): {"instances": Instances} for the image, as from AstroPredictor
+        """
+        with torch.no_grad():
+            height, width = original_image.shape[:2]
+            image = _to_input(original_image, self.input_format, self.device)
+            instances = self.outputs_schema(self.model(image))[0]
+            return {"instances": postprocess(instances, height, width, self.mask_format)}
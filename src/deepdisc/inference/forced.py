@@ -0,0 +1,155 @@
+"""Forced inference: evaluate the class and redshift heads of a trained model on given boxes.
+
+For catalog production the source positions are often already known, e.g. from the sep
+catalog passed to run_scarlet.  Instead of detecting the sources with the RPN and refining
+the boxes through the cascade stages, forced_inference runs the backbone once per image and
+evaluates the box classifier(s), the redshift head and optionally the mask head directly on
+the supplied boxes.  The outputs keep the order of the boxes and record the index of each,
+so they line up with the catalog.
+
+Example
+-------
+    boxes = boxes_from_positions(catalog["x"], catalog["y"], 16)
+    outputs = forced_inference(predictor.model, [{"image": image, "height": h, "width": w}], [boxes])
+    pdfs = outputs[0]["instances"].pred_redshift_pdf
+"""
+
+import numpy as np
+import torch
+from detectron2.modeling.postprocessing import detector_postprocess
+from detectron2.structures import Boxes, BoxMode, Instances
+from torch import nn
+from torch.nn.parallel import DistributedDataParallel
+
+from deepdisc.model.feature_cache import FeatureCacheRCNN
+
+
+def boxes_from_positions(x, y, size):
+    """Square XYXY_ABS boxes centred on catalog positions
+
+    Parameters
+    ----------
+    x, y : array-like
+        Source positions in 0-indexed pixel coordinates with pixel centres at integers,
+        as in the sep/scarlet catalogs
+    size : float or array-like
+        The box side length in pixels, for all sources or per source
+
+    Returns
+    -------
+    np.ndarray
+        (N, 4) boxes in detectron2 pixel coordinates (pixel edges at integers)
+    """
+    x = np.asarray(x, dtype=np.float64) + 0.5
+    y = np.asarray(y, dtype=np.float64) + 0.5
+    half = np.broadcast_to(np.asarray(size, dtype=np.float64) / 2, x.shape)
+    return np.stack([x - half, y - half, x + half, y + half], axis=1)
+
+
+def _unwrap(model):
+    if isinstance(model, DistributedDataParallel):
+        model = model.module
+    if isinstance(model, FeatureCacheRCNN):
+        model = model.model
+    return model
+
+
+def _class_scores(roi_heads, box_features, proposals):
+    """Class probabilities of the boxes, averaged over the cascade stages as in CascadeROIHeads"""
+    if isinstance(roi_heads.box_head, nn.ModuleList):
+        # the stages run at inference, see deepdisc.inference.early_exit
+        stages = list(zip(roi_heads.box_head, roi_heads.box_predictor))[: roi_heads.num_cascade_stages]
+    else:
+        stages = [(roi_heads.box_head, roi_heads.box_predictor)]
+    scores = 0
+    for box_head, box_predictor in stages:
+        predictions = box_predictor(box_head(box_features))
+        scores = scores + torch.cat(box_predictor.predict_probs(predictions, proposals))
+    return scores / len(stages)
+
+
+def _forced_instances(model, features, image_size, boxes, classify):
+    roi_heads = model.roi_heads
+    instances = Instances(image_size)
+    instances.pred_boxes = boxes
+    if classify:
+        proposals = Instances(image_size)
+        proposals.proposal_boxes = boxes
+        box_features = roi_heads.box_pooler([features[f] for f in roi_heads.box_in_features], [boxes])
+        probs = _class_scores(roi_heads, box_features, [proposals])
+        # the last column is the background class
+        instances.scores, instances.pred_classes = probs[:, :-1].max(dim=1)
+    else:
+        instances.pred_classes = torch.zeros(len(boxes), dtype=torch.int64, device=boxes.device)
+    instances = roi_heads.forward_with_given_boxes(features, [instances])
+    instances = roi_heads._forward_redshift(features, instances)
+    # the poolers of heads built with share_pooling reuse the box features above; their
+    # cache is normally emptied by the forward hooks of the heads, which are not called here
+    pooling_cache = getattr(roi_heads, "_pooling_cache", None)
+    if pooling_cache is not None:
+        pooling_cache.clear()
+    return instances[0]
+
+
+def forced_inference(
+    model, batched_inputs, boxes, box_mode=BoxMode.XYXY_ABS, classify=True, max_boxes_per_call=2000
+):
+    """Run the class, mask and redshift heads of a model on supplied boxes
+
+    Parameters
+    ----------
+    model : GeneralizedRCNN
+        A model with one of the redshift ROI heads (e.g. predictor.model), in eval mode
+    batched_inputs : list[dict]
+        The images in the model's input format ("image" CHW tensor, "height", "width")
+    boxes : list[array-like]
+        The (N_i, 4) boxes of each image, in the coordinates of the original image
+        (height x width), in box_mode
+    box_mode : BoxMode
+        The mode of the supplied boxes, XYXY_ABS by default
+    classify : bool
+        Also run the box classifier(s) for "pred_classes" and "scores".  Otherwise every
+        box gets class 0 and no score
+    max_boxes_per_call : int
+        Evaluate the heads on at most this many boxes at once, to bound the memory
+
+    Returns
+    -------
+    list[dict]
+        {"instances": Instances} per image, like the model's output, with "pred_boxes",
+        "pred_classes", the redshift outputs of the head, masks if the model has a mask head,
+        and "forced_index", the index of each instance in the supplied boxes.  Boxes that
+        lie entirely outside the image are dropped.
+    """
+    model = _unwrap(model)
+    with torch.no_grad():
+        images = model.preprocess_image(batched_inputs)
+        features = model.backbone(images.tensor)
+
+        results = []
+        for i, (inputs, image_boxes) in enumerate(zip(batched_inputs, boxes)):
+            image_size = images.image_sizes[i]
+            height = inputs.get("height", image_size[0])
+            width = inputs.get("width", image_size[1])
+            image_boxes = np.asarray(image_boxes, dtype=np.float64).reshape(-1, 4)
+            image_boxes = BoxMode.convert(image_boxes, box_mode, BoxMode.XYXY_ABS)
+            image_boxes = torch.as_tensor(image_boxes, dtype=torch.float32, device=images.tensor.device)
+            # to the coordinates of the (possibly resized) model input
+            scale = torch.tensor(
+                [image_size[1] / width, image_size[0] / height] * 2, dtype=torch.float32, device=image_boxes.device
+            )
+            image_boxes = Boxes(image_boxes * scale)
+            image_boxes.clip(image_size)
+
+            image_features = {name: f[i : i + 1] for name, f in features.items()}
+            chunks = []
+            for start in range(0, max(len(image_boxes), 1), max_boxes_per_call):
+                chunks.append(
+                    _forced_instances(
+                        model, image_features, image_size, image_boxes[start : start + max_boxes_per_call], classify
+                    )
+                )
+            instances = Instances.cat(chunks)
+            instances.forced_index = torch.arange(len(instances), device=image_boxes.device)
+            results.append({"instances": detector_postprocess(instances, height, width)})
+    return results
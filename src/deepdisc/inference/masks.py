@@ -0,0 +1,240 @@
+"""Compact mask outputs: box-local probability maps or run-length encodings.
+
+detectron2 pastes the 28x28 mask of every detection into a full-resolution (H, W) bool
+mask when it rescales the outputs (detector_postprocess).  With the test_topk_per_image
+of 1000-2000 in the deepdisc configs and 512-1024 pixel tiles, that is up to gigabytes of
+masks per tile, most of them empty.  The other mask formats keep the masks compact:
+
+    "full"   (N, H, W) bool tensor, as detectron2 returns them
+    "roi"    detectron2 ROIMasks: the (N, 28, 28) probability maps in the frame of each
+             box.  Pasting them gives exactly the "full" masks
+    "rle"    RLEMasks: COCO run-length encodings of the "full" masks, as used by the
+             evaluation and the ground truth of the COCO json files
+
+paste_masks turns any of them into full-resolution masks when they are needed, e.g. for
+visualisation, and mask_rles into RLEs for evaluation.
+"""
+
+import numpy as np
+import pycocotools.mask as mask_util
+import torch
+from detectron2.modeling.postprocessing import detector_postprocess
+from detectron2.structures import ROIMasks
+from torch.nn.parallel import DistributedDataParallel
+
+from deepdisc.model.feature_cache import FeatureCacheRCNN
+
+MASK_FORMATS = ("full", "roi", "rle")
+
+
+class RLEMasks:
+    """The masks of the instances of one image, as COCO run-length encodings
+
+    Parameters
+    ----------
+    rles : list[dict]
+        The compressed RLE of each mask, as from pycocotools.mask.encode
+    image_size : tuple[int, int]
+        (height, width) of the masks
+    """
+
+    def __init__(self, rles, image_size):
+        self.rles = list(rles)
+        self.image_size = tuple(image_size)
+
+    @classmethod
+    def from_roi_masks(cls, roi_masks, boxes, height, width, threshold=0.5, chunk_size=64):
+        """Paste box-local masks and encode them, a chunk of instances at a time
+
+        Parameters
+        ----------
+        roi_masks : ROIMasks
+            The (N, M, M) probability maps
+        boxes : Boxes
+            The N boxes, in the (height x width) frame
+        height, width : int
+            The size of the image
+        threshold : float
+            The probability above which a pixel is in the mask
+        chunk_size : int
+            The number of full-resolution masks in memory at once
+
+        Returns
+        -------
+        RLEMasks
+        """
+        rles = []
+        for start in range(0, len(roi_masks), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            bitmasks = roi_masks[chunk].to_bitmasks(boxes[chunk], height, width, threshold).tensor
+            rles.extend(encode_masks(bitmasks))
+        return cls(rles, (height, width))
+
+    def __len__(self):
+        return len(self.rles)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return RLEMasks(self.rles[item], self.image_size)
+        if isinstance(item, int):
+            return RLEMasks([self.rles[item]], self.image_size)
+        item = item.cpu().numpy() if torch.is_tensor(item) else np.asarray(item)
+        if item.dtype == bool:
+            item = np.flatnonzero(item)
+        return RLEMasks([self.rles[i] for i in item], self.image_size)
+
+    def __repr__(self):
+        return f"RLEMasks(num_instances={len(self)}, image_size={self.image_size})"
+
+    def to(self, device):
+        return self
+
+    @classmethod
+    def cat(cls, masks_list):
+        return cls([rle for masks in masks_list for rle in masks.rles], masks_list[0].image_size)
+
+    def area(self):
+        """The number of pixels in each mask"""
+        return torch.as_tensor(mask_util.area(self.rles).astype(np.int64)) if self.rles else torch.zeros(0)
+
+    def decode(self):
+        """The (N, H, W) bool masks"""
+        if not self.rles:
+            return torch.zeros((0, *self.image_size), dtype=torch.bool)
+        return torch.from_numpy(mask_util.decode(self.rles).transpose(2, 0, 1).astype(bool))
+
+
+def encode_masks(masks):
+    """Compressed RLEs of (N, H, W) bool masks, with the counts as str so they serialise to json"""
+    masks = masks.cpu().numpy() if torch.is_tensor(masks) else np.asarray(masks)
+    if len(masks) == 0:
+        return []
+    rles = mask_util.encode(np.asfortranarray(masks.transpose(1, 2, 0).astype(np.uint8)))
+    for rle in rles:
+        rle["counts"] = rle["counts"].decode("utf-8")
+    return rles
+
+
+def postprocess(results, output_height, output_width, mask_format="full", mask_threshold=0.5):
+    """detector_postprocess, keeping the masks in mask_format
+
+    Parameters
+    ----------
+    results : Instances
+        The raw detections of one image in the model input frame, with "pred_masks" of
+        shape (N, 1, M, M) if the model has a mask head
+    output_height, output_width : int
+        The size of the original image
+    mask_format : str
+        One of MASK_FORMATS
+    mask_threshold : float
+        The probability above which a pixel is in the mask
+
+    Returns
+    -------
+    Instances
+        The detections rescaled to the original image, as from detector_postprocess
+    """
+    if mask_format not in MASK_FORMATS:
+        raise ValueError(f"mask_format must be one of {MASK_FORMATS}, got {mask_format}")
+    if mask_format == "full" or not results.has("pred_masks"):
+        return detector_postprocess(results, output_height, output_width, mask_threshold)
+
+    masks = results.pred_masks
+    results.remove("pred_masks")
+    # detector_postprocess drops the boxes that are empty after clipping
+    results.set("_index", torch.arange(len(results), device=masks.device))
+    results = detector_postprocess(results, output_height, output_width)
+    roi_masks = ROIMasks(masks[results._index, 0])
+    results.remove("_index")
+
+    if mask_format == "roi":
+        results.pred_masks = roi_masks
+    else:
+        results.pred_masks = RLEMasks.from_roi_masks(
+            roi_masks, results.pred_boxes, output_height, output_width, mask_threshold
+        )
+    return results
+
+
+def model_inference(model, batched_inputs, mask_format="full", mask_threshold=0.5):
+    """Run a GeneralizedRCNN at inference, returning its masks in mask_format
+
+    Parameters
+    ----------
+    model : GeneralizedRCNN
+        The model, in eval mode
+    batched_inputs : list[dict]
+        The images in the model's input format ("image" CHW tensor, "height", "width")
+    mask_format : str
+        One of MASK_FORMATS
+    mask_threshold : float
+        The probability above which a pixel is in the mask
+
+    Returns
+    -------
+    list[dict]
+        {"instances": Instances} per image, like the model's output
+    """
+    if mask_format == "full":
+        return model(batched_inputs)
+    if isinstance(model, DistributedDataParallel):
+        model = model.module
+    if isinstance(model, FeatureCacheRCNN):
+        model = model.model
+
+    results = model.inference(batched_inputs, do_postprocess=False)
+    outputs = []
+    for instances, inputs in zip(results, batched_inputs):
+        height = inputs.get("height", instances.image_size[0])
+        width = inputs.get("width", instances.image_size[1])
+        outputs.append({"instances": postprocess(instances, height, width, mask_format, mask_threshold)})
+    return outputs
+
+
+def paste_masks(instances, mask_threshold=0.5):
+    """The full-resolution masks of instances, whatever their mask format
+
+    Parameters
+    ----------
+    instances : Instances
+        Postprocessed detections with "pred_masks"
+    mask_threshold : float
+        The probability above which a pixel is in the mask, for "roi" masks
+
+    Returns
+    -------
+    torch.Tensor
+        (N, H, W) bool masks
+    """
+    masks = instances.pred_masks
+    if isinstance(masks, ROIMasks):
+        height, width = instances.image_size
+        return masks.to_bitmasks(instances.pred_boxes, height, width, mask_threshold).tensor
+    if isinstance(masks, RLEMasks):
+        return masks.decode()
+    return masks
+
+
+def mask_rles(instances, mask_threshold=0.5):
+    """COCO RLEs of the masks of instances, whatever their mask format
+
+    Parameters
+    ----------
+    instances : Instances
+        Postprocessed detections with "pred_masks"
+    mask_threshold : float
+        The probability above which a pixel is in the mask, for "roi" masks
+
+    Returns
+    -------
+    list[dict]
+        The compressed RLE of each mask
+    """
+    masks = instances.pred_masks
+    if isinstance(masks, ROIMasks):
+        height, width = instances.image_size
+        return RLEMasks.from_roi_masks(masks, instances.pred_boxes, height, width, mask_threshold).rles
+    if isinstance(masks, RLEMasks):
+        return masks.rles
+    return encode_masks(masks)
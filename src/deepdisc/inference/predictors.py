@@ -1,4 +1,7 @@
+import torch
+
 import DeepDiscVR.src.deepdisc.astrodet.astrodet as toolkit
+from deepdisc.inference.forced import forced_inference
 
 
 def return_predictor(cfg, checkpoint=None):
@@ -67,3 +70,32 @@ def get_predictions_new(dataset_dict, predictor):
     img = dataset_dict["image_shaped"]
     outputs = predictor(img)
     return outputs
+
+
+def get_forced_predictions(img, boxes, predictor, **kwargs):
+    """Returns the class and redshift predictions of the model for known sources in an image
+
+    The heads are evaluated on the supplied boxes instead of detecting the sources,
+    see deepdisc.inference.forced
+
+    Parameters
+    ----------
+    img : np.ndarray
+        The (H, W, C) image, as passed to the predictor
+    boxes : array-like
+        The (N, 4) XYXY_ABS boxes of the sources, e.g. from forced.boxes_from_positions
+    predictor: AstroPredictor
+        The predictor object used to make predictions on the test set
+    **kwargs
+        Passed to forced_inference
+
+    Returns
+    -------
+        outputs: dict
+            {"instances": Instances} with the predictions for each box
+    """
+    if predictor.input_format == "RGB":
+        img = img[:, :, ::-1]
+    image = torch.as_tensor(img.astype("float32").transpose(2, 0, 1))
+    inputs = {"image": image, "height": img.shape[0], "width": img.shape[1]}
+    return forced_inference(predictor.model, [inputs], [boxes], **kwargs)[0]
@@ -0,0 +1,216 @@
+"""Dynamic int8 quantisation of the model for CPU inference, and a check of its accuracy.
+
+Outside the backbone, most of the CPU inference time goes to the large Linear layers of
+the box heads and the redshift head (e.g. 256*7*7 -> 1024).  quantize_model replaces
+them with dynamically quantised int8 Linear layers: the weights are stored in int8, the
+activations are quantised on the fly, and the outputs are float again, so nothing else in
+the model changes.  compare_predictors runs a float and a quantised predictor on the same
+images and reports how much the detections and redshift PDFs move.
+"""
+
+import time
+
+import numpy as np
+import torch
+from torch import nn
+from torch.nn.parallel import DistributedDataParallel
+
+from deepdisc.model.feature_cache import FeatureCacheRCNN
+
+QUANTIZE_MODES = ("heads", "all")
+
+
+def quantize_model(model, mode="heads", dtype=torch.qint8):
+    """Apply dynamic quantisation to the Linear layers of a model, in place
+
+    Parameters
+    ----------
+    model : GeneralizedRCNN
+        The model, on the CPU.  It is put in eval mode
+    mode : str
+        "heads" to quantise the proposal generator and ROI heads (box, mask and redshift
+        heads), "all" to also quantise the backbone
+    dtype : torch.dtype
+        The weight dtype, torch.qint8 or torch.float16
+
+    Returns
+    -------
+    GeneralizedRCNN
+        The quantised model
+    """
+    if mode not in QUANTIZE_MODES:
+        raise ValueError(f"Quantization mode must be one of {QUANTIZE_MODES}, got {mode}")
+    inner = model.module if isinstance(model, DistributedDataParallel) else model
+    if any(p.device.type != "cpu" for p in inner.parameters()):
+        raise ValueError("Dynamic quantization is only supported for models on the CPU")
+    if torch.backends.quantized.engine == "none":
+        torch.backends.quantized.engine = torch.backends.quantized.supported_engines[-1]
+
+    inner.eval()
+    names = ["proposal_generator", "roi_heads"] + (["backbone"] if mode == "all" else [])
+    for name in names:
+        module = getattr(inner, name, None)
+        if module is not None:
+            setattr(inner, name, torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=dtype))
+    return model
+
+
+def redshift_grid(model):
+    """The redshift grid the PDF head of a model evaluates its PDFs on
+
+    Parameters
+    ----------
+    model : GeneralizedRCNN or ROIHeads
+        The model (e.g. AstroPredictor(cfg).model) or its ROI heads
+
+    Returns
+    -------
+    np.ndarray or None
+        The grid, None if the model has no redshift PDF head
+    """
+    if isinstance(model, DistributedDataParallel):
+        model = model.module
+    if isinstance(model, FeatureCacheRCNN):
+        model = model.model
+    zgrid = getattr(getattr(model, "roi_heads", model), "zgrid", None)
+    return None if zgrid is None else np.asarray(zgrid)
+
+
+def _pdf_moments(log_pdfs, zs):
+    """Mean and mode of PDFs given as log densities on a grid"""
+    pdfs = np.exp(log_pdfs)
+    norm = pdfs.sum(axis=1)
+    mean = (pdfs * zs).sum(axis=1) / np.where(norm > 0, norm, 1)
+    return mean, zs[np.argmax(log_pdfs, axis=1)]
+
+
+def compare_outputs(reference, candidate, iou_thresh=0.5, zs=None):
+    """Compare the predictions of two models on one image
+
+    Detections are matched greedily by IoU, in order of the reference scores.
+
+    Parameters
+    ----------
+    reference, candidate : dict
+        The outputs of the float and quantised predictors
+    iou_thresh : float
+        The IoU needed to match two detections
+    zs : np.ndarray
+        The redshift grid of the PDFs (for the PDF means and modes), see redshift_grid.
+        Required when the outputs have redshift PDFs
+
+    Returns
+    -------
+    dict
+        Numbers of detections, matches, and per-match IoUs, score, class and redshift differences
+    """
+    from detectron2.structures import pairwise_iou
+
+    ref = reference["instances"].to("cpu")
+    cand = candidate["instances"].to("cpu")
+    result = {"n_reference": len(ref), "n_candidate": len(cand), "ious": [], "score_diffs": [], "class_agree": []}
+    if len(ref) and len(cand):
+        ious = pairwise_iou(ref.pred_boxes, cand.pred_boxes).numpy()
+        order = np.argsort(-ref.scores.numpy()) if ref.has("scores") else np.arange(len(ref))
+        pairs = []
+        for i in order:
+            j = int(np.argmax(ious[i]))
+            if ious[i, j] >= iou_thresh:
+                pairs.append((i, j))
+                result["ious"].append(float(ious[i, j]))
+                ious[:, j] = -1
+        pairs = np.array(pairs, dtype=int).reshape(-1, 2)
+        ri, ci = pairs[:, 0], pairs[:, 1]
+        if ref.has("scores"):
+            result["score_diffs"] = (cand.scores.numpy()[ci] - ref.scores.numpy()[ri]).tolist()
+        result["class_agree"] = (cand.pred_classes.numpy()[ci] == ref.pred_classes.numpy()[ri]).tolist()
+        if ref.has("pred_redshift_pdf") and len(pairs):
+            ref_pdf = ref.pred_redshift_pdf.numpy()[ri]
+            cand_pdf = cand.pred_redshift_pdf.numpy()[ci]
+            if zs is None:
+                raise ValueError("The outputs have redshift PDFs; pass their grid as zs, see redshift_grid")
+            grid = np.asarray(zs)
+            if len(grid) != ref_pdf.shape[1]:
+                raise ValueError(f"zs has {len(grid)} points but the PDFs have {ref_pdf.shape[1]}")
+            ref_mean, ref_mode = _pdf_moments(ref_pdf, grid)
+            cand_mean, cand_mode = _pdf_moments(cand_pdf, grid)
+            result["pdf_max_abs_diff"] = np.abs(np.exp(cand_pdf) - np.exp(ref_pdf)).max(axis=1).tolist()
+            result["z_mean_diffs"] = (cand_mean - ref_mean).tolist()
+            result["z_mode_diffs"] = (cand_mode - ref_mode).tolist()
+        if ref.has("pred_redshift") and len(pairs):
+            result["z_point_diffs"] = (cand.pred_redshift.numpy()[ci] - ref.pred_redshift.numpy()[ri]).ravel().tolist()
+    return result
+
+
+def compare_predictors(reference, candidate, images, iou_thresh=0.5, zs=None):
+    """Run two predictors on the same images and summarise how their predictions differ
+
+    Parameters
+    ----------
+    reference, candidate : callable
+        The float and quantised predictors (e.g. AstroPredictor), called on an HWC image
+    images : iterable of np.ndarray
+        The held-out images
+    iou_thresh : float
+        The IoU needed to match two detections
+    zs : np.ndarray
+        The redshift grid of the PDFs, see compare_outputs.  Default: the grid of the head
+        of reference.model, if it has one
+
+    Returns
+    -------
+    dict
+        The summary: mean latencies, detection counts and recall of the reference
+        detections, mean IoU, class agreement, and the score and redshift differences
+    """
+    if zs is None and hasattr(reference, "model"):
+        zs = redshift_grid(reference.model)
+    keys = ["ious", "score_diffs", "class_agree", "pdf_max_abs_diff", "z_mean_diffs", "z_mode_diffs", "z_point_diffs"]
+    totals = {k: [] for k in keys}
+    n_reference = n_candidate = 0
+    latency = {"reference": [], "candidate": []}
+    for image in images:
+        start = time.perf_counter()
+        ref_out = reference(image)
+        latency["reference"].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        cand_out = candidate(image)
+        latency["candidate"].append(time.perf_counter() - start)
+
+        result = compare_outputs(ref_out, cand_out, iou_thresh=iou_thresh, zs=zs)
+        n_reference += result["n_reference"]
+        n_candidate += result["n_candidate"]
+        for k in keys:
+            totals[k].extend(result.get(k, []))
+
+    def stat(values, func):
+        return float(func(np.asarray(values))) if len(values) else None
+
+    return {
+        "n_images": len(latency["reference"]),
+        "latency_ms": {k: 1000 * float(np.mean(v)) if v else None for k, v in latency.items()},
+        "n_reference": n_reference,
+        "n_candidate": n_candidate,
+        "matched_fraction": len(totals["ious"]) / n_reference if n_reference else None,
+        "mean_iou": stat(totals["ious"], np.mean),
+        "class_agreement": stat(totals["class_agree"], np.mean),
+        "max_abs_score_diff": stat(totals["score_diffs"], lambda x: np.abs(x).max()),
+        "max_pdf_abs_diff": stat(totals["pdf_max_abs_diff"], np.max),
+        "rms_z_mean_diff": stat(totals["z_mean_diffs"], lambda x: np.sqrt(np.mean(x**2))),
+        "rms_z_mode_diff": stat(totals["z_mode_diffs"], lambda x: np.sqrt(np.mean(x**2))),
+        "rms_z_point_diff": stat(totals["z_point_diffs"], lambda x: np.sqrt(np.mean(x**2))),
+    }
+
+
+def format_report(summary):
+    """Format the summary of compare_predictors as text"""
+    lines = []
+    for key, value in summary.items():
+        if isinstance(value, dict):
+            value = ", ".join(f"{k}: {v:.1f}" if v is not None else f"{k}: -" for k, v in value.items())
+        elif isinstance(value, float):
+            value = f"{value:.4g}"
+        elif value is None:
+            value = "-"
+        lines.append(f"{key:<20} {value}")
+    return "\n".join(lines)
@@ -0,0 +1,355 @@
+"""A local inference service that shares one loaded model between many clients.
+
+Clients submit single tiles over HTTP (TCP or a Unix socket).  A DynamicBatcher collects
+the tiles of concurrent requests into batches, up to a maximum batch size or until the
+oldest request has waited max_latency_ms, and runs them through the predictor in one
+forward pass.  Each response is a json document with the detections of one tile: boxes,
+scores, classes and the redshift outputs of the head (PDF on the head's redshift grid or
+point estimates).
+
+Protocol
+--------
+    POST /predict    body: one (H, W, C) image in .npy format (np.save)
+                     response: {"pred_boxes": [[x0, y0, x1, y1], ...], "scores": [...], ...}
+                     add ?masks=1 to also get the pasted masks as nested lists
+    GET  /health     response: {"status": "ok", "requests": ..., "batches": ...}
+
+Example
+-------
+    server = InferenceServer(AstroPredictor(cfg), port=8470)
+    server.serve_forever()
+
+    # in another process
+    outputs = predict_remote(image, port=8470)
+"""
+
+import http.client
+import io
+import json
+import os
+import queue
+import socket
+import socketserver
+import stat
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import torch
+
+
+class DynamicBatcher:
+    """Group single requests into batches for a batch prediction function
+
+    Parameters
+    ----------
+    predict_batch : callable
+        Called with a list of inputs, returns the list of their outputs
+    max_batch_size : int
+        The largest batch passed to predict_batch
+    max_latency_ms : float
+        How long the first request of a batch waits for more requests to arrive
+    """
+
+    def __init__(self, predict_batch, max_batch_size=8, max_latency_ms=20.0):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.n_requests = 0
+        self.n_batches = 0
+        self._queue = queue.Queue()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name="DynamicBatcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, item):
+        """Queue an input; returns a Future of its output"""
+        if self._closed:
+            raise RuntimeError("The batcher is closed")
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def __call__(self, item):
+        """Predict a single input, blocking until its batch has run"""
+        return self.submit(item).result()
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # finish this batch, then stop
+                self._queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            items = [item for item, _ in batch]
+            try:
+                outputs = self.predict_batch(items)
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                    continue
+                # one bad input fails the whole batch; run them alone so only it fails
+                self._run_singly(batch)
+                continue
+            self.n_requests += len(batch)
+            self.n_batches += 1
+            for (_, future), output in zip(batch, outputs):
+                future.set_result(output)
+
+    def _run_singly(self, batch):
+        for item, future in batch:
+            try:
+                output = self.predict_batch([item])[0]
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            self.n_requests += 1
+            self.n_batches += 1
+            future.set_result(output)
+
+    def close(self):
+        """Stop the worker after the queued requests are done"""
+        self._closed = True
+        self._queue.put(None)
+        self._worker.join()
+
+
+def predictor_batch_function(predictor):
+    """The batch prediction function of a predictor
+
+    AstroPredictor.predict_batch runs the images in one forward pass; other predictors
+    (e.g. ExportedAstroPredictor, which is traced for single images) are called per image.
+    """
+    predict_batch = getattr(predictor, "predict_batch", None)
+    if predict_batch is not None:
+        return predict_batch
+    return lambda images: [predictor(image) for image in images]
+
+
+def outputs_to_json(outputs, masks=False):
+    """Convert the predictions of one image to a json-serialisable dict
+
+    Parameters
+    ----------
+    outputs : dict
+        {"instances": Instances}, the output of a predictor for one image
+    masks : bool
+        Include "pred_masks"
+
+    Returns
+    -------
+    dict
+        Each field of the instances as (nested) lists, with the boxes as XYXY lists and
+        compact masks as their box-local maps or COCO RLEs
+    """
+    result = {}
+    for name, value in outputs["instances"].get_fields().items():
+        if name == "pred_masks" and not masks:
+            continue
+        if hasattr(value, "rles"):
+            # RLEMasks, see deepdisc.inference.masks
+            result[name] = value.rles
+            continue
+        value = getattr(value, "tensor", value)
+        if torch.is_tensor(value):
+            value = value.detach().cpu().numpy()
+        if isinstance(value, np.ndarray):
+            result[name] = value.tolist()
+    return result
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = "DeepDISC"
+
+    def address_string(self):
+        # Unix socket peers have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _reply(self, code, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/health":
+            self._reply(404, {"error": f"unknown path {self.path}"})
+            return
+        batcher = self.server.batcher
+        self._reply(200, {"status": "ok", "requests": batcher.n_requests, "batches": batcher.n_batches})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/predict":
+            self._reply(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            image = np.load(io.BytesIO(self.rfile.read(length)), allow_pickle=False)
+            if image.ndim != 3:
+                raise ValueError(f"Expected an (H, W, C) image, got shape {image.shape}")
+        except (ValueError, EOFError, OSError) as e:
+            # e.g. an empty body (EOFError) or one that is not in .npy format
+            self._reply(400, {"error": f"Could not read the image: {type(e).__name__}: {e}"})
+            return
+        masks = parse_qs(url.query).get("masks", ["0"])[0] not in ("0", "false")
+        try:
+            outputs = self.server.batcher(image)
+        except Exception as e:
+            self._reply(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+        self._reply(200, outputs_to_json(outputs, masks=masks))
+
+
+def _remove_stale_socket(path):
+    """Remove a Unix socket file left behind by a server that did not shut down cleanly"""
+    if not os.path.exists(path) or not stat.S_ISSOCK(os.stat(path).st_mode):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+            return
+    raise OSError(f"A server is already listening on {path}")
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class InferenceServer:
+    """Serve a predictor over HTTP with dynamic batching of concurrent requests
+
+    Parameters
+    ----------
+    predictor : AstroPredictor or ExportedAstroPredictor
+        The loaded predictor
+    host : str
+        The address to listen on (TCP)
+    port : int
+        The TCP port, 0 to pick a free one
+    unix_socket : str
+        Listen on this Unix socket path instead of TCP
+    max_batch_size : int
+        The largest batch of tiles run together
+    max_latency_ms : float
+        How long a request waits for others to batch with
+    verbose : bool
+        Log every request
+    """
+
+    def __init__(
+        self,
+        predictor,
+        host="127.0.0.1",
+        port=8470,
+        unix_socket=None,
+        max_batch_size=8,
+        max_latency_ms=20.0,
+        verbose=False,
+    ):
+        self.batcher = DynamicBatcher(predictor_batch_function(predictor), max_batch_size, max_latency_ms)
+        self.unix_socket = unix_socket
+        if unix_socket is not None:
+            _remove_stale_socket(unix_socket)
+            self.httpd = _UnixHTTPServer(unix_socket, _Handler)
+        else:
+            self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.batcher = self.batcher
+        self.httpd.verbose = verbose
+        self.address = self.httpd.server_address
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def start(self):
+        """Serve in a background thread; returns the thread"""
+        thread = threading.Thread(target=self.httpd.serve_forever, name="InferenceServer", daemon=True)
+        thread.start()
+        return thread
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.unix_socket is not None and os.path.exists(self.unix_socket):
+            os.unlink(self.unix_socket)
+        self.batcher.close()
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self._path)
+
+
+def predict_remote(image, host="127.0.0.1", port=8470, unix_socket=None, masks=False, timeout=None):
+    """Send a tile to an InferenceServer and return its detections
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The (H, W, C) image
+    host, port : str, int
+        The TCP address of the server
+    unix_socket : str
+        The Unix socket path of the server, instead of host and port
+    masks : bool
+        Also return the masks
+    timeout : float
+        Socket timeout in seconds
+
+    Returns
+    -------
+    dict
+        The fields of the detections, see outputs_to_json
+    """
+    if unix_socket is not None:
+        conn = _UnixHTTPConnection(unix_socket, timeout=timeout)
+    else:
+        conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    buffer = io.BytesIO()
+    np.save(buffer, np.asarray(image), allow_pickle=False)
+    try:
+        conn.request("POST", "/predict?masks=1" if masks else "/predict", body=buffer.getvalue())
+        response = conn.getresponse()
+        payload = json.loads(response.read())
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise RuntimeError(f"Inference server error {response.status}: {payload.get('error')}")
+    return payload
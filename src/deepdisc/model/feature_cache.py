@@ -0,0 +1,213 @@
+"""Cache of backbone/FPN features for training the heads of a model with a frozen backbone.
+
+In the frozen-backbone phase of training the backbone features of an image only depend on
+the image and on the dihedral variant (rotation/flip) the augmentations applied to it, and
+there are only 8 of those.  FeatureCacheRCNN computes the features once per (image_id,
+variant) and trains the proposal generator and ROI heads from the stored features.
+
+Caching is only used for samples whose augmentations were exclusively dihedral transforms
+(the mappers record the variant under the "dihedral" key).  Augmentation lists with a crop,
+such as train_augs (KRandomAugmentationList always applies its cropaug), never produce such
+samples, so the cache only helps with crop-free lists such as dc2_train_augs; a warning is
+logged when nothing has been reused.  The key also contains a hash of the image tensor, so
+different datasets with overlapping image ids do not share entries, nor do the orientations
+of an image that reach the mapper already rotated (the materialised dihedral variants of
+deepdisc.data_format.dihedral keep the image_id and are recorded with variant 0).
+
+The backbone is run in eval mode by FeatureCacheRCNN, for cached and uncached samples alike.
+The Swin, MViT and ViTDet backbones use stochastic depth (drop_path_rate 0.4-0.6 in the
+configs) even when their weights are frozen; in train mode the first random sample of it
+would be stored and reused in every later epoch.  With the cache, the heads are therefore
+trained on the deterministic features the model produces at inference, which differs from
+training without the cache, where the frozen backbone still drops paths at random.
+"""
+
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+
+import torch
+from torch import nn
+
+
+logger = logging.getLogger(__name__)
+
+# Warn if no features were reused after this many training samples
+_HIT_CHECK_SAMPLES = 1000
+
+
+class FeatureStore:
+    """An in-memory LRU store of feature dicts with an optional on-disk write-through copy
+
+    Parameters
+    ----------
+    cache_dir : str
+        If given, features are also saved there and reloaded after eviction or a restart
+    max_memory_mb : float
+        The memory budget of the in-memory store
+    dtype : torch.dtype
+        Store the features in this dtype (e.g. torch.float16 to halve the memory), or None
+        to keep them as computed
+    """
+
+    def __init__(self, cache_dir=None, max_memory_mb=4096, dtype=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_memory_mb * 2**20
+        self.dtype = dtype
+        self._memory = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _filename(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(repr(key).encode()).hexdigest() + ".pt")
+
+    def get(self, key):
+        """Return the stored features (on the CPU) or None"""
+        features = self._memory.get(key)
+        if features is not None:
+            self._memory.move_to_end(key)
+        elif self.cache_dir is not None and os.path.exists(self._filename(key)):
+            features = torch.load(self._filename(key), map_location="cpu")
+            self._remember(key, features)
+        if features is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return features
+
+    def put(self, key, features):
+        """Store a dict of feature tensors of one image"""
+        features = {k: v.detach().to("cpu", dtype=self.dtype or v.dtype) for k, v in features.items()}
+        if self.cache_dir is not None:
+            filename = self._filename(key)
+            torch.save(features, filename + ".tmp")
+            os.replace(filename + ".tmp", filename)
+        self._remember(key, features)
+
+    def _remember(self, key, features):
+        size = sum(v.numel() * v.element_size() for v in features.values())
+        if size > self.max_bytes:
+            return
+        self._memory[key] = features
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._bytes -= sum(v.numel() * v.element_size() for v in evicted.values())
+
+    def clear(self):
+        """Empty the in-memory store (the disk copy is kept)"""
+        self._memory.clear()
+        self._bytes = 0
+
+
+class FeatureCacheRCNN(nn.Module):
+    """Wrap a GeneralizedRCNN whose backbone is frozen so its features are computed once per
+    (image, dihedral variant) during training
+
+    Inference, and training once any backbone parameter requires grad, run the wrapped model
+    unchanged.  In the cached training path the backbone runs in eval mode (no stochastic
+    depth or dropout), see the module docstring.  state_dict and load_state_dict are those
+    of the wrapped model, so checkpoints are interchangeable with an unwrapped model.
+
+    Parameters
+    ----------
+    model : GeneralizedRCNN
+        The model, e.g. from return_lazy_model(cfg, freeze=True)
+    store : FeatureStore
+        Where to keep the features
+    """
+
+    def __init__(self, model, store):
+        super().__init__()
+        self.model = model
+        self.store = store
+        self._samples = 0
+        self._cacheable_samples = 0
+        self._hits_checked = False
+
+    def __getattr__(self, name):
+        # let hooks and the trainer use the attributes of the wrapped model (device, roi_heads, ...)
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            return getattr(self._modules["model"], name)
+
+    def state_dict(self, *args, **kwargs):
+        return self.model.state_dict(*args, **kwargs)
+
+    def load_state_dict(self, *args, **kwargs):
+        return self.model.load_state_dict(*args, **kwargs)
+
+    def _backbone_trainable(self):
+        return any(p.requires_grad for p in self.model.backbone.parameters())
+
+    def _cache_key(self, batched_input, image):
+        variant = batched_input.get("dihedral")
+        if variant is None:
+            return None
+        # a hash of the pixels, which unlike pixel statistics differs between orientations
+        digest = hashlib.blake2b(image.detach().cpu().contiguous().numpy(), digest_size=16).hexdigest()
+        return (batched_input["image_id"], int(variant), tuple(image.shape), digest)
+
+    def _features(self, batched_inputs, images):
+        """Backbone features of a batch, from the store where possible"""
+        keys = [self._cache_key(x, image) for x, image in zip(batched_inputs, images)]
+        cached = [self.store.get(k) if k is not None else None for k in keys]
+        missing = [i for i, c in enumerate(cached) if c is None]
+        if missing:
+            backbone = self.model.backbone
+            was_training = backbone.training
+            # deterministic features: a stochastic-depth sample must not be stored and reused
+            backbone.eval()
+            try:
+                with torch.no_grad():
+                    computed = backbone(images[missing])
+            finally:
+                backbone.train(was_training)
+            for j, i in enumerate(missing):
+                cached[i] = {name: f[j] for name, f in computed.items()}
+                if keys[i] is not None:
+                    self.store.put(keys[i], cached[i])
+        self._check_hits(keys)
+        device = images.device
+        return {
+            name: torch.stack([c[name].to(device, dtype=images.dtype, non_blocking=True) for c in cached])
+            for name in cached[0]
+        }
+
+    def _check_hits(self, keys):
+        self._samples += len(keys)
+        self._cacheable_samples += sum(k is not None for k in keys)
+        if self._hits_checked or self._samples < _HIT_CHECK_SAMPLES:
+            return
+        self._hits_checked = True
+        if self.store.hits == 0:
+            logger.warning(
+                f"The backbone feature cache has not been hit in {self._samples} samples, of which "
+                f"{self._cacheable_samples} were cacheable.  Only samples augmented exclusively by dihedral "
+                "transforms are cached; use an augmentation list without crops (e.g. dc2_train_augs)."
+            )
+
+    def forward(self, batched_inputs):
+        model = self.model
+        if not self.training or self._backbone_trainable():
+            return model(batched_inputs)
+
+        # GeneralizedRCNN.forward in training mode, with the backbone features from the store
+        images = model.preprocess_image(batched_inputs)
+        if "instances" in batched_inputs[0]:
+            gt_instances = [x["instances"].to(model.device) for x in batched_inputs]
+        else:
+            gt_instances = None
+        features = self._features(batched_inputs, images.tensor)
+        proposals, proposal_losses = model.proposal_generator(images, features, gt_instances)
+        _, detector_losses = model.roi_heads(images, features, proposals, gt_instances)
+
+        losses = {}
+        losses.update(detector_losses)
+        losses.update(proposal_losses)
+        return losses
@@ -5,9 +5,11 @@ import detectron2.data.transforms as T
 import numpy as np
 import torch
 from detectron2.data import detection_utils as utils
+from detectron2.data.build import trivial_batch_collator
 
-import DeepDiscVR.src.deepdisc.astrodet.astrodet as toolkit
-import DeepDiscVR.src.deepdisc.astrodet.detectron as detectron_addons
+from deepdisc.astrodet.detectron import DihedralTransform
+from deepdisc.data_format import dihedral
+from deepdisc.utils.profiling import StageTimer
 
 
 class DataMapper:
@@ -18,7 +20,7 @@ class DataMapper:
     and a custom version of map_data().
     """
 
-    def __init__(self, imreader=None, key_mapper=None, augmentations=None):
+    def __init__(self, imreader=None, key_mapper=None, augmentations=None, profile=False):
         """
         Parameters
         ----------
@@ -32,14 +34,77 @@ class DataMapper:
         augmentations : detectron2 AugmentationList or a detectron_addons.KRandomAugmentationList
             The list of augmentations to apply to the image
             Default = None
+        profile : bool
+            If True, time the image read, scaling, augmentation and annotation steps
+            and attach them to each mapped sample under the "timings" key
+            Default = False
         """
         self.IR = imreader
         self.km = key_mapper
         self.augmentations = augmentations
+        self.timer = StageTimer(enabled=profile)
 
     def map_data(self, data):
         return data
 
+    def _read_image(self, dataset_dict):
+        """Load and contrast scale the image belonging to dataset_dict"""
+        key = self.km(dataset_dict)
+        with self.timer.stage("image_read"):
+            image = self.IR.read(key)
+        with self.timer.stage("scaling"):
+            image = self.IR.scale(image)
+        return image
+
+    def _augment(self, image):
+        """Apply the augmentations to an image
+
+        Returns
+        -------
+        auginput : T.AugInput
+            The augmented input, with the augmented HWC image
+        transform : T.Transform
+            The transform to apply to the annotations
+        image : torch.Tensor
+            The augmented image in CHW format
+        """
+        with self.timer.stage("augmentation"):
+            auginput = T.AugInput(image)
+            # Transformations to model shapes
+            if self.augmentations is not None:
+                augs = self.augmentations(image)
+            else:
+                augs = T.AugmentationList([])
+            transform = augs(auginput)
+            image = torch.from_numpy(auginput.image.copy().transpose(2, 0, 1))
+        self._dihedral = _dihedral_variant(transform)
+        return auginput, transform, image
+
+    def _finalize(self, record):
+        """Attach the dihedral variant of the augmentations, and the stage timings of this sample when profiling"""
+        if getattr(self, "_dihedral", None) is not None:
+            record["dihedral"] = self._dihedral
+            self._dihedral = None
+        if self.timer.enabled:
+            record["timings"] = self.timer.pop_sample_timings()
+        return record
+
+
+def _dihedral_variant(transform):
+    """The dihedral variant (see deepdisc.data_format.dihedral) applied by a transform, if it
+    only consists of DihedralTransforms and no-ops; None otherwise
+
+    Used as part of the key of the backbone feature cache (deepdisc.model.feature_cache).
+    """
+    variant = 0
+    for t in getattr(transform, "transforms", [transform]):
+        if isinstance(t, T.NoOpTransform):
+            continue
+        if not isinstance(t, DihedralTransform):
+            return None
+        variant = dihedral.compose(variant, t.variant)
+    return variant
+
 
 class DictMapper(DataMapper):
     """Class that will map COCO dictionary data to the format necessary for the model"""
@@ -62,35 +127,30 @@ class DictMapper(DataMapper):
         """
 
         dataset_dict = copy.deepcopy(dataset_dict)
-        key = self.km(dataset_dict)
-        image = self.IR(key)
+        image = self._read_image(dataset_dict)
 
         # Data Augmentation
-        auginput = T.AugInput(image)
-        # Transformations to model shapes
-        if self.augmentations is not None:
-            augs = self.augmentations(image)
-        else:
-            augs = T.AugmentationList([])
-        transform = augs(auginput)
-        image = torch.from_numpy(auginput.image.copy().transpose(2, 0, 1))
-        annos = [
-            utils.transform_instance_annotations(annotation, [transform], image.shape[1:])
-            for annotation in dataset_dict.pop("annotations")
-        ]
-
-        instances = utils.annotations_to_instances(annos, image.shape[1:])
-        instances = utils.filter_empty_instances(instances)
-
-        return {
-            # create the format that the model expects
-            "image": image,
-            "image_shaped": auginput.image,
-            "height": image.shape[1],
-            "width": image.shape[2],
-            "image_id": dataset_dict["image_id"],
-            "instances": instances,
-        }
+        auginput, transform, image = self._augment(image)
+        with self.timer.stage("annotations"):
+            annos = [
+                utils.transform_instance_annotations(annotation, [transform], image.shape[1:])
+                for annotation in dataset_dict.pop("annotations")
+            ]
+
+            instances = utils.annotations_to_instances(annos, image.shape[1:])
+            instances = utils.filter_empty_instances(instances)
+
+        return self._finalize(
+            {
+                # create the format that the model expects
+                "image": image,
+                "image_shaped": auginput.image,
+                "height": image.shape[1],
+                "width": image.shape[2],
+                "image_id": dataset_dict["image_id"],
+                "instances": instances,
+            }
+        )
 
     
 class MagRedshiftDictMapper(DataMapper):
@@ -112,42 +172,36 @@ class MagRedshiftDictMapper(DataMapper):
         """
 
         dataset_dict = copy.deepcopy(dataset_dict)
-        key = self.km(dataset_dict)
-        image = self.IR(key)
+        image = self._read_image(dataset_dict)
 
         # Data Augmentation
-        auginput = T.AugInput(image)
-        # Transformations to model shapes
-        if self.augmentations is not None:
-            augs = self.augmentations(image)
-        else:
-            augs = T.AugmentationList([])
-
-        transform = augs(auginput)
-        image = torch.from_numpy(auginput.image.copy().transpose(2, 0, 1))
-
-        annos = [
-            utils.transform_instance_annotations(annotation, [transform], image.shape[1:])
-            for annotation in dataset_dict.pop("annotations")
-            if annotation["redshift"] != 0.0]# and annotation["mag_i"] < 25.3]
-
-        instances = utils.annotations_to_instances(annos, image.shape[1:])
-
-        instances.gt_magi = torch.tensor([a["mag_i"] for a in annos])
-        instances.gt_redshift = torch.tensor([a["redshift"] for a in annos])
-
-        instances = utils.filter_empty_instances(instances)
-
-        return {
-            # create the format that the model expects
-            "image": image,
-            "image_shaped": auginput.image,
-            "height": image.shape[1],
-            "width": image.shape[2],
-            "image_id": dataset_dict["image_id"],
-            "instances": instances,
-            "annotations": annos
-        }
+        auginput, transform, image = self._augment(image)
+
+        with self.timer.stage("annotations"):
+            annos = [
+                utils.transform_instance_annotations(annotation, [transform], image.shape[1:])
+                for annotation in dataset_dict.pop("annotations")
+                if annotation["redshift"] != 0.0]# and annotation["mag_i"] < 25.3]
+
+            instances = utils.annotations_to_instances(annos, image.shape[1:])
+
+            instances.gt_magi = torch.tensor([a["mag_i"] for a in annos])
+            instances.gt_redshift = torch.tensor([a["redshift"] for a in annos])
+
+            instances = utils.filter_empty_instances(instances)
+
+        return self._finalize(
+            {
+                # create the format that the model expects
+                "image": image,
+                "image_shaped": auginput.image,
+                "height": image.shape[1],
+                "width": image.shape[2],
+                "image_id": dataset_dict["image_id"],
+                "instances": instances,
+                "annotations": annos
+            }
+        )
     
 
 class RedshiftDictMapper(DataMapper):
@@ -169,42 +223,36 @@ class RedshiftDictMapper(DataMapper):
         """
 
         dataset_dict = copy.deepcopy(dataset_dict)
-        key = self.km(dataset_dict)
-        image = self.IR(key)
+        image = self._read_image(dataset_dict)
 
         # Data Augmentation
-        auginput = T.AugInput(image)
-        # Transformations to model shapes
-        if self.augmentations is not None:
-            augs = self.augmentations(image)
-        else:
-            augs = T.AugmentationList([])
-
-        transform = augs(auginput)
-        image = torch.from_numpy(auginput.image.copy().transpose(2, 0, 1))
-
-        annos = [
-            utils.transform_instance_annotations(annotation, [transform], image.shape[1:])
-            for annotation in dataset_dict.pop("annotations")
-            if annotation["redshift"] != 0.0
-        ]
-
-        instances = utils.annotations_to_instances(annos, image.shape[1:])
-
-        instances.gt_redshift = torch.tensor([a["redshift"] for a in annos])
-
-        instances = utils.filter_empty_instances(instances)
-
-        return {
-            # create the format that the model expects
-            "image": image,
-            "image_shaped": auginput.image,
-            "height": image.shape[1],
-            "width": image.shape[2],
-            "image_id": dataset_dict["image_id"],
-            "instances": instances,
-            "annotations": annos
-        }
+        auginput, transform, image = self._augment(image)
+
+        with self.timer.stage("annotations"):
+            annos = [
+                utils.transform_instance_annotations(annotation, [transform], image.shape[1:])
+                for annotation in dataset_dict.pop("annotations")
+                if annotation["redshift"] != 0.0
+            ]
+
+            instances = utils.annotations_to_instances(annos, image.shape[1:])
+
+            instances.gt_redshift = torch.tensor([a["redshift"] for a in annos])
+
+            instances = utils.filter_empty_instances(instances)
+
+        return self._finalize(
+            {
+                # create the format that the model expects
+                "image": image,
+                "image_shaped": auginput.image,
+                "height": image.shape[1],
+                "width": image.shape[2],
+                "image_id": dataset_dict["image_id"],
+                "instances": instances,
+                "annotations": annos
+            }
+        )
     
     
 class GoldRedshiftDictMapper(DataMapper):
@@ -226,42 +274,36 @@ class GoldRedshiftDictMapper(DataMapper):
         """
 
         dataset_dict = copy.deepcopy(dataset_dict)
-        key = self.km(dataset_dict)
-        image = self.IR(key)
+        image = self._read_image(dataset_dict)
 
         # Data Augmentation
-        auginput = T.AugInput(image)
-        # Transformations to model shapes
-        if self.augmentations is not None:
-            augs = self.augmentations(image)
-        else:
-            augs = T.AugmentationList([])
-
-        transform = augs(auginput)
-        image = torch.from_numpy(auginput.image.copy().transpose(2, 0, 1))
-
-        annos = [
-            utils.transform_instance_annotations(annotation, [transform], image.shape[1:])
-            for annotation in dataset_dict.pop("annotations")
-            if annotation["redshift"] != 0.0 and annotation["mag_i"] < 25.3
-        ]
-
-        instances = utils.annotations_to_instances(annos, image.shape[1:])
-
-        instances.gt_redshift = torch.tensor([a["redshift"] for a in annos])
-
-        instances = utils.filter_empty_instances(instances)
-
-        return {
-            # create the format that the model expects
-            "image": image,
-            "image_shaped": auginput.image,
-            "height": image.shape[1],
-            "width": image.shape[2],
-            "image_id": dataset_dict["image_id"],
-            "instances": instances,
-            "annotations": annos
-        }
+        auginput, transform, image = self._augment(image)
+
+        with self.timer.stage("annotations"):
+            annos = [
+                utils.transform_instance_annotations(annotation, [transform], image.shape[1:])
+                for annotation in dataset_dict.pop("annotations")
+                if annotation["redshift"] != 0.0 and annotation["mag_i"] < 25.3
+            ]
+
+            instances = utils.annotations_to_instances(annos, image.shape[1:])
+
+            instances.gt_redshift = torch.tensor([a["redshift"] for a in annos])
+
+            instances = utils.filter_empty_instances(instances)
+
+        return self._finalize(
+            {
+                # create the format that the model expects
+                "image": image,
+                "image_shaped": auginput.image,
+                "height": image.shape[1],
+                "width": image.shape[2],
+                "image_id": dataset_dict["image_id"],
+                "instances": instances,
+                "annotations": annos
+            }
+        )
 
     
 class RedshiftEBVDictMapper(DataMapper):
@@ -283,43 +325,37 @@ class RedshiftEBVDictMapper(DataMapper):
         """
 
         dataset_dict = copy.deepcopy(dataset_dict)
-        key = self.km(dataset_dict)
-        image = self.IR(key)
+        image = self._read_image(dataset_dict)
 
         # Data Augmentation
-        auginput = T.AugInput(image)
-        # Transformations to model shapes
-        if self.augmentations is not None:
-            augs = self.augmentations(image)
-        else:
-            augs = T.AugmentationList([])
-
-        transform = augs(auginput)
-        image = torch.from_numpy(auginput.image.copy().transpose(2, 0, 1))
-
-        annos = [
-            utils.transform_instance_annotations(annotation, [transform], image.shape[1:])
-            for annotation in dataset_dict.pop("annotations")
-            if annotation["redshift"] != 0.0
-        ]
-
-        instances = utils.annotations_to_instances(annos, image.shape[1:])
-
-        instances.gt_redshift = torch.tensor([a["redshift"] for a in annos])
-        instances.gt_ebv = torch.tensor([a["EBV"] for a in annos])
-
-        instances = utils.filter_empty_instances(instances)
-
-        return {
-            # create the format that the model expects
-            "image": image,
-            "image_shaped": auginput.image,
-            "height": image.shape[1],
-            "width": image.shape[2],
-            "image_id": dataset_dict["image_id"],
-            "instances": instances,
-            #"annotations": annos
-        }
+        auginput, transform, image = self._augment(image)
+
+        with self.timer.stage("annotations"):
+            annos = [
+                utils.transform_instance_annotations(annotation, [transform], image.shape[1:])
+                for annotation in dataset_dict.pop("annotations")
+                if annotation["redshift"] != 0.0
+            ]
+
+            instances = utils.annotations_to_instances(annos, image.shape[1:])
+
+            instances.gt_redshift = torch.tensor([a["redshift"] for a in annos])
+            instances.gt_ebv = torch.tensor([a["EBV"] for a in annos])
+
+            instances = utils.filter_empty_instances(instances)
+
+        return self._finalize(
+            {
+                # create the format that the model expects
+                "image": image,
+                "image_shaped": auginput.image,
+                "height": image.shape[1],
+                "width": image.shape[2],
+                "image_id": dataset_dict["image_id"],
+                "instances": instances,
+                #"annotations": annos
+            }
+        )
     
     
 class GoldRedshiftDictMapperEval(DataMapper):
@@ -341,22 +377,14 @@ class GoldRedshiftDictMapperEval(DataMapper):
         """
 
         dataset_dict = copy.deepcopy(dataset_dict)
-        key = self.km(dataset_dict)
-        image = self.IR(key)
+        image = self._read_image(dataset_dict)
 
         # Data Augmentation
-        auginput = T.AugInput(image)
-        # Transformations to model shapes
-        if self.augmentations is not None:
-            augs = self.augmentations(image)
-        else:
-            augs = T.AugmentationList([])
-
-        transform = augs(auginput)
-        image = torch.from_numpy(auginput.image.copy().transpose(2, 0, 1))
-
-        annotations = [annotation for annotation in dataset_dict["annotations"]
-                       if annotation["redshift"] != 0.0 and annotation["mag_i"] < 25.3]
+        auginput, transform, image = self._augment(image)
+
+        with self.timer.stage("annotations"):
+            annotations = [annotation for annotation in dataset_dict["annotations"]
+                           if annotation["redshift"] != 0.0 and annotation["mag_i"] < 25.3]
         
         #annos = [
         #    utils.transform_instance_annotations(annotation, [transform], image.shape[1:])
@@ -370,16 +398,18 @@ class GoldRedshiftDictMapperEval(DataMapper):
 
         #instances = utils.filter_empty_instances(instances)
 
-        return {
-            # create the format that the model expects
-            "image": image,
-            "image_shaped": auginput.image,
-            "height": image.shape[1],
-            "width": image.shape[2],
-            "image_id": dataset_dict["image_id"],
-            #"instances": instances,
-            "annotations": annotations
-        }
+        return self._finalize(
+            {
+                # create the format that the model expects
+                "image": image,
+                "image_shaped": auginput.image,
+                "height": image.shape[1],
+                "width": image.shape[2],
+                "image_id": dataset_dict["image_id"],
+                #"instances": instances,
+                "annotations": annotations
+            }
+        )
 
 
 
@@ -403,22 +433,14 @@ class RedshiftDictMapperEval(DataMapper):
         """
 
         dataset_dict = copy.deepcopy(dataset_dict)
-        key = self.km(dataset_dict)
-        image = self.IR(key)
+        image = self._read_image(dataset_dict)
 
         # Data Augmentation
-        auginput = T.AugInput(image)
-        # Transformations to model shapes
-        if self.augmentations is not None:
-            augs = self.augmentations(image)
-        else:
-            augs = T.AugmentationList([])
-
-        transform = augs(auginput)
-        image = torch.from_numpy(auginput.image.copy().transpose(2, 0, 1))
-
-        annotations = [annotation for annotation in dataset_dict["annotations"]
-                       if annotation["redshift"] != 0.0]
+        auginput, transform, image = self._augment(image)
+
+        with self.timer.stage("annotations"):
+            annotations = [annotation for annotation in dataset_dict["annotations"]
+                           if annotation["redshift"] != 0.0]
         
         #annos = [
         #    utils.transform_instance_annotations(annotation, [transform], image.shape[1:])
@@ -432,16 +454,18 @@ class RedshiftDictMapperEval(DataMapper):
 
         #instances = utils.filter_empty_instances(instances)
 
-        return {
-            # create the format that the model expects
-            "image": image,
-            "image_shaped": auginput.image,
-            "height": image.shape[1],
-            "width": image.shape[2],
-            "image_id": dataset_dict["image_id"],
-            #"instances": instances,
-            "annotations": annotations
-        }
+        return self._finalize(
+            {
+                # create the format that the model expects
+                "image": image,
+                "image_shaped": auginput.image,
+                "height": image.shape[1],
+                "width": image.shape[2],
+                "image_id": dataset_dict["image_id"],
+                #"instances": instances,
+                "annotations": annotations
+            }
+        )
 
 
 class WCSDictmapper(DataMapper):
@@ -463,31 +487,24 @@ class WCSDictmapper(DataMapper):
         """
 
         dataset_dict = copy.deepcopy(dataset_dict)
-        key = self.km(dataset_dict)
-        image = self.IR(key)
+        image = self._read_image(dataset_dict)
 
         # Data Augmentation
-        auginput = T.AugInput(image)
-        # Transformations to model shapes
-        if self.augmentations is not None:
-            augs = self.augmentations(image)
-        else:
-            augs = T.AugmentationList([])
-
-        transform = augs(auginput)
-        image = torch.from_numpy(auginput.image.copy().transpose(2, 0, 1))
-
-
-        return {
-            # create the format that the model expects
-            "image": image,
-            "image_shaped": auginput.image,
-            "height": image.shape[1],
-            "width": image.shape[2],
-            #"image_id": dataset_dict["image_id"],
-            #"instances": instances,
-            "wcs": dataset_dict['wcs']
-        }
+        auginput, transform, image = self._augment(image)
+
+
+        return self._finalize(
+            {
+                # create the format that the model expects
+                "image": image,
+                "image_shaped": auginput.image,
+                "height": image.shape[1],
+                "width": image.shape[2],
+                #"image_id": dataset_dict["image_id"],
+                #"instances": instances,
+                "wcs": dataset_dict['wcs']
+            }
+        )
 
     
     
@@ -510,53 +527,83 @@ class RedshiftEBVDictMapper(DataMapper):
         """
 
         dataset_dict = copy.deepcopy(dataset_dict)
-        key = self.km(dataset_dict)
-        image = self.IR(key)
+        image = self._read_image(dataset_dict)
 
         # Data Augmentation
-        auginput = T.AugInput(image)
-        # Transformations to model shapes
-        if self.augmentations is not None:
-            augs = self.augmentations(image)
-        else:
-            augs = T.AugmentationList([])
-
-        transform = augs(auginput)
-        image = torch.from_numpy(auginput.image.copy().transpose(2, 0, 1))
-
-        annos = [
-            utils.transform_instance_annotations(annotation, [transform], image.shape[1:])
-            for annotation in dataset_dict.pop("annotations")
-            if annotation["redshift"] != 0.0
-        ]
-
-        instances = utils.annotations_to_instances(annos, image.shape[1:])
-
-        instances.gt_redshift = torch.tensor([a["redshift"] for a in annos])
-        instances.gt_ebv = torch.tensor([a["EBV"] for a in annos])
-
-        instances = utils.filter_empty_instances(instances)
-
-        return {
-            # create the format that the model expects
-            "image": image,
-            "image_shaped": auginput.image,
-            "height": image.shape[1],
-            "width": image.shape[2],
-            "image_id": dataset_dict["image_id"],
-            "instances": instances,
-            #"annotations": annos
-        }
+        auginput, transform, image = self._augment(image)
+
+        with self.timer.stage("annotations"):
+            annos = [
+                utils.transform_instance_annotations(annotation, [transform], image.shape[1:])
+                for annotation in dataset_dict.pop("annotations")
+                if annotation["redshift"] != 0.0
+            ]
+
+            instances = utils.annotations_to_instances(annos, image.shape[1:])
+
+            instances.gt_redshift = torch.tensor([a["redshift"] for a in annos])
+            instances.gt_ebv = torch.tensor([a["EBV"] for a in annos])
+
+            instances = utils.filter_empty_instances(instances)
+
+        return self._finalize(
+            {
+                # create the format that the model expects
+                "image": image,
+                "image_shaped": auginput.image,
+                "height": image.shape[1],
+                "width": image.shape[2],
+                "image_id": dataset_dict["image_id"],
+                "instances": instances,
+                #"annotations": annos
+            }
+        )
 
     
 
-def return_train_loader(cfg, mapper):
+class TimedCollator:
+    """Wrap a batch collate function to time it as the "collation" stage
+
+    The interval is attached to the "timings" of the first sample of the batch, like the
+    stage timings of the data mappers, so it reaches the training process when the batch
+    is collated in a data loader worker.
+
+    Parameters
+    ----------
+    collate_fn : function
+        The collate function, by default detectron2's trivial_batch_collator
+    """
+
+    def __init__(self, collate_fn=None):
+        self.collate_fn = collate_fn if collate_fn is not None else trivial_batch_collator
+        self.timer = StageTimer(enabled=True)
+
+    def __call__(self, batch):
+        with self.timer.stage("collation"):
+            batch = self.collate_fn(batch)
+        if len(batch) and isinstance(batch[0], dict):
+            batch[0]["timings"] = batch[0].get("timings", []) + self.timer.pop_sample_timings()
+        return batch
+
+
+def return_train_loader(cfg, mapper, sampler=None, batch_augs=None, batch_aug_device=None, profile=False):
     """Returns a train loader
 
     Parameters
     ----------
     cfg : LazyConfig
         The lazy config, which contains data loader config values
+    sampler : torch.utils.data.Sampler
+        Optional sampler of dataset indices, e.g. a
+        deepdisc.data_format.dihedral.DihedralVariantSampler for materialised
+        dihedral variants. Default: the sampler given in the config
+    batch_augs : list
+        Optional augmentations from deepdisc.data_format.batch_augment, applied to each
+        collated batch after the loader instead of per sample in the workers
+    batch_aug_device : str
+        Device for the batch augmentations. Default: cuda if available, else cpu
+    profile : bool
+        If True, time the batch collation as its own stage (see TimedCollator)
 
     **kwargs for the read_image functionality
 
@@ -564,7 +611,12 @@ def return_train_loader(cfg, mapper):
     -------
         a train loader
     """
-    loader = data.build_detection_train_loader(cfg, mapper=mapper)
+    collate_fn = TimedCollator() if profile else None
+    loader = data.build_detection_train_loader(cfg, mapper=mapper, sampler=sampler, collate_fn=collate_fn)
+    if batch_augs:
+        from deepdisc.data_format.batch_augment import BatchAugmentedLoader
+
+        loader = BatchAugmentedLoader(loader, batch_augs, device=batch_aug_device)
     return loader
 
 
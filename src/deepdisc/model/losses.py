@@ -0,0 +1,110 @@
+"""Gaussian mixture density network (MDN) log-likelihoods for the redshift PDF heads.
+
+The redshift PDF heads output, for every instance, K mixture logits, K means and K raw
+scales.  These functions compute the log density of the mixture directly with logsumexp,
+equal to Independent(MixtureSameFamily(Categorical(logits), Normal(means, scales)), 0).log_prob
+but without building the distribution objects (and validating their arguments) at every
+step, and for a whole grid of redshifts at once.
+"""
+
+import math
+
+import torch
+from torch.nn import functional as F
+
+_LOG_SQRT_2PI = 0.5 * math.log(2 * math.pi)
+
+SCALE_ACTIVATIONS = ("exp", "softplus")
+
+
+def _split_outputs(inputs, num_components, scale_activation):
+    """The log mixture weights, means, log scales and inverse scales of MDN outputs"""
+    if scale_activation not in SCALE_ACTIVATIONS:
+        raise ValueError(f"scale_activation must be one of {SCALE_ACTIVATIONS}, got {scale_activation}")
+    log_weights = F.log_softmax(inputs[..., :num_components], dim=-1)
+    means = inputs[..., num_components : 2 * num_components]
+    raw_scales = inputs[..., 2 * num_components :]
+    if scale_activation == "exp":
+        log_scales = raw_scales
+        inv_scales = torch.exp(-raw_scales)
+    else:
+        scales = F.softplus(raw_scales)
+        log_scales = torch.log(scales)
+        inv_scales = 1 / scales
+    return log_weights, means, log_scales, inv_scales
+
+
+def mdn_log_prob(inputs, z, num_components, scale_activation="exp"):
+    """Log density of each instance's Gaussian mixture at its redshift
+
+    Parameters
+    ----------
+    inputs : torch.Tensor
+        The (N, 3 * num_components) outputs of a redshift PDF head: mixture logits, means
+        and raw scales
+    z : torch.Tensor
+        (N,) redshifts, one per instance
+    num_components : int
+        Number of gaussian components
+    scale_activation : str
+        "exp" or "softplus", the map from the raw outputs to the standard deviations
+
+    Returns
+    -------
+    torch.Tensor
+        The (N,) log densities
+    """
+    log_weights, means, log_scales, inv_scales = _split_outputs(inputs, num_components, scale_activation)
+    zscores = (z.to(inputs.dtype)[..., None] - means) * inv_scales
+    return torch.logsumexp(log_weights - 0.5 * zscores**2 - log_scales, dim=-1) - _LOG_SQRT_2PI
+
+
+def mdn_log_prob_grid(inputs, zs, num_components, scale_activation="exp"):
+    """Log densities of every instance's mixture on a grid of redshifts
+
+    Parameters
+    ----------
+    inputs : torch.Tensor
+        The (N, 3 * num_components) outputs of a redshift PDF head
+    zs : torch.Tensor
+        The (M,) grid of redshifts
+    num_components : int
+        Number of gaussian components
+    scale_activation : str
+        "exp" or "softplus"
+
+    Returns
+    -------
+    torch.Tensor
+        The (N, M) log densities
+    """
+    log_weights, means, log_scales, inv_scales = _split_outputs(inputs[:, None, :], num_components, scale_activation)
+    zscores = (zs.to(inputs.dtype)[None, :, None] - means) * inv_scales
+    return torch.logsumexp(log_weights - 0.5 * zscores**2 - log_scales, dim=-1) - _LOG_SQRT_2PI
+
+
+def mdn_nll(inputs, z, num_components, scale_activation="exp", zbins=None, bin_weights=None):
+    """Negative log-likelihood of the true redshifts under the predicted mixtures
+
+    Parameters
+    ----------
+    inputs : torch.Tensor
+        The (N, 3 * num_components) outputs of a redshift PDF head
+    z : torch.Tensor
+        The (N,) true redshifts
+    num_components : int
+        Number of gaussian components
+    scale_activation : str
+        "exp" or "softplus"
+    zbins, bin_weights : torch.Tensor
+        If given, the NLL of each instance is multiplied by bin_weights[torch.bucketize(z, zbins)]
+
+    Returns
+    -------
+    torch.Tensor
+        The (N,) (weighted) negative log-likelihoods
+    """
+    nlls = -mdn_log_prob(inputs, z, num_components, scale_activation)
+    if zbins is not None:
+        nlls = nlls * bin_weights[torch.bucketize(z, zbins)]
+    return nlls
@@ -16,9 +16,25 @@ from torch.distributions.independent import Independent
 from torch.distributions.mixture_same_family import MixtureSameFamily
 from torch.distributions.normal import Normal
 from torch.nn import functional as F
+from torch.nn.parallel import DistributedDataParallel
 
+from deepdisc.model.feature_cache import FeatureCacheRCNN
+from deepdisc.model.losses import mdn_log_prob_grid, mdn_nll
+from deepdisc.model.pooling import pool_subset, share_roi_pooling
 
-def return_lazy_model(cfg, freeze=True):
+
+def _split_per_image(x, instances):
+    """Split per-instance outputs of a batch into one tensor per image
+
+    A single image gets the whole tensor, so a traced model (deepdisc.inference.export)
+    does not record its number of detections as a constant.
+    """
+    if len(instances) == 1:
+        return [x]
+    return x.split([len(i) for i in instances])
+
+
+def return_lazy_model(cfg, freeze=True, feature_store=None):
     """Return a model formed from a LazyConfig with the backbone
     frozen. Only the head layers will be trained.
 
@@ -26,6 +42,11 @@ def return_lazy_model(cfg, freeze=True):
     ----------
     cfg : .py file
         a LazyConfig
+    freeze : bool
+        Freeze everything except the ROI heads and the proposal generator
+    feature_store : deepdisc.model.feature_cache.FeatureStore
+        If given (with freeze=True), wrap the model in a FeatureCacheRCNN so the frozen
+        backbone features are computed once per (image, dihedral variant)
 
     Returns
     -------
@@ -42,6 +63,8 @@ def return_lazy_model(cfg, freeze=True):
         # Phase 2: Unfreeze region proposal generator with reduced lr
         for param in model.proposal_generator.parameters():
             param.requires_grad = True
+        if feature_store is not None:
+            model = FeatureCacheRCNN(model, feature_store)
 
     model.to(cfg.train.device)
     model = create_ddp_model(model, **cfg.train.ddp)
@@ -49,6 +72,40 @@ def return_lazy_model(cfg, freeze=True):
     return model
 
 
+def unfreeze_lazy_model(model, cfg):
+    """Unfreeze all the layers of a model returned by return_lazy_model(cfg, freeze=True)
+
+    DistributedDataParallel only reduces the gradients of parameters that required
+    grad when it was constructed, so the underlying model is re-wrapped after
+    unfreezing. A FeatureCacheRCNN wrapper is removed, since the backbone features
+    change once the backbone trains. The weights, their device and the data loaders
+    are untouched.
+
+    Parameters
+    ----------
+    model : torch model
+        The (possibly DDP-wrapped) model from the frozen training phase
+    cfg : .py file
+        a LazyConfig
+
+    Returns
+    -------
+        torch model with every parameter trainable
+    """
+    if isinstance(model, DistributedDataParallel):
+        model = model.module
+    if isinstance(model, FeatureCacheRCNN):
+        model.store.clear()
+        model = model.model
+
+    for param in model.parameters():
+        param.requires_grad = True
+
+    model = create_ddp_model(model, **cfg.train.ddp)
+
+    return model
+
+
 
 class WeightedRedshiftPDFCasROIHeads(CascadeROIHeads):
     """CascadeROIHead with added redshift pdf capability.  Follows the detectron2 CascadeROIHead class init, except for
@@ -57,6 +114,9 @@ class WeightedRedshiftPDFCasROIHeads(CascadeROIHeads):
     ----------
     num_components : int
         Number of gaussian components in the Mixture Density Network
+    share_pooling : bool
+        Reuse the features pooled by the box (and mask) heads in the redshift head
+        instead of pooling the same boxes again, see deepdisc.model.pooling
     """
 
     # def __init__(self, cfg, input_shape):
@@ -72,6 +132,7 @@ class WeightedRedshiftPDFCasROIHeads(CascadeROIHeads):
         box_heads: List[nn.Module],
         box_predictors: List[nn.Module],
         proposal_matchers: List[Matcher],
+        share_pooling: bool = False,
         **kwargs,
     ):
         super().__init__(
@@ -89,12 +150,16 @@ class WeightedRedshiftPDFCasROIHeads(CascadeROIHeads):
             sampling_ratio=0,
             pooler_type="ROIAlignV2",
         )
+        if share_pooling:
+            share_roi_pooling(self)
         
         in_channels = 256
         inshape = ShapeSpec(channels=in_channels, height=7, width=7)
 
         self._output_size = (inshape.channels, inshape.height, inshape.width)
         self.num_components = num_components
+        # the redshifts the PDFs are evaluated on at inference
+        self.zgrid = np.linspace(0, 5, 200)
         
         #self.dummy_param = nn.Parameter(torch.empty(0))
         
@@ -132,12 +197,16 @@ class WeightedRedshiftPDFCasROIHeads(CascadeROIHeads):
     def _forward_redshift(self, features, instances):
         
         if self.training:
-            instances, _ = select_foreground_proposals(instances, self.num_classes)
+            proposals = instances
+            instances, fg_masks = select_foreground_proposals(instances, self.num_classes)
         
         if self.redshift_pooler is not None:
             features = [features[f] for f in self.box_in_features]
-            boxes = [x.proposal_boxes if self.training else x.pred_boxes for x in instances]
-            features = self.redshift_pooler(features, boxes)
+            if self.training:
+                boxes = [x.proposal_boxes for x in proposals]
+                features = pool_subset(self.redshift_pooler, features, boxes, fg_masks)
+            else:
+                features = self.redshift_pooler(features, [x.pred_boxes for x in instances])
 
         features = nn.Flatten()(features)
         #ebvs = cat([x.gt_ebv for x in instances])
@@ -147,13 +216,11 @@ class WeightedRedshiftPDFCasROIHeads(CascadeROIHeads):
 
         if self.training:
             fcs = self.redshift_fc(features)
-            pdfs = self.output_pdf(fcs)
 
             gt_redshifts = cat([x.gt_redshift for x in instances])
 
-            sample_bins = torch.bucketize(gt_redshifts,self.zbins)
-            sample_weights = self.weights[sample_bins]
-            nlls = -pdfs.log_prob(gt_redshifts) * self.zloss_factor * sample_weights
+            nlls = mdn_nll(fcs, gt_redshifts, self.num_components, zbins=self.zbins, bin_weights=self.weights)
+            nlls = nlls * self.zloss_factor
 
 
             return {"redshift_loss": torch.mean(nlls)}
@@ -165,21 +232,17 @@ class WeightedRedshiftPDFCasROIHeads(CascadeROIHeads):
                 return instances
                 
             fcs = self.redshift_fc(features)
-            pdfs = self.output_pdf(fcs)
-            zs = torch.tensor(np.linspace(0, 5, 200)).to(fcs.device)
+            zs = torch.tensor(self.zgrid).to(fcs.device)
             nin = torch.as_tensor(np.array([num_instances_per_img]))
             #probs = torch.zeros((num_instances_per_img[0], 200)).to(fcs.device)
 
-            inds = np.cumsum(num_instances_per_img)
 
             
 
-            probs = torch.zeros((torch.sum(nin), 200)).to(fcs.device)
-            for j, z in enumerate(zs):
-                probs[:, j] = pdfs.log_prob(z)
+            probs = mdn_log_prob_grid(fcs, zs, self.num_components)
 
-            for i, pred_instances in enumerate(instances):
-                pred_instances.pred_redshift_pdf = np.split(probs,inds)[i]
+            for pred_instances, image_probs in zip(instances, _split_per_image(probs, instances)):
+                pred_instances.pred_redshift_pdf = image_probs
 
             return instances
 
@@ -210,6 +273,9 @@ class CNNRedshiftPDFCasROIHeads(CascadeROIHeads):
     ----------
     num_components : int
         Number of gaussian components in the Mixture Density Network
+    share_pooling : bool
+        Reuse the features pooled by the box (and mask) heads in the redshift head
+        instead of pooling the same boxes again, see deepdisc.model.pooling
     """
 
     # def __init__(self, cfg, input_shape):
@@ -223,6 +289,7 @@ class CNNRedshiftPDFCasROIHeads(CascadeROIHeads):
         box_heads: List[nn.Module],
         box_predictors: List[nn.Module],
         proposal_matchers: List[Matcher],
+        share_pooling: bool = False,
         **kwargs,
     ):
         super().__init__(
@@ -240,12 +307,16 @@ class CNNRedshiftPDFCasROIHeads(CascadeROIHeads):
             sampling_ratio=0,
             pooler_type="ROIAlignV2",
         )
+        if share_pooling:
+            share_roi_pooling(self)
 
         in_channels = 256
         inshape = ShapeSpec(channels=in_channels, height=7, width=7)
 
         self._output_size = (inshape.channels, inshape.height, inshape.width)
         self.num_components = num_components
+        # the redshifts the PDFs are evaluated on at inference
+        self.zgrid = np.linspace(0, 3, 300)
         self.zloss_factor = zloss_factor
 
         self.redshift_conv = nn.Sequential(
@@ -279,12 +350,16 @@ class CNNRedshiftPDFCasROIHeads(CascadeROIHeads):
     def _forward_redshift(self, features, instances):
         
         if self.training:
-            instances, _ = select_foreground_proposals(instances, self.num_classes)
+            proposals = instances
+            instances, fg_masks = select_foreground_proposals(instances, self.num_classes)
         
         if self.redshift_pooler is not None:
             features = [features[f] for f in self.box_in_features]
-            boxes = [x.proposal_boxes if self.training else x.pred_boxes for x in instances]
-            features = self.redshift_pooler(features, boxes)
+            if self.training:
+                boxes = [x.proposal_boxes for x in proposals]
+                features = pool_subset(self.redshift_pooler, features, boxes, fg_masks)
+            else:
+                features = self.redshift_pooler(features, [x.pred_boxes for x in instances])
         
         #features = nn.Flatten()(features)
         #ebvs = cat([x.gt_ebv for x in instances])
@@ -295,10 +370,9 @@ class CNNRedshiftPDFCasROIHeads(CascadeROIHeads):
 
         if self.training:
             fcs = self.redshift_conv(features)
-            pdfs = self.output_pdf(fcs)
 
             gt_redshifts = cat([x.gt_redshift for x in instances])
-            nlls = -pdfs.log_prob(gt_redshifts) * self.zloss_factor
+            nlls = mdn_nll(fcs, gt_redshifts, self.num_components) * self.zloss_factor
 
             return {"redshift_loss": torch.mean(nlls)}
 
@@ -309,21 +383,17 @@ class CNNRedshiftPDFCasROIHeads(CascadeROIHeads):
                 return instances
                 
             fcs = self.redshift_conv(features)
-            pdfs = self.output_pdf(fcs)
-            zs = torch.tensor(np.linspace(0, 3, 300)).to(fcs.device)
+            zs = torch.tensor(self.zgrid).to(fcs.device)
             nin = torch.as_tensor(np.array([num_instances_per_img]))
             #probs = torch.zeros((num_instances_per_img[0], 200)).to(fcs.device)
 
-            inds = np.cumsum(num_instances_per_img)
 
             
 
-            probs = torch.zeros((torch.sum(nin), 300)).to(fcs.device)
-            for j, z in enumerate(zs):
-                probs[:, j] = pdfs.log_prob(z)
+            probs = mdn_log_prob_grid(fcs, zs, self.num_components)
 
-            for i, pred_instances in enumerate(instances):
-                pred_instances.pred_redshift_pdf = np.split(probs,inds)[i]
+            for pred_instances, image_probs in zip(instances, _split_per_image(probs, instances)):
+                pred_instances.pred_redshift_pdf = image_probs
                 
             
             #for i, pred_instances in enumerate(instances):
@@ -366,6 +436,9 @@ class RedshiftPDFCasROIHeadsGold(CascadeROIHeads):
     ----------
     num_components : int
         Number of gaussian components in the Mixture Density Network
+    share_pooling : bool
+        Reuse the features pooled by the box (and mask) heads in the redshift head
+        instead of pooling the same boxes again, see deepdisc.model.pooling
     """
 
     # def __init__(self, cfg, input_shape):
@@ -379,6 +452,7 @@ class RedshiftPDFCasROIHeadsGold(CascadeROIHeads):
         box_heads: List[nn.Module],
         box_predictors: List[nn.Module],
         proposal_matchers: List[Matcher],
+        share_pooling: bool = False,
         **kwargs,
     ):
         super().__init__(
@@ -396,12 +470,16 @@ class RedshiftPDFCasROIHeadsGold(CascadeROIHeads):
             sampling_ratio=0,
             pooler_type="ROIAlignV2",
         )
+        if share_pooling:
+            share_roi_pooling(self)
 
         in_channels = 256
         inshape = ShapeSpec(channels=in_channels, height=7, width=7)
 
         self._output_size = (inshape.channels, inshape.height, inshape.width)
         self.num_components = num_components
+        # the redshifts the PDFs are evaluated on at inference
+        self.zgrid = np.linspace(0, 5, 200)
         self.zloss_factor = zloss_factor
 
 
@@ -432,18 +510,27 @@ class RedshiftPDFCasROIHeadsGold(CascadeROIHeads):
     def _forward_redshift(self, features, instances):
         
         if self.training:
-            finstances, _ = select_foreground_proposals(instances, self.num_classes)
+            proposals = instances
+            finstances, fg_masks = select_foreground_proposals(instances, self.num_classes)
             instances = []
-            for x in finstances:
-                gold_inst = x[x.gt_magi < 25.3]
+            gold_masks = []
+            for x, fg_mask in zip(finstances, fg_masks):
+                gold = x.gt_magi < 25.3
+                gold_inst = x[gold]
                 instances.append(gold_inst)
+                gold_mask = fg_mask.clone()
+                gold_mask[fg_mask] = gold
+                gold_masks.append(gold_mask)
             if len(instances)==0:
                 return 0
                 
         if self.redshift_pooler is not None:
             features = [features[f] for f in self.box_in_features]
-            boxes = [x.proposal_boxes if self.training else x.pred_boxes for x in instances]
-            features = self.redshift_pooler(features, boxes)
+            if self.training:
+                boxes = [x.proposal_boxes for x in proposals]
+                features = pool_subset(self.redshift_pooler, features, boxes, gold_masks)
+            else:
+                features = self.redshift_pooler(features, [x.pred_boxes for x in instances])
         
         features = nn.Flatten()(features)
         #ebvs = cat([x.gt_ebv for x in instances])
@@ -453,10 +540,9 @@ class RedshiftPDFCasROIHeadsGold(CascadeROIHeads):
 
         if self.training:
             fcs = self.redshift_fc(features)
-            pdfs = self.output_pdf(fcs)
 
             gt_redshifts = cat([x.gt_redshift for x in instances])
-            nlls = -pdfs.log_prob(gt_redshifts) * self.zloss_factor
+            nlls = mdn_nll(fcs, gt_redshifts, self.num_components) * self.zloss_factor
 
             return {"redshift_loss": torch.mean(nlls)}
 
@@ -467,21 +553,17 @@ class RedshiftPDFCasROIHeadsGold(CascadeROIHeads):
                 return instances
                 
             fcs = self.redshift_fc(features)
-            pdfs = self.output_pdf(fcs)
-            zs = torch.tensor(np.linspace(0, 5, 200)).to(fcs.device)
+            zs = torch.tensor(self.zgrid).to(fcs.device)
             nin = torch.as_tensor(np.array([num_instances_per_img]))
             #probs = torch.zeros((num_instances_per_img[0], 200)).to(fcs.device)
 
-            inds = np.cumsum(num_instances_per_img)
 
             
 
-            probs = torch.zeros((torch.sum(nin), 200)).to(fcs.device)
-            for j, z in enumerate(zs):
-                probs[:, j] = pdfs.log_prob(z)
+            probs = mdn_log_prob_grid(fcs, zs, self.num_components)
 
-            for i, pred_instances in enumerate(instances):
-                pred_instances.pred_redshift_pdf = np.split(probs,inds)[i]
+            for pred_instances, image_probs in zip(instances, _split_per_image(probs, instances)):
+                pred_instances.pred_redshift_pdf = image_probs
 
             return instances
 
@@ -513,6 +595,9 @@ class RedshiftPDFCasROIHeads(CascadeROIHeads):
     ----------
     num_components : int
         Number of gaussian components in the Mixture Density Network
+    share_pooling : bool
+        Reuse the features pooled by the box (and mask) heads in the redshift head
+        instead of pooling the same boxes again, see deepdisc.model.pooling
     """
 
     # def __init__(self, cfg, input_shape):
@@ -526,6 +611,7 @@ class RedshiftPDFCasROIHeads(CascadeROIHeads):
         box_heads: List[nn.Module],
         box_predictors: List[nn.Module],
         proposal_matchers: List[Matcher],
+        share_pooling: bool = False,
         **kwargs,
     ):
         super().__init__(
@@ -543,12 +629,16 @@ class RedshiftPDFCasROIHeads(CascadeROIHeads):
             sampling_ratio=0,
             pooler_type="ROIAlignV2",
         )
+        if share_pooling:
+            share_roi_pooling(self)
 
         in_channels = 256
         inshape = ShapeSpec(channels=in_channels, height=7, width=7)
 
         self._output_size = (inshape.channels, inshape.height, inshape.width)
         self.num_components = num_components
+        # the redshifts the PDFs are evaluated on at inference
+        self.zgrid = np.linspace(0, 3, 300)
         self.zloss_factor = zloss_factor
 
 
@@ -579,12 +669,16 @@ class RedshiftPDFCasROIHeads(CascadeROIHeads):
     def _forward_redshift(self, features, instances):
         
         if self.training:
-            instances, _ = select_foreground_proposals(instances, self.num_classes)
+            proposals = instances
+            instances, fg_masks = select_foreground_proposals(instances, self.num_classes)
         
         if self.redshift_pooler is not None:
             features = [features[f] for f in self.box_in_features]
-            boxes = [x.proposal_boxes if self.training else x.pred_boxes for x in instances]
-            features = self.redshift_pooler(features, boxes)
+            if self.training:
+                boxes = [x.proposal_boxes for x in proposals]
+                features = pool_subset(self.redshift_pooler, features, boxes, fg_masks)
+            else:
+                features = self.redshift_pooler(features, [x.pred_boxes for x in instances])
         
         features = nn.Flatten()(features)
         #ebvs = cat([x.gt_ebv for x in instances])
@@ -594,10 +688,9 @@ class RedshiftPDFCasROIHeads(CascadeROIHeads):
 
         if self.training:
             fcs = self.redshift_fc(features)
-            pdfs = self.output_pdf(fcs)
 
             gt_redshifts = cat([x.gt_redshift for x in instances])
-            nlls = -pdfs.log_prob(gt_redshifts) * self.zloss_factor
+            nlls = mdn_nll(fcs, gt_redshifts, self.num_components) * self.zloss_factor
 
             return {"redshift_loss": torch.mean(nlls)}
 
@@ -608,21 +701,17 @@ class RedshiftPDFCasROIHeads(CascadeROIHeads):
                 return instances
                 
             fcs = self.redshift_fc(features)
-            pdfs = self.output_pdf(fcs)
-            zs = torch.tensor(np.linspace(0, 3, 300)).to(fcs.device)
+            zs = torch.tensor(self.zgrid).to(fcs.device)
             nin = torch.as_tensor(np.array([num_instances_per_img]))
             #probs = torch.zeros((num_instances_per_img[0], 200)).to(fcs.device)
 
-            inds = np.cumsum(num_instances_per_img)
 
             
 
-            probs = torch.zeros((torch.sum(nin), 300)).to(fcs.device)
-            for j, z in enumerate(zs):
-                probs[:, j] = pdfs.log_prob(z)
+            probs = mdn_log_prob_grid(fcs, zs, self.num_components)
 
-            for i, pred_instances in enumerate(instances):
-                pred_instances.pred_redshift_pdf = np.split(probs,inds)[i]
+            for pred_instances, image_probs in zip(instances, _split_per_image(probs, instances)):
+                pred_instances.pred_redshift_pdf = image_probs
                 
             
             #for i, pred_instances in enumerate(instances):
@@ -701,6 +790,8 @@ class OldRedshiftPDFCasROIHeads(CascadeROIHeads):
 
         self._output_size = (inshape.channels, inshape.height, inshape.width)
         self.num_components = num_components
+        # the redshifts the PDFs are evaluated on at inference
+        self.zgrid = np.linspace(-1, 5, 200)
         self.zloss_factor = zloss_factor
 
 
@@ -747,10 +838,9 @@ class OldRedshiftPDFCasROIHeads(CascadeROIHeads):
 
         if self.training:
             fcs = self.redshift_fc(features)
-            pdfs = self.output_pdf(fcs)
 
             gt_redshifts = cat([x.gt_redshift for x in instances])
-            nlls = -pdfs.log_prob(gt_redshifts) * self.zloss_factor
+            nlls = mdn_nll(fcs, gt_redshifts, self.num_components, "softplus") * self.zloss_factor
 
             return {"redshift_loss": torch.mean(nlls)}
 
@@ -761,21 +851,17 @@ class OldRedshiftPDFCasROIHeads(CascadeROIHeads):
                 return instances
                 
             fcs = self.redshift_fc(features)
-            pdfs = self.output_pdf(fcs)
-            zs = torch.tensor(np.linspace(-1, 5, 200)).to(fcs.device)
+            zs = torch.tensor(self.zgrid).to(fcs.device)
             nin = torch.as_tensor(np.array([num_instances_per_img]))
             #probs = torch.zeros((num_instances_per_img[0], 200)).to(fcs.device)
 
-            inds = np.cumsum(num_instances_per_img)
 
             
 
-            probs = torch.zeros((torch.sum(nin), 200)).to(fcs.device)
-            for j, z in enumerate(zs):
-                probs[:, j] = pdfs.log_prob(z)
+            probs = mdn_log_prob_grid(fcs, zs, self.num_components, "softplus")
 
-            for i, pred_instances in enumerate(instances):
-                pred_instances.pred_redshift_pdf = np.split(probs,inds)[i]
+            for pred_instances, image_probs in zip(instances, _split_per_image(probs, instances)):
+                pred_instances.pred_redshift_pdf = image_probs
                 
             
             #for i, pred_instances in enumerate(instances):
@@ -824,6 +910,7 @@ class RedshiftPointCasROIHeads(CascadeROIHeads):
         box_heads: List[nn.Module],
         box_predictors: List[nn.Module],
         proposal_matchers: List[Matcher],
+        share_pooling: bool = False,
         **kwargs,
     ):
         super().__init__(
@@ -843,6 +930,8 @@ class RedshiftPointCasROIHeads(CascadeROIHeads):
             sampling_ratio=0,
             pooler_type="ROIAlignV2",
         )
+        if share_pooling:
+            share_roi_pooling(self)
         # in_channels = [input_shape[f].channels for f in in_features]
         # in_channels = in_channels[0]
         in_channels = 256
@@ -900,7 +989,7 @@ class RedshiftPointCasROIHeads(CascadeROIHeads):
             return {"redshift_loss": torch.square(diff).mean()}
             # return{"redshift_loss": torch.abs(diff).median()}
         else:
-            z_pred = torch.split(prediction, num_instances_per_img, dim=0)
+            z_pred = _split_per_image(prediction, instances)
             for z, pred_instances in zip(z_pred, instances):
                 pred_instances.pred_redshift = z
             return instances
@@ -942,6 +1031,7 @@ class RedshiftPointROIHeads(StandardROIHeads):
         keypoint_pooler: Optional[ROIPooler] = None,
         keypoint_head: Optional[nn.Module] = None,
         train_on_pred_boxes: bool = False,
+        share_pooling: bool = False,
         **kwargs,
     ):
         super().__init__(
@@ -965,8 +1055,10 @@ class RedshiftPointROIHeads(StandardROIHeads):
             sampling_ratio=0,
             pooler_type="ROIAlignV2",
         )
+        if share_pooling:
+            share_roi_pooling(self)
         
-        slef.zloss_factor = zloss_factor
+        self.zloss_factor = zloss_factor
 
         in_channels = 256
         inshape = ShapeSpec(channels=in_channels, height=7, width=7)
@@ -1006,7 +1098,7 @@ class RedshiftPointROIHeads(StandardROIHeads):
             # diff = prediction - cat([x.gt_redshift for x in instances])
             return {"redshift_loss": torch.square(diff).mean()}
         else:
-            z_pred = torch.split(prediction, num_instances_per_img, dim=0)
+            z_pred = _split_per_image(prediction, instances)
             for z, pred_instances in zip(z_pred, instances):
                 pred_instances.pred_redshift = z
             return instances
@@ -1052,6 +1144,9 @@ class RedshiftPDFROIHeads(StandardROIHeads):
     ----------
     num_components : int
         Number of gaussian components in the Mixture Density Network
+    share_pooling : bool
+        Reuse the features pooled by the box (and mask) heads in the redshift head
+        instead of pooling the same boxes again, see deepdisc.model.pooling
     """
 
     def __init__(
@@ -1070,6 +1165,7 @@ class RedshiftPDFROIHeads(StandardROIHeads):
         keypoint_pooler: Optional[ROIPooler] = None,
         keypoint_head: Optional[nn.Module] = None,
         train_on_pred_boxes: bool = False,
+        share_pooling: bool = False,
         **kwargs,
     ):
         super().__init__(
@@ -1093,6 +1189,8 @@ class RedshiftPDFROIHeads(StandardROIHeads):
             sampling_ratio=0,
             pooler_type="ROIAlignV2",
         )
+        if share_pooling:
+            share_roi_pooling(self)
 
         self.zloss_factor = zloss_factor
         
@@ -1103,6 +1201,8 @@ class RedshiftPDFROIHeads(StandardROIHeads):
         self._output_size = (inshape.channels, inshape.height, inshape.width)
 
         self.num_components = num_components
+        # the redshifts the PDFs are evaluated on at inference
+        self.zgrid = np.linspace(0, 5, 200)
 
         self.redshift_fc = nn.Sequential(
             # nn.Linear(int(np.prod(self._output_size)), self.num_components * 3)
@@ -1138,15 +1238,11 @@ class RedshiftPDFROIHeads(StandardROIHeads):
 
         if self.training:
             fcs = self.redshift_fc(features)
-            pdfs = self.output_pdf(fcs)
             gt_classes = cat([x.gt_classes for x in instances])
             fg_inds = nonzero_tuple((gt_classes >= 0) & (gt_classes < self.num_classes))[0]
-            pdfs_fg = self.output_pdf(fcs[fg_inds, ...])
 
             gt_redshifts = cat([x.gt_redshift for x in instances])
-            nlls_fg = -pdfs_fg.log_prob(gt_redshifts[fg_inds])
-
-            nlls = -pdfs.log_prob(gt_redshifts)[fg_inds] * self.zloss_factor
+            nlls = mdn_nll(fcs[fg_inds], gt_redshifts[fg_inds], self.num_components, "softplus") * self.zloss_factor
             return {"redshift_loss": torch.mean(nlls)}
 
         else:
@@ -1158,13 +1254,9 @@ class RedshiftPDFROIHeads(StandardROIHeads):
             #    if num_instances_per_img[i] ==0:
             #        continue
             fcs = self.redshift_fc(features)
-            pdfs = self.output_pdf(fcs)
-            zs = torch.tensor(np.linspace(0, 5, 200)).to(fcs.device)
+            zs = torch.tensor(self.zgrid).to(fcs.device)
 
-            probs = torch.zeros((num_instances_per_img[0], 200)).to(fcs.device)
-            for i, z in enumerate(zs):
-                # probs.append(outputs.log_prob(z))
-                probs[:, i] = pdfs.log_prob(z)
+            probs = mdn_log_prob_grid(fcs, zs, self.num_components, "softplus")
 
             for i, pred_instances in enumerate(instances):
                 pred_instances.pred_redshift_pdf = probs
@@ -1248,6 +1340,8 @@ class OldEBVRedshiftPDFCasROIHeads(CascadeROIHeads):
 
         self._output_size = (inshape.channels, inshape.height, inshape.width)
         self.num_components = num_components
+        # the redshifts the PDFs are evaluated on at inference
+        self.zgrid = np.linspace(0, 5, 200)
         self.zloss_factor = zloss_factor
 
 
@@ -1293,10 +1387,9 @@ class OldEBVRedshiftPDFCasROIHeads(CascadeROIHeads):
 
         if self.training:
             fcs = self.redshift_conv(features)
-            pdfs = self.output_pdf(fcs)
 
             gt_redshifts = cat([x.gt_redshift for x in instances])
-            nlls = -pdfs.log_prob(gt_redshifts) * self.zloss_factor
+            nlls = mdn_nll(fcs, gt_redshifts, self.num_components) * self.zloss_factor
 
             return {"redshift_loss": torch.mean(nlls)}
 
@@ -1309,13 +1402,9 @@ class OldEBVRedshiftPDFCasROIHeads(CascadeROIHeads):
             #    if num_instances_per_img[i] ==0:
             #        continue
             fcs = self.redshift_fc(features)
-            pdfs = self.output_pdf(fcs)
-            zs = torch.tensor(np.linspace(0, 5, 200)).to(fcs.device)
+            zs = torch.tensor(self.zgrid).to(fcs.device)
 
-            probs = torch.zeros((num_instances_per_img[0], 200)).to(fcs.device)
-            for i, z in enumerate(zs):
-                # probs.append(outputs.log_prob(z))
-                probs[:, i] = pdfs.log_prob(z)
+            probs = mdn_log_prob_grid(fcs, zs, self.num_components)
 
             for i, pred_instances in enumerate(instances):
                 pred_instances.pred_redshift_pdf = probs
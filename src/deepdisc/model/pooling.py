@@ -0,0 +1,158 @@
+"""ROI pooling shared between the box, mask and redshift branches of the ROI heads.
+
+The redshift heads pool the same FPN levels as the box head, with the same ROIAlignV2
+settings, and in training the redshift boxes are (a subset of) the proposals the first box
+stage has already pooled.  share_roi_pooling wraps the poolers of a ROI heads module so they
+look up a per-forward cache before pooling: a pooler with the same settings called on the
+same feature maps and box tensors returns the features pooled before, and pool_subset takes
+the foreground rows of them instead of pooling the foreground boxes again.  The results are
+identical to pooling separately.
+"""
+
+from detectron2.layers import cat
+from detectron2.modeling.poolers import ROIPooler
+from torch import nn
+
+
+def _pooler_signature(pooler):
+    """The settings that determine the output of an ROIPooler"""
+    level_poolers = tuple(
+        (
+            type(p).__name__,
+            getattr(p, "output_size", None),
+            getattr(p, "spatial_scale", None),
+            getattr(p, "sampling_ratio", None),
+            getattr(p, "aligned", None),
+        )
+        for p in pooler.level_poolers
+    )
+    return (
+        tuple(pooler.output_size),
+        pooler.min_level,
+        pooler.max_level,
+        pooler.canonical_level,
+        pooler.canonical_box_size,
+        level_poolers,
+    )
+
+
+def _same_tensors(a, b):
+    return len(a) == len(b) and all(x is y for x, y in zip(a, b))
+
+
+class PoolingCache:
+    """The pooled features of one forward pass of the ROI heads"""
+
+    def __init__(self):
+        self._entries = []
+
+    def lookup(self, signature, x, box_lists):
+        box_tensors = [b.tensor for b in box_lists]
+        for entry_signature, entry_x, entry_boxes, pooled in self._entries:
+            if entry_signature == signature and _same_tensors(entry_x, x) and _same_tensors(entry_boxes, box_tensors):
+                return pooled
+        return None
+
+    def add(self, signature, x, box_lists, pooled):
+        self._entries.append((signature, list(x), [b.tensor for b in box_lists], pooled))
+
+    def clear(self):
+        self._entries = []
+
+
+class CachedROIPooler(nn.Module):
+    """An ROIPooler that reuses the output of any pooler with the same settings sharing its cache
+
+    Parameters
+    ----------
+    pooler : ROIPooler
+        The pooler to wrap
+    cache : PoolingCache
+        The cache shared by the poolers of the ROI heads
+    """
+
+    def __init__(self, pooler, cache):
+        super().__init__()
+        self.pooler = pooler
+        self.cache = cache
+        self.signature = _pooler_signature(pooler)
+
+    def __getattr__(self, name):
+        # output_size etc. of the wrapped pooler
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            return getattr(self._modules["pooler"], name)
+
+    def forward(self, x, box_lists):
+        pooled = self.cache.lookup(self.signature, x, box_lists)
+        if pooled is None:
+            pooled = self.pooler(x, box_lists)
+            self.cache.add(self.signature, x, box_lists, pooled)
+        return pooled
+
+    def pool_subset(self, x, box_lists, masks):
+        pooled = self.cache.lookup(self.signature, x, box_lists)
+        if pooled is None:
+            return self.pooler(x, [b[m] for b, m in zip(box_lists, masks)])
+        return pooled[cat(list(masks))]
+
+
+def pool_subset(pooler, x, box_lists, masks):
+    """Pool the boxes selected by a boolean mask per image
+
+    Parameters
+    ----------
+    pooler : ROIPooler or CachedROIPooler
+        The pooler
+    x : list[torch.Tensor]
+        The feature maps
+    box_lists : list[Boxes]
+        All the boxes of each image
+    masks : list[torch.Tensor]
+        Boolean masks of the boxes to pool, one per image
+
+    Returns
+    -------
+    torch.Tensor
+        The pooled features of the selected boxes, in the order of pooler(x, selected boxes).
+        A CachedROIPooler takes them from the features of all the boxes if those were
+        already pooled in this forward pass.
+    """
+    if isinstance(pooler, CachedROIPooler):
+        return pooler.pool_subset(x, box_lists, masks)
+    return pooler(x, [b[m] for b, m in zip(box_lists, masks)])
+
+
+def share_roi_pooling(roi_heads, pooler_names=("box_pooler", "mask_pooler", "keypoint_pooler", "redshift_pooler")):
+    """Make the poolers of ROI heads share one cache of pooled features
+
+    The cache is emptied before and after every forward pass of the heads.  ROIPoolers have
+    no parameters, so the state dict of the heads does not change.
+
+    Parameters
+    ----------
+    roi_heads : ROIHeads
+        The heads, modified in place
+    pooler_names : list[str]
+        The attributes of the heads holding the poolers to share
+
+    Returns
+    -------
+    PoolingCache
+        The shared cache
+    """
+    cache = PoolingCache()
+    for name in pooler_names:
+        pooler = getattr(roi_heads, name, None)
+        if isinstance(pooler, ROIPooler):
+            setattr(roi_heads, name, CachedROIPooler(pooler, cache))
+    roi_heads._pooling_cache = cache
+    roi_heads.register_forward_pre_hook(_clear_pooling_cache)
+    roi_heads.register_forward_hook(_clear_pooling_cache)
+    return cache
+
+
+def _clear_pooling_cache(module, *args):
+    # a module-level function rather than a closure, so copies of the heads clear their own cache
+    module._pooling_cache.clear()
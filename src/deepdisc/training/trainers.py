@@ -10,6 +10,7 @@ from detectron2.solver import build_lr_scheduler, build_optimizer
 from detectron2.utils import comm
 
 from DeepDiscVR.src.deepdisc.astrodet import detectron as detectron_addons
+from deepdisc.utils.profiling import StageTimer
 
 class LazyAstroTrainer(SimpleTrainer):
     def __init__(self, model, data_loader, optimizer, cfg):
@@ -39,21 +40,87 @@ class LazyAstroTrainer(SimpleTrainer):
         self.valloss = 0
         self.vallossdict={}
 
+        self.timer = StageTimer(enabled=False)
+        self.trace_file = None
+
     # Note: print out loss over p iterations
     def set_period(self, p):
         self.period = p
 
+    def enable_profiling(self, window=1000, trace_file=None):
+        """Time the data wait, forward, backward and optimizer step of every iteration
+
+        The p50/p90/p99 of each stage are put into the EventStorage every period
+        as "time/<stage>_p<q>" scalars. Timings measured by data mappers created with
+        profile=True (image_read, scaling, augmentation, annotations) and the batch collation
+        of a train loader built with profile=True are merged in too.
+
+        Parameters
+        ----------
+        window : int
+            Number of recent iterations used for the percentiles
+        trace_file : str
+            If given, a Chrome trace of all recorded stages is written here after training
+        """
+        self.timer = StageTimer(enabled=True, window=window)
+        self.trace_file = trace_file
+        # CUDA kernels run asynchronously, so wait for them before closing a stage
+        self._sync = torch.cuda.synchronize if torch.cuda.is_available() else None
+
+    def export_trace(self, filename):
+        """Write the recorded stage timings as a Chrome trace json file"""
+        return self.timer.export_chrome_trace(filename)
+
+    def after_train(self):
+        super().after_train()
+        if self.timer.enabled and self.trace_file is not None and comm.is_main_process():
+            self.export_trace(self.trace_file)
+
+    def start_phase(self, model, optimizer, cfg, hooklist):
+        """Switch to the next phase of a phased training schedule
+
+        The data loader (and its worker processes), the loss history and the
+        weights already in memory are kept. Only the model wrapper, the optimizer,
+        the lr scheduler and the hooks are replaced.
+
+        Parameters
+        ----------
+        model : torch model
+            The model to train in this phase, e.g. from models.unfreeze_lazy_model
+        optimizer : detectron2 optimizer
+            The optimizer for this phase, built over the now-trainable parameters
+        cfg : .py file
+            The LazyConfig, with any SOLVER values changed for this phase
+        hooklist : list
+            The hooks to use for this phase, replacing the previous phase's hooks
+        """
+        self.model = model
+        self.model.train()
+        self.optimizer = optimizer
+        self.scheduler = self.build_lr_scheduler(cfg, optimizer)
+        self._hooks = []
+        self.register_hooks(hooklist)
+
     # Copied directly from SimpleTrainer, add in custom manipulation with the loss
     # see https://detectron2.readthedocs.io/en/latest/_modules/detectron2/engine/train_loop.html#SimpleTrainer
     def run_step(self):
         self.iterCount = self.iterCount + 1
         assert self.model.training, "[SimpleTrainer] model was changed to eval mode!"
         start = time.perf_counter()
-        data = next(self._data_loader_iter)
+        # includes waiting on the workers and the batch collation, which is also timed on its own as
+        # "collation" when the loader is built with profile=True
+        with self.timer.stage("data_wait"):
+            data = next(self._data_loader_iter)
         data_time = time.perf_counter() - start
+        for d in data:
+            timings = d.pop("timings", None)
+            if timings is not None:
+                self.timer.add_sample_timings(timings)
+        sync = self._sync if self.timer.enabled else None
         # Note: in training mode, model() returns loss
         start = time.perf_counter()
-        loss_dict = self.model(data)
+        with self.timer.stage("forward", sync=sync):
+            loss_dict = self.model(data)
         loss_time = time.perf_counter() - start
 
     
@@ -72,11 +139,13 @@ class LazyAstroTrainer(SimpleTrainer):
             losses = sum(loss_dict.values())
             all_losses = [l.cpu().detach().item() for l in loss_dict.values()]
         self.optimizer.zero_grad()
-        losses.backward()
+        with self.timer.stage("backward", sync=sync):
+            losses.backward()
 
         # self._write_metrics(loss_dict,data_time)
 
-        self.optimizer.step()
+        with self.timer.stage("optimizer", sync=sync):
+            self.optimizer.step()
 
         self.lossList.append(losses.cpu().detach().numpy())
         if self.iterCount % self.period == 0 and comm.is_main_process():
@@ -95,6 +164,8 @@ class LazyAstroTrainer(SimpleTrainer):
                 "lr: ",
                 self.scheduler.get_lr(),
             )
+        if self.timer.enabled and self.iterCount % self.period == 0:
+            self.timer.write_to_storage(self.storage)
 
         #del data
         #gc.collect()
@@ -251,20 +322,27 @@ def return_lazy_trainer(model, loader, optimizer, cfg, hooklist):
     return trainer
 
 
-def return_savehook(output_name, save_period):
+def return_savehook(output_name, save_period, async_save=False, max_to_keep=None):
     """Returns a hook for saving the model
 
     Parameters
     ----------
     output_name : str
         name of output file to save
+    save_period : int
+        how many iterations between checkpoints
+    async_save : bool
+        if True, checkpoints are serialised on a background thread and
+        atomically renamed into place
+    max_to_keep : int
+        number of periodic checkpoints to keep on disk when async_save is set
 
     Returns
     -------
         a SaveHook
     """
     #saveHook = detectron_addons.SaveHook()
-    saveHook = detectron_addons.NewSaveHook(save_period)
+    saveHook = detectron_addons.NewSaveHook(save_period, async_save=async_save, max_to_keep=max_to_keep)
     saveHook.set_output_name(output_name)
     return saveHook
 
@@ -166,6 +166,31 @@ Run on multiple machines:
         help="initialization URL for pytorch distributed backend. See "
         "https://pytorch.org/docs/stable/distributed.html for details.",
     )
+    adv_args.add_argument(
+        "--profile",
+        action="store_true",
+        help="time the data loading and compute stages and write a Chrome trace to the output directory",
+    )
+    adv_args.add_argument(
+        "--async-checkpoint",
+        action="store_true",
+        help="write the checkpoints on a background thread, so the training loop only copies the weights to "
+        "CPU memory",
+    )
+    adv_args.add_argument(
+        "--max-checkpoints",
+        type=int,
+        default=None,
+        help="with --async-checkpoint, how many periodic checkpoints to keep on disk (default: all)",
+    )
+    adv_args.add_argument(
+        "--feature-cache",
+        type=str,
+        default=None,
+        help="directory for the backbone features cached while training the heads with a frozen backbone. "
+        "Only samples augmented exclusively by flips/rotations are cached, so use a crop-free augmentation "
+        "list such as dc2_train_augs; the frozen backbone then runs in eval mode (no stochastic depth)",
+    )
     adv_args.add_argument(
         "opts",
         help="""
@@ -0,0 +1,140 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+
+import numpy as np
+
+
+class StageTimer:
+    """Records wall-clock durations of named pipeline stages
+
+    Durations are kept in a rolling window per stage so percentiles can be
+    reported to the EventStorage, and every timed interval is also kept as a
+    trace event that can be exported in the Chrome trace format
+    (open it in chrome://tracing or https://ui.perfetto.dev).
+
+    A disabled timer is a cheap no-op, so it can be left in the data mappers
+    and the training loop permanently.
+
+    Parameters
+    ----------
+    enabled : bool
+        Whether to record anything
+    window : int
+        Number of most recent durations kept per stage for the percentiles
+    max_trace_events : int
+        Number of most recent trace events kept for export
+    """
+
+    def __init__(self, enabled=True, window=1000, max_trace_events=200000):
+        self.enabled = enabled
+        self.window = window
+        self._durations = defaultdict(lambda: deque(maxlen=window))
+        self._trace = deque(maxlen=max_trace_events)
+        self._sample = []
+
+    @contextlib.contextmanager
+    def stage(self, name, sync=None):
+        """Time the enclosed block as stage `name`
+
+        Parameters
+        ----------
+        name : str
+            The stage name, e.g. "image_read" or "forward"
+        sync : function
+            Called before the block ends to flush asynchronous work,
+            e.g. torch.cuda.synchronize
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if sync is not None:
+                sync()
+            self.record(name, start, time.perf_counter())
+
+    def record(self, name, start, end, tid=None):
+        """Add one interval (perf_counter seconds) for stage `name`"""
+        if not self.enabled:
+            return
+        self._durations[name].append(end - start)
+        event = (name, start, end, os.getpid(), tid if tid is not None else threading.get_ident())
+        self._trace.append(event)
+        self._sample.append(event)
+
+    def pop_sample_timings(self):
+        """Return and clear the intervals recorded since the last call
+
+        Data mappers attach these to the sample they produced, so timings measured
+        in data loader workers reach the training process.
+        """
+        timings, self._sample = self._sample, []
+        return timings
+
+    def add_sample_timings(self, timings):
+        """Merge intervals returned by `pop_sample_timings` in another process"""
+        if not self.enabled:
+            return
+        for name, start, end, pid, tid in timings:
+            self._durations[name].append(end - start)
+            self._trace.append((name, start, end, pid, tid))
+
+    def percentiles(self, qs=(50, 90, 99)):
+        """Percentiles of the recent durations of each stage, in seconds
+
+        Returns
+        -------
+        dict
+            {stage: {"p50": ..., "p90": ..., "p99": ..., "count": ...}}
+        """
+        summary = {}
+        for name, durations in self._durations.items():
+            if len(durations) == 0:
+                continue
+            values = np.percentile(np.fromiter(durations, dtype=np.float64), qs)
+            summary[name] = {f"p{q}": float(v) for q, v in zip(qs, values)}
+            summary[name]["count"] = len(durations)
+        return summary
+
+    def write_to_storage(self, storage, prefix="time/", qs=(50, 90, 99)):
+        """Put the stage percentiles into a detectron2 EventStorage as scalars
+
+        The scalars are named e.g. "time/forward_p50".
+        """
+        scalars = {}
+        for name, stats in self.percentiles(qs).items():
+            for q in qs:
+                scalars[f"{prefix}{name}_p{q}"] = stats[f"p{q}"]
+        if scalars:
+            storage.put_scalars(smoothing_hint=False, **scalars)
+        return scalars
+
+    def export_chrome_trace(self, filename):
+        """Write the recorded intervals as a Chrome trace json file"""
+        events = [
+            {
+                "name": name,
+                "ph": "X",
+                "ts": start * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": pid,
+                "tid": tid,
+            }
+            for name, start, end, pid, tid in self._trace
+        ]
+        tmp_file = filename + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        os.replace(tmp_file, filename)
+        return filename
+
+    def reset(self):
+        self._durations.clear()
+        self._trace.clear()
+        self._sample = []
@@ -0,0 +1,85 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+pytest.importorskip("detectron2")
+
+from deepdisc.astrodet import detectron
+from deepdisc.astrodet.detectron import AsyncCheckpointWriter, NewSaveHook
+
+
+def checkpoint(value):
+    return AsyncCheckpointWriter.snapshot({"model": {"weight": torch.full((4,), float(value))}, "iteration": value})
+
+
+def test_write_is_atomic(tmp_path, monkeypatch):
+    writer = AsyncCheckpointWriter(str(tmp_path))
+    writer.save("model_1", checkpoint(1), aliases=["model_final"])
+    writer.wait()
+    assert sorted(os.listdir(tmp_path)) == ["last_checkpoint", "model_1.pth", "model_final.pth"]
+    assert (tmp_path / "last_checkpoint").read_text() == "model_1.pth"
+    assert torch.load(tmp_path / "model_final.pth")["iteration"] == 1
+
+    def partial_save(obj, f):
+        f.write(b"truncated")
+        raise OSError("disk full")
+
+    # a failed write leaves the previous checkpoint in place, never a truncated one
+    monkeypatch.setattr(detectron.torch, "save", partial_save)
+    writer.save("model_1", checkpoint(2))
+    with pytest.raises(RuntimeError, match="Background checkpoint write failed"):
+        writer.wait()
+    assert torch.load(tmp_path / "model_1.pth")["iteration"] == 1
+    # and cleans up its temporary file
+    assert sorted(os.listdir(tmp_path)) == ["last_checkpoint", "model_1.pth", "model_final.pth"]
+    writer.close()
+
+
+def test_max_to_keep(tmp_path):
+    writer = AsyncCheckpointWriter(str(tmp_path), max_to_keep=2)
+    for i in range(1, 5):
+        writer.save(f"model_{i}", checkpoint(i))
+    writer.save("model_best", checkpoint(5), rotate=False)
+    writer.close()
+    assert sorted(os.listdir(tmp_path)) == ["last_checkpoint", "model_3.pth", "model_4.pth", "model_best.pth"]
+
+
+def test_failure_surfaces_on_next_save_and_close(tmp_path, monkeypatch):
+    def failing_save(obj, f):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(detectron.torch, "save", failing_save)
+    writer = AsyncCheckpointWriter(str(tmp_path))
+    writer.save("model_1", checkpoint(1))
+    writer._queue.join()
+    with pytest.raises(RuntimeError) as excinfo:
+        writer.save("model_2", checkpoint(2))
+    assert isinstance(excinfo.value.__cause__, OSError)
+
+    writer.save("model_3", checkpoint(3))
+    with pytest.raises(RuntimeError):
+        writer.close()
+    # the writer thread is stopped even though the last write failed
+    assert not writer._thread.is_alive()
+
+
+def test_writer_error_does_not_hide_training_error(tmp_path, monkeypatch, caplog):
+    def failing_save(obj, f):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(detectron.torch, "save", failing_save)
+    hook = NewSaveHook(10, async_save=True)
+    hook.trainer = SimpleNamespace(storage=SimpleNamespace(put_scalar=lambda *args, **kwargs: None))
+    hook._writer = AsyncCheckpointWriter(str(tmp_path))
+    hook._writer.save("model_1", checkpoint(1))
+
+    # as detectron2's TrainerBase.train, which calls after_train in a finally block
+    with pytest.raises(ValueError, match="training failed"):
+        try:
+            raise ValueError("training failed")
+        finally:
+            hook.after_train()
+    assert "Background checkpoint write failed" in caplog.text
+    assert os.listdir(tmp_path) == []
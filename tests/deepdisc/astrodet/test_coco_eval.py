@@ -0,0 +1,132 @@
+import contextlib
+import copy
+import io
+from collections import defaultdict
+
+import numpy as np
+import pytest
+
+pytest.importorskip("detectron2")
+pytest.importorskip("pycocotools")
+
+from pycocotools.coco import COCO
+
+from deepdisc.astrodet.astrodet import COCOeval_opt_custom
+
+AREA_RNG = [[0, 1e10], [0, 64], [64, 1e10]]
+
+
+def make_coco(n_images=8, seed=0):
+    rng = np.random.default_rng(seed)
+    images, anns, results = [], [], []
+    for i in range(n_images):
+        images.append({"id": i, "height": 64, "width": 64})
+        for _ in range(rng.integers(0, 5)):
+            x, y = rng.uniform(0, 50, 2)
+            w, h = rng.uniform(3, 14, 2)
+            anns.append(
+                {
+                    "id": len(anns) + 1,
+                    "image_id": i,
+                    "category_id": 1,
+                    "bbox": [x, y, w, h],
+                    "area": w * h,
+                    "iscrowd": 0,
+                    "imag": float(rng.uniform(18, 28)),
+                }
+            )
+            dx, dy = rng.normal(0, 1.5, 2)
+            results.append(
+                {"image_id": i, "category_id": 1, "bbox": [x + dx, y + dy, w, h], "score": float(rng.uniform())}
+            )
+    coco_gt = COCO()
+    coco_gt.dataset = {"images": images, "annotations": anns, "categories": [{"id": 1, "name": "object"}]}
+    with contextlib.redirect_stdout(io.StringIO()):
+        coco_gt.createIndex()
+    return coco_gt, results
+
+
+def evaluate(coco_gt, results, mode):
+    with contextlib.redirect_stdout(io.StringIO()):
+        if mode == "incremental":
+            coco_eval = COCOeval_opt_custom(coco_gt, None, "bbox")
+            coco_eval.params.areaRng = AREA_RNG
+            coco_eval.start_incremental()
+            per_image = defaultdict(list)
+            for r in results:
+                per_image[r["image_id"]].append(r)
+            for img_id, img_results in reversed(list(per_image.items())):
+                coco_eval.add_image_results(img_id, img_results)
+            coco_eval.finish_incremental()
+        else:
+            coco_eval = COCOeval_opt_custom(coco_gt, coco_gt.loadRes(copy.deepcopy(results)), "bbox")
+            coco_eval.params.areaRng = AREA_RNG
+            coco_eval.evaluate_custom(num_workers=3 if mode == "parallel" else 0)
+    return coco_eval.evalImgs
+
+
+@pytest.mark.parametrize("mode", ["parallel", "incremental"])
+def test_evaluate_modes_match_serial(mode):
+    coco_gt, results = make_coco()
+    expected = evaluate(coco_gt, results, "serial")
+    evalImgs = evaluate(coco_gt, results, mode)
+    assert len(evalImgs) == len(expected)
+    for a, b in zip(expected, evalImgs):
+        assert (a is None) == (b is None)
+        if a is not None:
+            assert a["image_id"] == b["image_id"] and a["aRng"] == b["aRng"]
+            np.testing.assert_array_equal(a["dtMatches"], b["dtMatches"])
+            np.testing.assert_array_equal(a["gtIgnore"], b["gtIgnore"])
+
+
+def test_magnitude_bins_single_pass():
+    coco_gt, results = make_coco()
+    with contextlib.redirect_stdout(io.StringIO()):
+        coco_eval = COCOeval_opt_custom(coco_gt, coco_gt.loadRes(copy.deepcopy(results)), "bbox")
+        coco_eval.params.areaRng = AREA_RNG
+        coco_eval.params.areaRngLbl = ["all", "small", "large"]
+        coco_eval.params.magRng = [[-np.inf, np.inf], [18, 23], [40, 50]]
+        coco_eval.evaluate_custom()
+        coco_eval.accumulate_custom()
+        rows = coco_eval.summarize_mag_bins()
+
+    precision = coco_eval.eval["precision"]
+    assert precision.shape[3] == 4 * len(AREA_RNG)
+    # the first block covers all magnitudes, and so does the (-inf, inf] bin
+    np.testing.assert_array_equal(precision[..., 0:3, :], precision[..., 3:6, :])
+    # no objects in the last bin
+    assert np.all(precision[..., 9:12, :] == -1)
+    assert [r["mag"] for r in rows[::3]] == ["all", "(-inf, inf]", "(18, 23]", "(40, 50]"]
+    assert np.isnan(rows[-1]["AP"])
+
+
+def test_merge_evaluated_images():
+    coco_gt, results = make_coco()
+    expected = evaluate(coco_gt, results, "serial")
+    per_image = defaultdict(list)
+    for r in results:
+        per_image[r["image_id"]].append(r)
+
+    def new_eval():
+        coco_eval = COCOeval_opt_custom(coco_gt, None, "bbox")
+        coco_eval.params.areaRng = AREA_RNG
+        coco_eval.start_incremental()
+        return coco_eval
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        # two "ranks" evaluate alternate images, the main process merges them
+        ranks = []
+        for rank in range(2):
+            coco_eval = new_eval()
+            for img_id in list(per_image)[rank::2]:
+                coco_eval.add_image_results(img_id, per_image[img_id])
+            ranks.append(coco_eval.evaluated_images())
+        merged = new_eval()
+        for evaluated in ranks:
+            merged.add_evaluated_images(evaluated)
+        merged.finish_incremental()
+
+    for a, b in zip(expected, merged.evalImgs):
+        assert (a is None) == (b is None)
+        if a is not None:
+            np.testing.assert_array_equal(a["dtMatches"], b["dtMatches"])
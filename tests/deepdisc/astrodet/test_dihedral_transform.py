@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("detectron2")
+
+import detectron2.data.transforms as T
+
+from deepdisc.astrodet.detectron import DihedralTransform, RandomDihedral
+
+
+@pytest.mark.parametrize("variant", range(8))
+def test_dihedral_transform_matches_rotation(variant):
+    rng = np.random.default_rng(variant)
+    image = rng.random((16, 24, 6)).astype(np.float32)
+    boxes = np.array([[2.0, 3.0, 9.0, 7.0]])
+
+    tfm = DihedralTransform(variant, 16, 24)
+    out = tfm.apply_image(image)
+    k, flip = variant % 4, variant >= 4
+    expected = np.rot90(image, k)
+    if flip:
+        expected = expected[:, ::-1]
+    np.testing.assert_array_equal(out, expected)
+
+    # the box of a filled rectangle follows the pixels exactly
+    mask = np.zeros((16, 24), dtype=np.uint8)
+    mask[3:7, 2:9] = 1
+    ys, xs = np.nonzero(tfm.apply_segmentation(mask))
+    np.testing.assert_array_equal(tfm.apply_box(boxes)[0], [xs.min(), ys.min(), xs.max() + 1, ys.max() + 1])
+
+    inverse = tfm.inverse()
+    np.testing.assert_array_equal(inverse.apply_image(out), image)
+    np.testing.assert_allclose(inverse.apply_box(tfm.apply_box(boxes)), boxes)
+
+
+def test_random_dihedral_in_augmentation_list():
+    image = np.zeros((10, 20, 3), dtype=np.float32)
+    auginput = T.AugInput(image)
+    tfm = T.AugmentationList([RandomDihedral(variants=[1])])(auginput)
+    assert auginput.image.shape == (20, 10, 3)
+    assert isinstance(tfm.transforms[0], DihedralTransform)
+
+
+def test_dihedral_augs_replace_rotation_and_flips():
+    from deepdisc.data_format.augment_image import dc2_train_augs, dihedral_augs
+
+    image = np.random.default_rng(0).random((4, 6, 2))
+    rotation, hflip, vflip = dihedral_augs()
+    # RandomRotation([-90, 90, 180]) and two RandomFlip(prob=0.5), one for one
+    assert sorted(rotation.variants) == [1, 2, 3]
+    assert tuple(hflip.variants) == (0, 4) and tuple(vflip.variants) == (0, 6)
+    np.testing.assert_array_equal(DihedralTransform(4, 4, 6).apply_image(image), image[:, ::-1])
+    np.testing.assert_array_equal(DihedralTransform(6, 4, 6).apply_image(image), image[::-1])
+    assert dc2_train_augs(image).max_range == 3
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip("detectron2")
+
+from deepdisc.benchmarks import cascade_depth, roi_heads
+from deepdisc.inference.early_exit import set_cascade_depth
+
+
+class HeadPredictor:
+    """Runs a ROI head on fixed synthetic features, ignoring the image"""
+
+    def __init__(self, head, features, proposals):
+        self.model = head
+        self.features = features
+        self.proposals = proposals
+
+    def __call__(self, image):
+        with torch.no_grad():
+            instances, _ = self.model(None, self.features, self.proposals)
+        return {"instances": instances[0]}
+
+
+def test_set_cascade_depth():
+    head = roi_heads.build_head("RedshiftPDFCasROIHeads", max_detections=5)
+    set_cascade_depth(head, 1, mask=False)
+    assert head.num_cascade_stages == 1 and not head.mask_on
+    set_cascade_depth(head)
+    assert head.num_cascade_stages == 3 and head.mask_on
+    with pytest.raises(ValueError):
+        set_cascade_depth(head, 4)
+    with pytest.raises(ValueError):
+        set_cascade_depth(roi_heads.build_head("RedshiftPointROIHeads"), 1)
+
+
+def test_benchmark_cascade_depth():
+    head = roi_heads.build_head("RedshiftPDFCasROIHeads", max_detections=5)
+    features, proposals = roi_heads.make_inputs(image_size=128, n_proposals=20)
+    predictor = HeadPredictor(head, features, proposals)
+    results = cascade_depth.benchmark_cascade_depth(predictor, [np.zeros((128, 128, 3))], stages=[1, 3])
+
+    assert [(r["stages"], r["masks"]) for r in results] == [(1, True), (1, False), (3, True), (3, False)]
+    # the full depth reproduces the reference run
+    assert results[2]["matched_fraction"] == 1.0
+    assert results[2]["rms_z_diff"] == 0.0
+    assert head.num_cascade_stages == 3 and head.mask_on
+    assert "stages" in cascade_depth.format_table(results)
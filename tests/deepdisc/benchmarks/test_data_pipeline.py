@@ -0,0 +1,61 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from deepdisc.benchmarks import data_pipeline
+
+
+@pytest.mark.parametrize("survey", ["dc2", "hsc", "roman"])
+def test_make_synthetic_dataset(tmp_path, survey):
+    nb = 3 if survey == "hsc" else 4
+    dataset_dicts = data_pipeline.make_synthetic_dataset(
+        tmp_path, survey, n_images=2, n_objects=3, shape=(nb, 64, 48)
+    )
+    assert len(dataset_dicts) == 2
+    assert len(dataset_dicts[0]["annotations"]) == 3
+
+    reader = data_pipeline.image_reader_for(survey, "raw")
+    image = reader(data_pipeline.key_mapper_for(survey)(dataset_dicts[1]))
+    assert image.shape == (64, 48, nb)
+    assert np.all(np.isfinite(image))
+
+
+def test_benchmark_reader_and_report(tmp_path):
+    report = data_pipeline.run_benchmarks(
+        tmp_path,
+        surveys=["dc2"],
+        norms=["raw", "zscore"],
+        mappers=[],
+        workers=[],
+        n_images=2,
+        n_objects=2,
+        repeats=1,
+        shape=(6, 32, 32),
+    )
+    readers = [r for r in report["results"] if r["benchmark"] == "reader"]
+    assert [r["norm"] for r in readers] == ["raw", "zscore"]
+    assert all(r["samples_per_s"] > 0 and r["n_samples"] == 2 for r in readers)
+
+    filename = os.path.join(tmp_path, "report.json")
+    data_pipeline.save_report(report, filename)
+    loaded = data_pipeline.load_report(filename)
+    assert json.loads(json.dumps(loaded)) == loaded
+
+    slower = json.loads(json.dumps(report))
+    for r in slower["results"]:
+        r["samples_per_s"] /= 2
+    comparison = data_pipeline.compare_reports(report, slower)
+    assert len(comparison) == 2
+    assert all(c["regression"] and c["ratio"] == pytest.approx(0.5) for c in comparison)
+
+
+def test_benchmark_mapper(tmp_path):
+    loaders = pytest.importorskip("deepdisc.model.loaders")
+    dataset_dicts = data_pipeline.make_synthetic_dataset(tmp_path, "dc2", n_images=2, n_objects=3, shape=(6, 32, 32))
+    mapper = loaders.RedshiftDictMapper(
+        data_pipeline.image_reader_for("dc2"), data_pipeline.key_mapper_for("dc2"), None
+    )
+    result = data_pipeline.benchmark_mapper(mapper.map_data, dataset_dicts, repeats=1)
+    assert result["n_samples"] == 2 and result["samples_per_s"] > 0
@@ -0,0 +1,10 @@
+from deepdisc.benchmarks import mdn_loss
+
+
+def test_benchmark_mdn_loss():
+    results = mdn_loss.benchmark_mdn_loss(n_instances=(16,), num_components=(2,), n_grid=5, repeats=1, warmup=0)
+    assert len(results) == 1
+    result = results[0]
+    assert set(result["step_ms"]) == {"distributions", "fused"}
+    assert result["max_abs_diff"]["grad"] < 1e-5
+    assert len(mdn_loss.format_table(results).splitlines()) == 2
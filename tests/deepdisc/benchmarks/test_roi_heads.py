@@ -0,0 +1,16 @@
+import pytest
+
+pytest.importorskip("detectron2")
+
+from deepdisc.benchmarks import roi_heads
+
+
+@pytest.mark.parametrize("name", ["RedshiftPDFCasROIHeads", "RedshiftPointROIHeads"])
+def test_benchmark_head(name):
+    results = roi_heads.benchmark_head(name, detections=(5,), image_size=128, n_proposals=20, repeats=1)
+    assert len(results) == 1
+    result = results[0]
+    assert "error" not in result, result.get("error")
+    assert result["n_pred"] == 5
+    assert set(result["latency_ms"]) == {"box", "mask", "redshift", "total"}
+    assert "RedshiftPDF" in roi_heads.format_table(results) or "RedshiftPoint" in roi_heads.format_table(results)
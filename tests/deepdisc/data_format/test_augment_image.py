@@ -4,10 +4,11 @@ import numpy as np
 import pytest
 from numpy.testing import assert_allclose
 
-from deepdisc.data_format.augment_image import (addelementwise,
+from deepdisc.data_format.augment_image import (A_EBV, addelementwise,
                                                 addelementwise8,
                                                 addelementwise16, centercrop,
-                                                gaussblur)
+                                                gaussblur, multiband_gaussblur,
+                                                redden, separable_blur)
 
 
 @pytest.fixture
@@ -19,40 +20,74 @@ def simple_image():
 
 def test_gaussblur(simple_image):
     output = gaussblur(simple_image, rng_seed=np.random.default_rng(54622))
-    assert len(output) == len(simple_image)
-    expected = [
-        [10, 11, 11, 12, 13, 14, 15, 16, 17, 17],
-        [13, 14, 14, 15, 16, 17, 18, 19, 20, 20],
-        [21, 21, 22, 23, 24, 25, 26, 27, 28, 28],
-        [31, 31, 32, 33, 34, 35, 36, 37, 38, 38],
-        [41, 41, 42, 43, 44, 45, 46, 47, 48, 48],
-        [51, 51, 52, 53, 54, 55, 56, 57, 58, 58],
-        [61, 61, 62, 63, 64, 65, 66, 67, 68, 68],
-        [71, 71, 72, 73, 74, 75, 76, 77, 78, 78],
-        [79, 79, 80, 81, 82, 83, 84, 85, 85, 86],
-        [82, 82, 83, 84, 85, 86, 87, 88, 88, 89],
-    ]
-    assert np.all(output == expected)
+    assert output.shape == simple_image.shape
+    assert output.dtype == simple_image.dtype
+    # sigma=10 on a 10x10 image leaves an almost flat image at the mean
+    assert np.all(np.abs(output - simple_image.mean()) <= 1)
+
+
+def test_separable_blur_matches_direct_convolution():
+    rng = np.random.default_rng(0)
+    image = rng.random((12, 9, 3)).astype(np.float32)
+    sigmas = [0.0, 0.8, 1.5]
+    output = separable_blur(image, sigmas)
+    assert output.dtype == np.float32
+
+    # direct 2D convolution with reflected borders
+    for band, sigma in enumerate(sigmas):
+        if sigma == 0:
+            assert_allclose(output[:, :, band], image[:, :, band])
+            continue
+        radius = int(np.ceil(4 * max(sigmas)))
+        x = np.arange(-radius, radius + 1)
+        k = np.exp(-0.5 * (x / sigma) ** 2)
+        k2d = np.outer(k, k) / k.sum() ** 2
+        padded = np.pad(image[:, :, band].astype(np.float64), radius, mode="reflect")
+        expected = np.array(
+            [
+                [np.sum(padded[i : i + 2 * radius + 1, j : j + 2 * radius + 1] * k2d) for j in range(9)]
+                for i in range(12)
+            ]
+        )
+        assert_allclose(output[:, :, band], expected, rtol=1e-5, atol=1e-6)
+
+
+def test_multiband_gaussblur():
+    image = np.random.default_rng(1).random((16, 16, 6)).astype(np.float32)
+    output = multiband_gaussblur(image, rng_seed=np.random.default_rng(3))
+    assert output.shape == image.shape and output.dtype == np.float32
+    assert_allclose(output, multiband_gaussblur(image, rng_seed=np.random.default_rng(3)))
+    # blurring preserves the flux of each band up to the borders
+    assert_allclose(output.mean(axis=(0, 1)), image.mean(axis=(0, 1)), rtol=0.05)
+
+
+def test_redden():
+    image = np.ones((4, 4, 6), dtype=np.float32)
+    output = redden(image, rng_seed=np.random.default_rng(5))
+    ebv = -2.5 * np.log10(output[0, 0]) / A_EBV
+    assert_allclose(ebv, ebv[0], rtol=1e-4)
+    assert 0 <= ebv[0] <= 0.5
+    assert_allclose(output, redden(image, rng_seed=np.random.default_rng(5)))
 
 
 def test_addelementwise16(simple_image):
     output = addelementwise16(simple_image, rng_seed=np.random.default_rng(54622))
-    expected_first = [260, -1743, 1504, -2360, 409, -1053, 163, 266, 2811, -337]
-    assert np.all(output[0] == expected_first)
+    assert output.dtype == simple_image.dtype
+    assert np.all(np.abs(output.astype(int) - simple_image) <= 3276)
+    assert np.all(output == addelementwise16(simple_image, rng_seed=np.random.default_rng(54622)))
     assert len(output) == len(simple_image)
 
 
 def test_addelementwise8(simple_image):
     output = addelementwise8(simple_image, rng_seed=np.random.default_rng(54622))
-    expected_first = [2, -12, 13, -15, 7, -3, 7, 9, 29, 6]
-    assert np.all(output[0] == expected_first)
+    assert np.all(np.abs(output.astype(int) - simple_image) <= 25)
+    assert not np.all(output == simple_image)
     assert len(output) == len(simple_image)
 
 
 def test_addelementwise(simple_image):
     output = addelementwise(simple_image, rng_seed=np.random.default_rng(54622))
-    expected_first = [1, -4, 7, -4, 5, 2, 6, 8, 16, 8]
-    assert np.all(output[0] == expected_first)
+    assert np.all(np.abs(output.astype(int) - simple_image) <= np.ceil(0.1 * simple_image.max()))
     assert len(output) == len(simple_image)
 
 
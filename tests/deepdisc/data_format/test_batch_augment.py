@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip("detectron2")
+
+from detectron2.structures import Boxes, Instances, PolygonMasks
+
+from deepdisc.data_format import batch_augment, dihedral
+from deepdisc.data_format.augment_image import separable_blur
+
+
+def make_sample(height=32, width=32, seed=0):
+    rng = np.random.default_rng(seed)
+    image = torch.from_numpy(rng.random((6, height, width)).astype(np.float32))
+    instances = Instances((height, width))
+    instances.gt_boxes = Boxes(torch.tensor([[2.0, 3.0, 10.0, 7.0]]))
+    instances.gt_masks = PolygonMasks([[np.array([2.0, 3.0, 10.0, 3.0, 10.0, 7.0, 2.0, 7.0])]])
+    instances.gt_redshift = torch.tensor([0.5])
+    return {"image": image, "height": height, "width": width, "instances": instances}
+
+
+@pytest.mark.parametrize("variant", range(8))
+def test_batch_dihedral_matches_numpy(variant):
+    sample = make_sample(seed=variant)
+    original = sample["image"].numpy().copy()
+    batch_augment.apply_batch_augmentations(
+        [sample], [batch_augment.BatchDihedral(variants=[variant])], device="cpu", generator=torch.Generator()
+    )
+    expected = dihedral.dihedral_image(original.transpose(1, 2, 0), variant).transpose(2, 0, 1)
+    np.testing.assert_array_equal(sample["image"].numpy(), expected)
+    instances = sample["instances"]
+    np.testing.assert_allclose(
+        instances.gt_boxes.tensor.numpy(), dihedral.dihedral_boxes([2, 3, 10, 7], variant, 32, 32)
+    )
+    np.testing.assert_allclose(instances.gt_masks.get_bounding_boxes().tensor, instances.gt_boxes.tensor)
+    assert instances.gt_redshift.item() == 0.5
+
+
+@pytest.mark.parametrize("variant", range(8))
+def test_dihedral_boxes_tensor_matches_numpy(variant):
+    boxes = np.array([[2.0, 3.0, 10.0, 7.0], [0.0, 0.0, 24.0, 16.0]])
+    out = batch_augment._dihedral_boxes_tensor(torch.tensor(boxes), variant, 16, 24)
+    np.testing.assert_allclose(out.numpy(), dihedral.dihedral_boxes(boxes, variant, 16, 24))
+
+
+def test_blur_matches_per_sample_blur():
+    rng = np.random.default_rng(0)
+    images = rng.random((3, 6, 24, 20)).astype(np.float32)
+    sigmas = rng.random((3, 6))
+    out = batch_augment.separable_blur_tensor(torch.from_numpy(images), torch.from_numpy(sigmas))
+    for image, sigma, result in zip(images, sigmas, out.numpy()):
+        expected = separable_blur(image.transpose(1, 2, 0), sigma).transpose(2, 0, 1)
+        np.testing.assert_allclose(result, expected, atol=1e-5)
+
+
+def test_batch_augmented_loader():
+    loader = [[dict(make_sample(seed=0), dihedral=0), make_sample(16, 24, seed=1), make_sample(seed=2)]]
+    augs = [
+        batch_augment.BatchDihedral(),
+        batch_augment.BatchMultibandBlur(),
+        batch_augment.BatchRedden(),
+        batch_augment.BatchUniformNoise(0.01),
+    ]
+    (batch,) = list(batch_augment.BatchAugmentedLoader(loader, augs, device="cpu", seed=0))
+    assert [tuple(s["image"].shape) for s in batch][1] == (6, 16, 24)
+    for s in batch:
+        assert s["instances"].image_size == tuple(s["image"].shape[1:])
+        assert torch.isfinite(s["image"]).all()
+        # the mapper's variant no longer describes the augmented image
+        assert "dihedral" not in s
@@ -0,0 +1,95 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("pycocotools")
+
+import pycocotools.mask as mask_util
+
+from deepdisc.data_format import coco_cache
+
+
+@pytest.fixture
+def coco_dict():
+    polygon = [[10, 10, 30, 12, 25, 40, 8, 30]]
+    images = [{"id": 7, "height": 64, "width": 48, "file_name": "a.npy"}, {"id": 3, "height": 32, "width": 32}]
+    annotations = [
+        {"id": 1, "image_id": 3, "category_id": 0, "bbox": [1, 2, 3, 4], "area": 12.0, "iscrowd": 0, "imag": 22.5},
+        {"id": 2, "image_id": 7, "category_id": 1, "bbox": [8, 10, 22, 30], "area": 400.0, "segmentation": polygon},
+        {"id": 3, "image_id": 3, "category_id": 1, "bbox": [5, 5, 2, 2], "area": 4.0, "iscrowd": 0, "ignore": 1},
+    ]
+    categories = [{"id": 0, "name": "star"}, {"id": 1, "name": "galaxy"}]
+    return {"images": images, "annotations": annotations, "categories": categories}
+
+
+def test_round_trip(tmp_path, coco_dict):
+    filename = os.path.join(tmp_path, "gt.npz")
+    coco_cache.COCOGroundTruthCache.from_coco_dict(coco_dict).save(filename)
+    coco = coco_cache.COCOGroundTruthCache.load(filename).to_coco()
+
+    assert sorted(coco.getImgIds()) == [3, 7]
+    assert coco.getAnnIds(imgIds=[3]) == [1, 3]
+    ann = coco.loadAnns([1])[0]
+    assert ann["bbox"] == [1, 2, 3, 4] and ann["imag"] == 22.5 and "segmentation" not in ann
+    assert coco.loadAnns([3])[0]["ignore"] == 1
+    assert coco.loadCats([1])[0]["name"] == "galaxy"
+
+    # polygons are stored as RLE
+    rle = coco.loadAnns([2])[0]["segmentation"]
+    expected = mask_util.decode(mask_util.merge(mask_util.frPyObjects(coco_dict["annotations"][1]["segmentation"], 64, 48)))
+    np.testing.assert_array_equal(mask_util.decode(rle), expected)
+
+
+def test_load_or_build(tmp_path, coco_dict):
+    calls = []
+
+    def build():
+        calls.append(1)
+        return coco_dict
+
+    key = coco_cache.content_hash(coco_dict)
+    coco_cache.load_or_build(tmp_path, "test", key, build)
+    coco_cache.load_or_build(tmp_path, "test", key, build)
+    assert len(calls) == 1
+
+    # a change to the dataset gives a new key, so the cache is rebuilt
+    coco_dict["annotations"][0]["bbox"] = [1, 2, 3, 5]
+    new_key = coco_cache.content_hash(coco_dict)
+    assert new_key != key
+    coco_cache.load_or_build(tmp_path, "test", new_key, build)
+    assert len(calls) == 2
+
+
+def test_indices_match_create_index(tmp_path, coco_dict):
+    coco = coco_cache.COCOGroundTruthCache.from_coco_dict(coco_dict).to_coco()
+    reference = coco_cache.COCOGroundTruthCache.from_coco_dict(coco_dict).to_coco()
+    reference.createIndex()
+
+    assert coco.anns == reference.anns
+    assert coco.imgs == reference.imgs
+    assert coco.cats == reference.cats
+    assert dict(coco.imgToAnns) == dict(reference.imgToAnns)
+    assert {k: sorted(v) for k, v in coco.catToImgs.items()} == {
+        k: sorted(v) for k, v in reference.catToImgs.items()
+    }
+
+
+def test_file_key(tmp_path):
+    filename = os.path.join(tmp_path, "dataset.json")
+    with open(filename, "w") as f:
+        f.write("[]")
+    key = coco_cache.file_key(filename, ["star", "galaxy"])
+    assert coco_cache.file_key(filename, ["star", "galaxy"]) == key
+    assert coco_cache.file_key(filename, ["galaxy"]) != key
+    with open(filename, "w") as f:
+        f.write("[{}]")
+    assert coco_cache.file_key(filename, ["star", "galaxy"]) != key
+
+
+def test_segmentation_to_rle():
+    polygons = [[10, 10, 30, 12, 25, 40, 8, 30], [40, 40, 50, 40, 50, 50]]
+    rle = coco_cache.segmentation_to_rle(polygons, 64, 48)
+    assert isinstance(rle["counts"], str)
+    expected = mask_util.decode(mask_util.merge(mask_util.frPyObjects(polygons, 64, 48)))
+    np.testing.assert_array_equal(mask_util.decode(rle), expected)
@@ -0,0 +1,80 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from deepdisc.data_format import dihedral
+
+
+def box_of_mask(mask):
+    """XYXY box of the nonzero pixels of a mask, in pixel edge coordinates"""
+    ys, xs = np.nonzero(mask)
+    return np.array([xs.min(), ys.min(), xs.max() + 1, ys.max() + 1], dtype=np.float64)
+
+
+@pytest.mark.parametrize("variant", range(dihedral.NUM_VARIANTS))
+def test_boxes_follow_image(variant):
+    height, width = 20, 32
+    image = np.zeros((height, width, 2))
+    image[3:8, 5:14] = 1
+    box = box_of_mask(image[..., 0])
+
+    transformed = dihedral.dihedral_image(image, variant)
+    assert transformed.shape[:2] == dihedral.transformed_shape(height, width, variant)
+    np.testing.assert_array_equal(dihedral.dihedral_boxes(box, variant, height, width)[0], box_of_mask(transformed[..., 0]))
+
+
+def test_variants_are_distinct_and_exact():
+    image = np.arange(12.0).reshape(3, 4, 1)
+    variants = [dihedral.dihedral_image(image, v) for v in range(dihedral.NUM_VARIANTS)]
+    for a, b in itertools.combinations(variants, 2):
+        assert a.shape != b.shape or not np.array_equal(a, b)
+    # rotate twice and flip = vertical flip
+    np.testing.assert_array_equal(dihedral.dihedral_image(image, 6), image[::-1])
+
+
+def test_annotation_xywh_and_polygon():
+    annotation = {"bbox": [5, 3, 9, 5], "bbox_mode": 1, "segmentation": [[5, 3, 14, 3, 14, 8, 5, 8]]}
+    out = dihedral.dihedral_annotation(annotation, 1, 20, 32)
+    # one quarter turn: (x, y) -> (y, W - x)
+    assert out["bbox"] == [3, 18, 5, 9]
+    assert out["segmentation"] == [[3, 27, 3, 18, 8, 18, 8, 27]]
+    assert annotation["bbox"] == [5, 3, 9, 5]
+
+
+class ArrayReader:
+    def __init__(self, images):
+        self.images = images
+
+    def read(self, key):
+        return self.images[key]
+
+
+def test_materialize_and_sample(tmp_path):
+    rng = np.random.default_rng(0)
+    images = {k: rng.random((6, 8, 3)).astype(np.float32) for k in ["a", "b"]}
+    dataset_dicts = [
+        {"image_id": i, "key": k, "height": 6, "width": 8, "annotations": [{"bbox": [1, 1, 2, 2], "bbox_mode": 1}]}
+        for i, k in enumerate(images)
+    ]
+    variant_dicts = dihedral.materialize_dihedral_variants(
+        dataset_dicts, ArrayReader(images), lambda d: d["key"], str(tmp_path), json_file=str(tmp_path / "d.json")
+    )
+    assert len(variant_dicts) == 16
+    d = variant_dicts[3]
+    saved = np.load(d["filename"]).transpose(1, 2, 0)
+    np.testing.assert_array_equal(saved, dihedral.dihedral_image(images["a"], 3))
+    assert (d["height"], d["width"]) == saved.shape[:2]
+
+    sampler = iter(dihedral.DihedralVariantSampler(variant_dicts, seed=0))
+    indices = [next(sampler) for _ in range(20)]
+    # each pass of two draws covers both images
+    for i in range(0, 20, 2):
+        assert {variant_dicts[j]["dihedral_source"] for j in indices[i : i + 2]} == {0, 1}
+
+
+def test_compose():
+    image = np.arange(20.0).reshape(4, 5)
+    for a, b in itertools.product(range(dihedral.NUM_VARIANTS), repeat=2):
+        expected = dihedral.dihedral_image(dihedral.dihedral_image(image, a), b)
+        np.testing.assert_array_equal(dihedral.dihedral_image(image, dihedral.compose(a, b)), expected)
@@ -0,0 +1,76 @@
+import pytest
+import torch
+from torch import nn
+
+from deepdisc.inference.checkpoint import (
+    build_inference_model,
+    load_inference_checkpoint,
+    load_inference_weights,
+    save_inference_checkpoint,
+)
+
+
+class ToyModel(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = nn.Conv2d(3, 4, 3)
+        self.norm = nn.BatchNorm2d(4)
+        self.register_buffer("pixel_mean", torch.tensor([1.0, 2.0, 3.0]).view(3, 1, 1), persistent=False)
+
+    def forward(self, x):
+        return self.norm(self.conv(x - self.pixel_mean))
+
+
+def trained_model():
+    torch.manual_seed(0)
+    model = ToyModel()
+    model.pixel_mean.fill_(0.5)
+    model.norm.running_mean.uniform_()
+    return model.eval()
+
+
+def test_build_inference_model(tmp_path):
+    model = trained_model()
+    path = str(tmp_path / "toy.pt")
+    save_inference_checkpoint(model, path)
+
+    loaded = build_inference_model(ToyModel, path)
+    x = torch.randn(2, 3, 8, 8)
+    torch.testing.assert_close(loaded(x), model(x))
+    # the non-persistent buffers are restored too
+    torch.testing.assert_close(loaded.pixel_mean, model.pixel_mean)
+    assert not any(t.is_meta for t in list(loaded.parameters()) + list(loaded.buffers()))
+
+
+def test_half_checkpoint(tmp_path):
+    model = trained_model()
+    path = str(tmp_path / "toy_half.pt")
+    save_inference_checkpoint(model, path, half=True)
+    assert load_inference_checkpoint(path)["model"]["conv.weight"].dtype == torch.float16
+
+    loaded = load_inference_weights(ToyModel().eval(), path)
+    assert loaded.conv.weight.dtype == torch.float32
+    assert loaded.norm.running_mean.dtype == torch.float32
+    torch.testing.assert_close(loaded.pixel_mean, model.pixel_mean)
+    x = torch.randn(2, 3, 8, 8)
+    torch.testing.assert_close(loaded(x), model(x), atol=1e-2, rtol=1e-2)
+
+
+def test_rejects_other_checkpoints(tmp_path):
+    path = str(tmp_path / "state_dict.pt")
+    torch.save(trained_model().state_dict(), path)
+    with pytest.raises(ValueError):
+        load_inference_checkpoint(path)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="needs a GPU")
+def test_load_into_model_on_gpu(tmp_path):
+    model = trained_model()
+    path = str(tmp_path / "toy.pt")
+    save_inference_checkpoint(model, path)
+
+    # as the yacs path of AstroPredictor, where build_model has already moved the model
+    loaded = load_inference_weights(ToyModel().cuda().eval(), path)
+    assert all(t.is_cuda for t in list(loaded.parameters()) + list(loaded.buffers()))
+    x = torch.randn(2, 3, 8, 8)
+    torch.testing.assert_close(loaded(x.cuda()).cpu(), model(x))
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+import torch
+from torch import nn
+
+pytest.importorskip("detectron2")
+
+from detectron2.layers import ShapeSpec
+from detectron2.modeling import GeneralizedRCNN
+from detectron2.modeling.anchor_generator import DefaultAnchorGenerator
+from detectron2.modeling.backbone import Backbone
+from detectron2.modeling.box_regression import Box2BoxTransform
+from detectron2.modeling.matcher import Matcher
+from detectron2.modeling.proposal_generator import RPN, StandardRPNHead
+
+from deepdisc.benchmarks import roi_heads
+from deepdisc.inference.export import ExportedAstroPredictor, export_model
+
+
+class ToyFPN(Backbone):
+    """p2-p5 features from one convolution and average pooling"""
+
+    def __init__(self, in_channels=3):
+        super().__init__()
+        self.conv = nn.Conv2d(in_channels, 256, 3, stride=4, padding=1)
+
+    def forward(self, x):
+        p2 = self.conv(x)
+        return {f"p{i + 2}": nn.functional.avg_pool2d(p2, 2**i) if i else p2 for i in range(4)}
+
+    def output_shape(self):
+        return {f"p{i + 2}": ShapeSpec(channels=256, stride=4 * 2**i) for i in range(4)}
+
+
+def build_model():
+    torch.manual_seed(0)
+    backbone = ToyFPN()
+    rpn = RPN(
+        in_features=roi_heads.IN_FEATURES,
+        head=StandardRPNHead(in_channels=256, num_anchors=3),
+        anchor_generator=DefaultAnchorGenerator(
+            sizes=[[8], [16], [32], [64]], aspect_ratios=[[0.5, 1.0, 2.0]], strides=[4, 8, 16, 32]
+        ),
+        anchor_matcher=Matcher([0.3, 0.7], [0, -1, 1]),
+        box2box_transform=Box2BoxTransform((1.0, 1.0, 1.0, 1.0)),
+        batch_size_per_image=256,
+        positive_fraction=0.5,
+        pre_nms_topk=(100, 100),
+        post_nms_topk=(50, 50),
+    )
+    head = roi_heads.build_head("RedshiftPDFCasROIHeads", max_detections=10)
+    model = GeneralizedRCNN(
+        backbone=backbone, proposal_generator=rpn, roi_heads=head, pixel_mean=[0.0] * 3, pixel_std=[1.0] * 3
+    )
+    return model.eval()
+
+
+def test_export_and_load(tmp_path):
+    model = build_model()
+    rng = np.random.default_rng(0)
+    images = [rng.random((64, 64, 3)).astype(np.float32) for _ in range(3)]
+    path = str(tmp_path / "model.ts")
+    export_model(model, images[0], path, check_images=images[1:2])
+
+    predictor = ExportedAstroPredictor(path)
+    image = images[2]
+    with torch.no_grad():
+        expected = model([{"image": torch.as_tensor(image.transpose(2, 0, 1).copy()), "height": 64, "width": 64}])
+    expected = expected[0]["instances"]
+    actual = predictor(image)["instances"]
+    assert len(actual) == len(expected)
+    torch.testing.assert_close(actual.pred_boxes.tensor, expected.pred_boxes.tensor, atol=1e-3, rtol=1e-3)
+    torch.testing.assert_close(actual.pred_redshift_pdf, expected.pred_redshift_pdf, atol=1e-3, rtol=1e-3)
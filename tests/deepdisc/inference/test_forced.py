@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+import torch
+from torch import nn
+
+pytest.importorskip("detectron2")
+
+from detectron2.structures import ImageList
+
+from deepdisc.benchmarks import roi_heads
+from deepdisc.inference.forced import boxes_from_positions, forced_inference
+
+
+class FixedFeatureModel(nn.Module):
+    """The parts of GeneralizedRCNN used by forced_inference, with synthetic backbone features"""
+
+    def __init__(self, roi_heads, features, image_size):
+        super().__init__()
+        self.roi_heads = roi_heads
+        self.features = features
+        self.image_size = image_size
+
+    def preprocess_image(self, batched_inputs):
+        size = self.image_size
+        return ImageList(torch.zeros(len(batched_inputs), 3, size, size), [(size, size)] * len(batched_inputs))
+
+    def backbone(self, images):
+        return self.features
+
+
+def test_boxes_from_positions():
+    boxes = boxes_from_positions([10, 20], [5, 6], [4, 2])
+    np.testing.assert_array_equal(boxes, [[8.5, 3.5, 12.5, 7.5], [19.5, 5.5, 21.5, 7.5]])
+
+
+def test_forced_redshifts_match_detection():
+    head = roi_heads.build_head("RedshiftPDFCasROIHeads", max_detections=5)
+    features, proposals = roi_heads.make_inputs(image_size=128, n_proposals=20)
+    with torch.no_grad():
+        detected, _ = head(None, features, proposals)
+    detected = detected[0]
+
+    model = FixedFeatureModel(head, features, 128)
+    boxes = detected.pred_boxes.tensor.numpy()
+    outputs = forced_inference(model, [{"image": torch.zeros(3, 128, 128)}], [boxes], max_boxes_per_call=2)
+    forced = outputs[0]["instances"]
+
+    assert forced.forced_index.tolist() == list(range(len(boxes)))
+    assert len(forced.scores) == len(boxes)
+    torch.testing.assert_close(forced.pred_redshift_pdf, detected.pred_redshift_pdf)
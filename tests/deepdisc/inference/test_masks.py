@@ -0,0 +1,42 @@
+import pytest
+import torch
+
+pytest.importorskip("detectron2")
+
+from detectron2.structures import Boxes, Instances
+
+from deepdisc.inference.masks import RLEMasks, mask_rles, paste_masks, postprocess
+
+
+def raw_instances():
+    gen = torch.Generator().manual_seed(0)
+    instances = Instances((64, 64))
+    # the last box is outside the image, and dropped by the postprocessing
+    boxes = [[4.0, 4.0, 20.0, 30.0], [30.0, 10.0, 63.0, 40.0], [70.0, 70.0, 80.0, 80.0]]
+    instances.pred_boxes = Boxes(torch.tensor(boxes))
+    instances.scores = torch.tensor([0.9, 0.8, 0.7])
+    instances.pred_classes = torch.tensor([0, 1, 0])
+    instances.pred_masks = torch.rand(3, 1, 28, 28, generator=gen)
+    return instances
+
+
+@pytest.mark.parametrize("mask_format", ["roi", "rle"])
+def test_compact_masks_paste_to_full(mask_format):
+    full = postprocess(raw_instances(), 128, 128)
+    compact = postprocess(raw_instances(), 128, 128, mask_format=mask_format)
+
+    assert len(compact) == len(full) == 2
+    torch.testing.assert_close(compact.pred_boxes.tensor, full.pred_boxes.tensor)
+    assert torch.equal(paste_masks(compact), full.pred_masks)
+    assert mask_rles(compact) == mask_rles(full)
+    assert torch.equal(paste_masks(compact[1:]), full.pred_masks[1:])
+
+
+def test_rle_masks_indexing():
+    masks = torch.zeros(3, 8, 8, dtype=torch.bool)
+    masks[0, :2] = True
+    masks[2, 4:, 4:] = True
+    rles = RLEMasks(mask_rles(Instances((8, 8), pred_masks=masks)), (8, 8))
+    assert rles.area().tolist() == [16, 0, 16]
+    assert torch.equal(rles[torch.tensor([True, False, True])].decode(), masks[[0, 2]])
+    assert torch.equal(RLEMasks.cat([rles[:1], rles[2:]]).decode(), masks[[0, 2]])
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+import torch
+from torch import nn
+
+from deepdisc.inference.quantization import quantize_model, redshift_grid
+
+
+class ToyModel(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.backbone = nn.Sequential(nn.Linear(8, 16))
+        self.proposal_generator = None
+        self.roi_heads = nn.Sequential(nn.Linear(16, 64), nn.ReLU(), nn.Linear(64, 3))
+
+    def forward(self, x):
+        return self.roi_heads(self.backbone(x))
+
+
+@pytest.mark.parametrize("mode", ["heads", "all"])
+def test_quantize_model(mode):
+    torch.manual_seed(0)
+    model = ToyModel()
+    x = torch.randn(32, 8)
+    expected = model(x)
+
+    quantize_model(model, mode)
+    assert not isinstance(model.roi_heads[0], nn.Linear)
+    assert isinstance(model.backbone[0], nn.Linear) == (mode == "heads")
+    torch.testing.assert_close(model(x), expected, atol=0.05, rtol=0.05)
+
+
+def test_quantize_model_mode():
+    with pytest.raises(ValueError):
+        quantize_model(ToyModel(), "backbone")
+
+
+def test_redshift_grid():
+    model = ToyModel()
+    assert redshift_grid(model) is None
+    model.roi_heads.zgrid = np.linspace(0, 3, 300)
+    assert np.array_equal(redshift_grid(model), np.linspace(0, 3, 300))
+    assert np.array_equal(redshift_grid(model.roi_heads), np.linspace(0, 3, 300))
+
+
+def test_compare_outputs():
+    pytest.importorskip("detectron2")
+    from detectron2.structures import Boxes, Instances
+
+    from deepdisc.inference.quantization import compare_outputs
+
+    def outputs(boxes, scores, classes):
+        instances = Instances((64, 64))
+        instances.pred_boxes = Boxes(torch.tensor(boxes, dtype=torch.float32))
+        instances.scores = torch.tensor(scores)
+        instances.pred_classes = torch.tensor(classes)
+        instances.pred_redshift_pdf = torch.log_softmax(torch.arange(10.0) * torch.tensor(scores)[:, None], dim=1)
+        return {"instances": instances}
+
+    reference = outputs([[0, 0, 10, 10], [20, 20, 30, 30]], [0.9, 0.8], [0, 1])
+    candidate = outputs([[21, 20, 30, 30], [40, 40, 50, 50], [0, 0, 10, 10]], [0.7, 0.6, 0.9], [1, 0, 0])
+    with pytest.raises(ValueError):
+        # the PDFs cannot be compared without their grid
+        compare_outputs(reference, candidate)
+    result = compare_outputs(reference, candidate, zs=np.linspace(0, 1, 10))
+    assert (result["n_reference"], result["n_candidate"]) == (2, 3)
+    assert result["ious"][0] == 1.0 and result["ious"][1] == pytest.approx(0.9)
+    assert result["class_agree"] == [True, True]
+    assert result["score_diffs"] == pytest.approx([0.0, -0.1])
+    assert result["z_mean_diffs"][0] == 0
@@ -0,0 +1,94 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+import torch
+
+from deepdisc.inference.server import DynamicBatcher, InferenceServer, _UnixHTTPConnection, predict_remote
+
+
+class FakeInstances:
+    def __init__(self, fields):
+        self.fields = fields
+
+    def get_fields(self):
+        return self.fields
+
+
+class FakePredictor:
+    """Returns the mean of each image as its single detection's redshift"""
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def predict_batch(self, images):
+        self.batch_sizes.append(len(images))
+        return [
+            {"instances": FakeInstances({"pred_redshift": torch.tensor([float(image.mean())]), "name": "x"})}
+            for image in images
+        ]
+
+
+def test_batcher_groups_concurrent_requests():
+    predictor = FakePredictor()
+    batcher = DynamicBatcher(predictor.predict_batch, max_batch_size=4, max_latency_ms=200)
+    futures = [batcher.submit(np.full((2, 2, 1), i)) for i in range(6)]
+    results = [f.result(timeout=5)["instances"].get_fields()["pred_redshift"].item() for f in futures]
+    batcher.close()
+    assert results == list(range(6))
+    assert predictor.batch_sizes == [4, 2]
+
+
+def test_server_roundtrip(tmp_path):
+    predictor = FakePredictor()
+    for kwargs in [{"port": 0}, {"unix_socket": str(tmp_path / "deepdisc.sock")}]:
+        server = InferenceServer(predictor, max_latency_ms=50, **kwargs)
+        server.start()
+        address = {"unix_socket": kwargs["unix_socket"]} if "unix_socket" in kwargs else {"port": server.address[1]}
+        results = [None] * 4
+
+        def request(i):
+            results[i] = predict_remote(np.full((4, 4, 3), i, dtype=np.float32), timeout=10, **address)
+
+        threads = [threading.Thread(target=request, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        server.shutdown()
+        assert [r["pred_redshift"] for r in results] == [[0.0], [1.0], [2.0], [3.0]]
+        assert "name" not in results[0]
+
+
+class ChannelCheckingPredictor(FakePredictor):
+    def predict_batch(self, images):
+        if any(image.shape[-1] != 3 for image in images):
+            raise ValueError("Expected 3 channels")
+        return super().predict_batch(images)
+
+
+def test_bad_request_fails_alone():
+    predictor = ChannelCheckingPredictor()
+    batcher = DynamicBatcher(predictor.predict_batch, max_batch_size=4, max_latency_ms=200)
+    good = batcher.submit(np.ones((4, 4, 3)))
+    bad = batcher.submit(np.ones((4, 4, 5)))
+    assert good.result(timeout=5)["instances"].get_fields()["pred_redshift"].item() == 1.0
+    with pytest.raises(ValueError):
+        bad.result(timeout=5)
+    batcher.close()
+
+
+def test_empty_body_and_socket_cleanup(tmp_path):
+    path = str(tmp_path / "deepdisc.sock")
+    for _ in range(2):
+        # the second server can listen on the path the first one used
+        server = InferenceServer(FakePredictor(), unix_socket=path)
+        server.start()
+        conn = _UnixHTTPConnection(path, timeout=10)
+        conn.request("POST", "/predict", body=b"")
+        response = conn.getresponse()
+        assert response.status == 400
+        conn.close()
+        server.shutdown()
+    assert not os.path.exists(path)
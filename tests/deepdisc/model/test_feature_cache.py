@@ -0,0 +1,120 @@
+import torch
+from torch import nn
+
+from deepdisc.model.feature_cache import FeatureCacheRCNN, FeatureStore
+
+
+class ImageList:
+    def __init__(self, tensor):
+        self.tensor = tensor
+
+
+class CountingBackbone(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = nn.Conv2d(2, 3, 1)
+        self.calls = 0
+
+    def forward(self, x):
+        self.calls += len(x)
+        return {"p2": self.conv(x)}
+
+
+class ToyRCNN(nn.Module):
+    """The parts of GeneralizedRCNN used by FeatureCacheRCNN"""
+
+    def __init__(self):
+        super().__init__()
+        self.backbone = CountingBackbone()
+        self.head = nn.Linear(3, 1)
+        self.device = torch.device("cpu")
+
+    def preprocess_image(self, batched_inputs):
+        return ImageList(torch.stack([x["image"] for x in batched_inputs]))
+
+    def proposal_generator(self, images, features, gt_instances):
+        return None, {}
+
+    def roi_heads(self, images, features, proposals, gt_instances):
+        return None, {"loss": self.head(features["p2"].mean((2, 3))).sum()}
+
+    def forward(self, batched_inputs):
+        images = self.preprocess_image(batched_inputs)
+        return self.roi_heads(images, self.backbone(images.tensor), None, None)[1]
+
+
+def test_features_computed_once(tmp_path):
+    model = ToyRCNN()
+    for p in model.backbone.parameters():
+        p.requires_grad = False
+    wrapped = FeatureCacheRCNN(model, FeatureStore(str(tmp_path))).train()
+    batch = [{"image": torch.rand(2, 4, 4), "image_id": i, "dihedral": 0} for i in range(3)]
+
+    expected = model(batch)["loss"]
+    model.backbone.calls = 0
+    for _ in range(3):
+        loss = wrapped(batch)["loss"]
+        torch.testing.assert_close(loss, expected)
+        loss.backward()
+    assert model.backbone.calls == 3
+    assert model.head.weight.grad is not None
+
+    # the disk copy survives clearing the memory store
+    wrapped.store.clear()
+    wrapped(batch)
+    assert model.backbone.calls == 3
+
+    # a different variant of the same image is a new entry
+    wrapped([dict(batch[0], image=batch[0]["image"].flip(-1), dihedral=4)])
+    assert model.backbone.calls == 4
+
+
+def test_rotated_tiles_get_their_own_features():
+    model = ToyRCNN()
+    for p in model.backbone.parameters():
+        p.requires_grad = False
+    wrapped = FeatureCacheRCNN(model, FeatureStore()).train()
+    image = torch.rand(2, 4, 4)
+    # materialised variants of a square tile: same image_id and pixel statistics, no mapper rotation
+    variants = [{"image": torch.rot90(image, k, (1, 2)), "image_id": 7, "dihedral": 0} for k in (0, 1)]
+
+    features = [wrapped._features([v], v["image"][None])["p2"] for v in variants]
+    assert model.backbone.calls == 2
+    torch.testing.assert_close(features[1], model.backbone(variants[1]["image"][None])["p2"])
+    assert not torch.allclose(features[0], features[1])
+
+
+def test_store_lru():
+    store = FeatureStore(max_memory_mb=2 * 4 * 100 / 2**20)
+    for key in range(3):
+        store.put(key, {"p2": torch.zeros(100)})
+    assert store.get(0) is None
+    assert store.get(2) is not None
+
+
+def test_backbone_runs_in_eval_mode():
+    model = ToyRCNN()
+    model.backbone.conv = nn.Sequential(nn.Dropout(0.5), model.backbone.conv)
+    for p in model.backbone.parameters():
+        p.requires_grad = False
+    wrapped = FeatureCacheRCNN(model, FeatureStore()).train()
+    image = torch.rand(2, 4, 4)
+
+    losses = [wrapped([{"image": image, "image_id": i, "dihedral": None}])["loss"] for i in range(2)]
+    # no dropout sample, and the backbone is left in train mode
+    torch.testing.assert_close(losses[0], losses[1])
+    assert model.backbone.training
+
+
+def test_warns_without_hits(caplog, monkeypatch):
+    from deepdisc.model import feature_cache
+
+    monkeypatch.setattr(feature_cache, "_HIT_CHECK_SAMPLES", 4)
+    model = ToyRCNN()
+    for p in model.backbone.parameters():
+        p.requires_grad = False
+    wrapped = FeatureCacheRCNN(model, FeatureStore()).train()
+    for i in range(4):
+        # cropped samples have no dihedral variant
+        wrapped([{"image": torch.rand(2, 4, 4), "image_id": i, "dihedral": None}])
+    assert "has not been hit" in caplog.text
@@ -0,0 +1,44 @@
+import pytest
+import torch
+
+from deepdisc.benchmarks.mdn_loss import distribution_log_prob_grid, distribution_nll, make_inputs
+from deepdisc.model.losses import mdn_log_prob_grid, mdn_nll
+
+
+@pytest.mark.parametrize("scale_activation", ["exp", "softplus"])
+@pytest.mark.parametrize("num_components", [1, 3])
+def test_nll_matches_distributions(scale_activation, num_components):
+    inputs, z = make_inputs(50, num_components)
+    inputs = inputs.double()
+    z = z.double()
+
+    x = inputs.clone().requires_grad_(True)
+    expected = distribution_nll(x, z, num_components, scale_activation)
+    (expected_grad,) = torch.autograd.grad(expected.sum(), x)
+    x = inputs.clone().requires_grad_(True)
+    nll = mdn_nll(x, z, num_components, scale_activation)
+    (grad,) = torch.autograd.grad(nll.sum(), x)
+
+    torch.testing.assert_close(nll, expected)
+    torch.testing.assert_close(grad, expected_grad)
+
+    zs = torch.linspace(0, 3, 7, dtype=torch.float64)
+    torch.testing.assert_close(
+        mdn_log_prob_grid(inputs, zs, num_components, scale_activation),
+        distribution_log_prob_grid(inputs, zs, num_components, scale_activation),
+    )
+
+
+def test_nll_far_tail_is_finite():
+    # the mixture log density stays finite where every component's density underflows
+    inputs = torch.tensor([[0.0, 5.0, 0.0, 1.0, -3.0, -3.0]])
+    nll = mdn_nll(inputs, torch.tensor([2.0]), 2)
+    assert torch.isfinite(nll).all()
+
+
+def test_bin_weights():
+    inputs, z = make_inputs(20, 2)
+    zbins = torch.tensor([1.0, 2.0])
+    bin_weights = torch.tensor([1.0, 2.0, 3.0])
+    weighted = mdn_nll(inputs, z, 2, zbins=zbins, bin_weights=bin_weights)
+    torch.testing.assert_close(weighted, mdn_nll(inputs, z, 2) * bin_weights[torch.bucketize(z, zbins)])
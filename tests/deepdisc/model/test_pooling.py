@@ -0,0 +1,40 @@
+import pytest
+import torch
+from torch import nn
+
+pytest.importorskip("detectron2")
+
+from detectron2.modeling.poolers import ROIPooler
+from detectron2.structures import Boxes
+
+from deepdisc.model.pooling import pool_subset, share_roi_pooling
+
+
+def make_pooler(output_size=7):
+    return ROIPooler(output_size, (0.25, 0.125), sampling_ratio=0, pooler_type="ROIAlignV2")
+
+
+class Heads(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.box_pooler = make_pooler()
+        self.mask_pooler = make_pooler(14)
+        self.redshift_pooler = make_pooler()
+
+    def forward(self, features, boxes, masks):
+        self.box_pooler(features, boxes)
+        self.mask_pooler(features, boxes)
+        return pool_subset(self.redshift_pooler, features, boxes, masks)
+
+
+def test_shared_pooling_matches_separate():
+    features = [torch.rand(2, 4, 32, 32), torch.rand(2, 4, 16, 16)]
+    boxes = [Boxes(torch.tensor([[0.0, 0, 20, 20], [10, 10, 90, 100], [4, 8, 40, 30]])), Boxes(torch.tensor([[5.0, 5, 60, 60]]))]
+    masks = [torch.tensor([True, False, True]), torch.tensor([True])]
+    expected = make_pooler()(features, [b[m] for b, m in zip(boxes, masks)])
+
+    heads = Heads()
+    cache = share_roi_pooling(heads)
+    torch.testing.assert_close(heads(features, boxes, masks), expected)
+    assert cache._entries == []
+    assert heads.redshift_pooler.output_size == (7, 7)
@@ -0,0 +1,49 @@
+"""Importing the image readers and data mappers (e.g. in data loader workers) must stay cheap."""
+
+import json
+import subprocess
+import sys
+
+import pytest
+
+# Modules that must only be imported on first use
+HEAVY_MODULES = [
+    "astropy.io.fits",
+    "astropy.visualization",
+    "h5py",
+    "matplotlib",
+    "pycocotools",
+    "scarlet",
+    "deepdisc.astrodet.astrodet",
+    "detectron2.evaluation",
+    "detectron2.utils.visualizer",
+]
+
+
+def import_in_subprocess(module):
+    """Import a module in a fresh interpreter; return the import time and the heavy modules it loaded"""
+    code = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "elapsed = time.perf_counter() - start\n"
+        f"print(json.dumps([elapsed, [m for m in {HEAVY_MODULES!r} if m in sys.modules]]))\n"
+    )
+    out = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+    return json.loads(out.splitlines()[-1])
+
+
+@pytest.mark.parametrize(
+    "module, budget",
+    [
+        ("deepdisc.data_format.image_readers", 2.0),
+        ("deepdisc.data_format.conversions", 2.0),
+        ("deepdisc.model.loaders", 15.0),
+    ],
+)
+def test_import_budget(module, budget):
+    if module == "deepdisc.model.loaders":
+        pytest.importorskip("detectron2")
+    elapsed, loaded = import_in_subprocess(module)
+    assert loaded == []
+    assert elapsed < budget
@@ -0,0 +1,76 @@
+import json
+import os
+
+import pytest
+
+from deepdisc.utils.profiling import StageTimer
+
+
+class FakeStorage:
+    def __init__(self):
+        self.scalars = {}
+
+    def put_scalars(self, smoothing_hint=True, **kwargs):
+        self.scalars.update(kwargs)
+
+
+def test_stage_timer_percentiles():
+    timer = StageTimer()
+    for i in range(1, 101):
+        timer.record("forward", 0.0, i * 1e-3)
+    with timer.stage("image_read"):
+        pass
+
+    stats = timer.percentiles()
+    assert set(stats.keys()) == {"forward", "image_read"}
+    assert stats["forward"]["count"] == 100
+    assert stats["forward"]["p50"] == pytest.approx(0.0505)
+    assert stats["forward"]["p50"] <= stats["forward"]["p90"] <= stats["forward"]["p99"]
+
+    storage = FakeStorage()
+    timer.write_to_storage(storage)
+    assert "time/forward_p99" in storage.scalars
+    assert "time/image_read_p50" in storage.scalars
+
+
+def test_stage_timer_disabled():
+    timer = StageTimer(enabled=False)
+    with timer.stage("forward"):
+        pass
+    timer.record("backward", 0.0, 1.0)
+    assert timer.percentiles() == {}
+    assert timer.pop_sample_timings() == []
+
+
+def test_stage_timer_sample_timings(tmp_path):
+    worker = StageTimer()
+    with worker.stage("image_read"):
+        pass
+    with worker.stage("augmentation"):
+        pass
+    timings = worker.pop_sample_timings()
+    assert [t[0] for t in timings] == ["image_read", "augmentation"]
+    assert worker.pop_sample_timings() == []
+
+    main = StageTimer()
+    main.add_sample_timings(timings)
+    assert main.percentiles()["image_read"]["count"] == 1
+
+    filename = os.path.join(tmp_path, "trace.json")
+    main.export_chrome_trace(filename)
+    with open(filename) as f:
+        trace = json.load(f)
+    assert [e["name"] for e in trace["traceEvents"]] == ["image_read", "augmentation"]
+    assert all(e["ph"] == "X" and e["dur"] >= 0 for e in trace["traceEvents"])
+
+
+def test_timed_collator():
+    pytest.importorskip("detectron2")
+    from deepdisc.model.loaders import TimedCollator
+
+    samples = [{"image": 0, "timings": [("image_read", 0.0, 1.0, 1, 1)]}, {"image": 1}]
+    batch = TimedCollator()(samples)
+    assert [d["image"] for d in batch] == [0, 1]
+    # the collation interval rides along with the first sample's timings
+    assert [t[0] for t in batch[0]["timings"]] == ["image_read", "collation"]
+    assert "timings" not in batch[1]